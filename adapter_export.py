@@ -0,0 +1,78 @@
+import argparse
+import json
+import os
+
+import torch
+
+from llava_finetune.adapter_export import (
+    EXPORT_FORMATS,
+    benchmark,
+    export_adapter,
+    load_adapter,
+    load_exported,
+    max_difference,
+    optimize_adapter,
+)
+from llava_finetune.embeddings import decode_embeddings
+
+
+def arg_parser():
+    parser = argparse.ArgumentParser(description="Export the SegAdapter of a model for low-latency inference")
+    parser.add_argument("--model_name", type=str, default="shorter_big", help="Model in the models directory")
+    parser.add_argument("--formats", type=str, nargs="+", default=["torchscript"], choices=EXPORT_FORMATS, help="Artifacts to export")
+    parser.add_argument("--int8", action="store_true", help="Also export the int8 dynamically quantized adapter (torchscript only)")
+    parser.add_argument("--output_dir", type=str, default="models/exported", help="Directory of the exported adapters")
+    parser.add_argument("--dataset", type=str, default=None, help="Dataset jsonl whose SAM embeddings are used as inputs (random inputs if not given)")
+    parser.add_argument("--num_segments", type=int, default=64, help="Segments per call in the latency benchmark")
+    parser.add_argument("--iters", type=int, default=50, help="Iterations of the latency benchmark")
+    parser.add_argument("--tolerance", type=float, default=1e-4, help="Maximum relative difference with the eager adapter (fp32 exports)")
+    return parser.parse_args()
+
+
+def load_inputs(adapter, dataset: str, num_segments: int) -> torch.Tensor:
+    """Segment embeddings of the first images of the dataset, or random embeddings around the training mean"""
+    if dataset is None:
+        mean = adapter.mean_train_masks
+        return mean + torch.randn(num_segments, mean.size(-1))
+    embs = []
+    with open(dataset, "r") as f:
+        for line in f:
+            embs += decode_embeddings(json.loads(line)["sam_embs"])
+            if len(embs) >= num_segments:
+                break
+    return torch.stack(embs[:num_segments])
+
+
+# python adapter_export.py --model_name shorter_big --formats torchscript onnx --int8
+if __name__ == "__main__":
+    args = arg_parser()
+    os.makedirs(args.output_dir, exist_ok=True)
+    torch.set_grad_enabled(False)
+
+    adapter = load_adapter(args.model_name)
+    inputs = load_inputs(adapter, args.dataset, args.num_segments)
+
+    candidates = {"fp32": optimize_adapter(adapter)}
+    if args.int8:
+        candidates["int8"] = optimize_adapter(adapter, int8=True)
+
+    latencies = {"eager": benchmark(adapter, inputs, args.iters)}
+    for name, module in candidates.items():
+        latencies[f"fused {name}"] = benchmark(module, inputs, args.iters)
+
+        for format in args.formats:
+            if name == "int8" and format == "onnx":
+                # the quantized torch operators have no ONNX equivalent, quantize the fp32 ONNX model with onnxruntime
+                continue
+            path = os.path.join(args.output_dir, f"{args.model_name}_{name}.{'onnx' if format == 'onnx' else 'pt'}")
+            export_adapter(module, path, format, inputs[:2])
+            exported = load_exported(path)
+
+            error = max_difference(adapter, exported, inputs)
+            status = "OK" if name == "int8" or error <= args.tolerance else "MISMATCH"
+            print(f"{path}: max relative difference with the eager adapter {error:.2e} ({status})")
+            latencies[f"{format} {name}"] = benchmark(exported, inputs, args.iters)
+
+    print(f"Latency for {len(inputs)} segments on the cpu (median of {args.iters} calls):")
+    for name, latency in latencies.items():
+        print(f"  {name:<20} {latency:8.2f} ms ({latencies['eager'] / latency:.2f}x)")
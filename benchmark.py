@@ -0,0 +1,507 @@
+import argparse
+import itertools
+import json
+import os
+import platform
+import random
+import resource
+import shutil
+import subprocess
+import tempfile
+import time
+from types import SimpleNamespace
+
+import cv2
+import numpy as np
+import torch
+from PIL import Image
+
+from configuration import load_yaml_config
+from inference import InferencePipeline, InferenceSample
+from llava_finetune.adapter_export import optimize_adapter
+from llava_finetune.metrics import compute_IoU
+from llava_finetune.model import MASK_POSITION_TEXTS, OUTPUT_MASK_TEXTS, DynamicVocabLlavaModel, LISA_Model, SegAdapter
+from llava_finetune.utils import collate_fn, draw_shapes
+from preprocessing.cache import PreprocessCache
+
+# Groups of micro benchmarks, in the order they are run
+MICRO_GROUPS = ("dynamic_vocab", "adapter", "masks", "metrics", "draw", "collate")
+
+
+def arg_parser():
+    parser = argparse.ArgumentParser(description="CPU benchmarks of the hot functions of the project, results saved as JSON")
+    parser.add_argument("command", choices=["micro", "e2e"], help="micro: functions driven with synthetic inputs, e2e: training steps, generation and inference pipeline of a tiny random LLava")
+    parser.add_argument("--groups", type=str, nargs="+", default=list(MICRO_GROUPS), choices=MICRO_GROUPS, help="Benchmark groups to run (micro)")
+    parser.add_argument("--output", type=str, default=None, help="JSON file of the results (default: output/benchmarks/<command>.json)")
+    parser.add_argument("--repeat", type=int, default=20, help="Timed calls of every benchmark (e2e: training steps and generations)")
+    parser.add_argument("--warmup", type=int, default=3, help="Untimed calls before the timed ones")
+    parser.add_argument("--threads", type=int, default=None, help="Torch threads (default: torch default)")
+    parser.add_argument("--num_masks", type=int, default=50, help="Masks per image")
+    parser.add_argument("--mask_size", type=int, default=1024, help="Side of the masks and images")
+    parser.add_argument("--vocab_size", type=int, default=256000, help="Vocabulary of the stand-in language model (Gemma: 256000)")
+    parser.add_argument("--hidden_size", type=int, default=2048, help="Embedding size of the stand-in language model (Gemma 2B: 2048)")
+    parser.add_argument("--seg_emb_size", type=int, default=512, help="Size of the AlphaCLIP embeddings")
+    parser.add_argument("--batch_size", type=int, default=16, help="Samples collated by collate_fn")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the tiny model and of the synthetic samples (e2e)")
+    parser.add_argument("--e2e_batch_size", type=int, default=2, help="Samples per training step and generation (e2e)")
+    parser.add_argument("--neg_masks", type=int, default=8, help="Negative masks per sample (e2e)")
+    parser.add_argument("--max_new_tokens", type=int, default=16, help="Tokens generated per sample (e2e)")
+    parser.add_argument("--config", type=str, default="config.example.yaml", help="Project configuration of the inference pipeline (e2e)")
+    return parser.parse_args()
+
+
+def measure(fn, repeat: int = 20, warmup: int = 3, teardown=None) -> dict:
+    """
+    Time the calls of a function.
+
+    Args:
+        fn (callable): function without arguments
+        repeat (int, optional): timed calls. Defaults to 20.
+        warmup (int, optional): untimed calls before the timed ones. Defaults to 3.
+        teardown (callable, optional): untimed function called after every call (e.g. to undo its effects)
+
+    Returns:
+        dict: median, mean, min, p90 and p99 time in milliseconds and the number of timed calls
+    """
+    times = []
+    for i in range(warmup + repeat):
+        start = time.perf_counter()
+        fn()
+        elapsed = time.perf_counter() - start
+        if teardown is not None:
+            teardown()
+        if i >= warmup:
+            times.append(elapsed * 1000)
+    times = np.asarray(times)
+    return {
+        "median_ms": float(np.median(times)),
+        "mean_ms": float(times.mean()),
+        "min_ms": float(times.min()),
+        "p90_ms": float(np.percentile(times, 90)),
+        "p99_ms": float(np.percentile(times, 99)),
+        "repeat": repeat,
+    }
+
+
+def peak_rss_mb() -> float:
+    """Peak resident memory of the process so far, in MiB"""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def environment() -> dict:
+    """Versions, hardware and commit the results were obtained with"""
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "git_commit": commit,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "torch": torch.__version__,
+        "numpy": np.__version__,
+        "cpu_count": os.cpu_count(),
+        "torch_threads": torch.get_num_threads(),
+    }
+
+
+# ==========================
+# Synthetic inputs
+# ==========================
+
+
+def synthetic_masks(num_masks: int, size: int, seed: int = 0) -> list[np.ndarray]:
+    """uint8 masks (0 or 255) of random filled ellipses, like the SAM masks after reshape_image"""
+    rng = np.random.default_rng(seed)
+    masks = []
+    for _ in range(num_masks):
+        mask = np.zeros((size, size), dtype=np.uint8)
+        center = tuple(int(v) for v in rng.integers(size // 8, size - size // 8, 2))
+        axes = tuple(int(v) for v in rng.integers(size // 32, size // 4, 2))
+        cv2.ellipse(mask, center, axes, float(rng.uniform(0, 180)), 0, 360, 255, -1)
+        masks.append(mask)
+    return masks
+
+
+def mask_shapes(masks: list[np.ndarray]) -> list:
+    """Shapes of the masks in the format of the datasets (same as PreprocessPipeline.get_shapes_from_masks)"""
+    shapes = [cv2.findContours(mask, cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE)[0] for mask in masks]
+    return [[[tuple(int(v) for v in p[0]) for p in s] for s in shape] for shape in shapes]
+
+
+def stand_in_llava(vocab_size: int, hidden_size: int) -> DynamicVocabLlavaModel:
+    """
+    DynamicVocabLlavaModel around a one-layer LLava with the vocabulary and embedding size of the real model,
+    so that the embedding matrix operations have the real cost (bfloat16 weights, as the quantized models).
+    """
+    from transformers import LlavaConfig, LlavaForConditionalGeneration
+
+    config = LlavaConfig(
+        text_config={
+            "model_type": "gemma",
+            "vocab_size": vocab_size,
+            "hidden_size": hidden_size,
+            "intermediate_size": 64,
+            "num_hidden_layers": 1,
+            "num_attention_heads": 1,
+            "num_key_value_heads": 1,
+            "head_dim": 16,
+        },
+        vision_config={
+            "model_type": "clip_vision_model",
+            "hidden_size": 32,
+            "intermediate_size": 64,
+            "num_hidden_layers": 1,
+            "num_attention_heads": 1,
+            "image_size": 28,
+            "patch_size": 14,
+        },
+        image_token_index=vocab_size - 1,
+    )
+    model = LlavaForConditionalGeneration._from_config(config, torch_dtype=torch.bfloat16)
+    processor = SimpleNamespace(tokenizer=SimpleNamespace(vocab_size=vocab_size - 1))
+    return DynamicVocabLlavaModel(model, processor)
+
+
+# ==========================
+# Benchmark groups
+# ==========================
+# every group returns {name: (function, teardown or None, parameters)}
+
+
+def dynamic_vocab_cases(args) -> dict:
+    vocab = stand_in_llava(args.vocab_size, args.hidden_size)
+    new_tokens = torch.randn(args.num_masks, args.hidden_size, dtype=torch.bfloat16)
+    params = {"vocab_size": args.vocab_size, "hidden_size": args.hidden_size, "new_tokens": args.num_masks}
+
+    def add_and_reset():
+        vocab.add_tokens(new_tokens)
+        vocab.reset_tokens()
+
+    return {
+        "add_tokens": (lambda: vocab.add_tokens(new_tokens), vocab.reset_tokens, params),
+        "add_tokens+reset_tokens": (add_and_reset, None, params),
+    }
+
+
+def adapter_cases(args) -> dict:
+    mean_path = os.path.join(tempfile.mkdtemp(), "train_embs_mean.pt")
+    torch.save(torch.randn(args.seg_emb_size) * 0.1, mean_path)
+    inputs = torch.randn(args.num_masks, args.seg_emb_size)
+
+    cases = {}
+    for variant, kwargs in {"mlp": {"mlp_adapter": True}, "query_blocks": {}}.items():
+        adapter = SegAdapter(args.seg_emb_size, args.hidden_size, mean_path=mean_path, **kwargs).eval()
+        fused = optimize_adapter(adapter)
+        params = {"segments": args.num_masks, "input_dim": args.seg_emb_size, "output_dim": args.hidden_size}
+        cases[f"SegAdapter.forward[{variant}]"] = (lambda a=adapter: a(inputs), None, params)
+        cases[f"FusedSegAdapter.forward[{variant}]"] = (lambda a=fused: a(inputs), None, params)
+    return cases
+
+
+def mask_cases(args) -> dict:
+    from preprocess import PreprocessPipeline, iou
+
+    sam_masks = synthetic_masks(args.num_masks, args.mask_size)
+    gt_masks = synthetic_masks(3, args.mask_size, seed=1)
+    # one of the SAM masks is a ground truth mask and gets removed
+    sam_masks[0] = gt_masks[0].copy()
+    params = {"masks": args.num_masks, "gt_masks": len(gt_masks), "size": args.mask_size}
+
+    return {
+        "iou": (lambda: iou(sam_masks[1], gt_masks[0]), None, {"size": args.mask_size}),
+        "remove_gt_masks": (lambda: PreprocessPipeline.remove_gt_masks(None, sam_masks, gt_masks), None, params),
+        "get_shapes_from_masks": (lambda: PreprocessPipeline.get_shapes_from_masks(None, sam_masks), None, params),
+    }
+
+
+def metric_cases(args) -> dict:
+    shapes = mask_shapes(synthetic_masks(4, args.mask_size, seed=2))
+    gt, pred = [shapes[0]], shapes[1:]
+    return {"compute_IoU": (lambda: compute_IoU(gt, pred), None, {"gt_masks": 1, "pred_masks": len(pred), "size": args.mask_size})}
+
+
+def draw_cases(args) -> dict:
+    rng = np.random.default_rng(3)
+    image = Image.fromarray(rng.integers(0, 255, (args.mask_size, args.mask_size, 3), dtype=np.uint8))
+    shapes = mask_shapes(synthetic_masks(args.num_masks, args.mask_size))
+    size = (args.mask_size, args.mask_size)
+    return {"draw_shapes": (lambda: draw_shapes(image, shapes, resize=size), None, {"masks": args.num_masks, "size": args.mask_size})}
+
+
+def collate_cases(args) -> dict:
+    shapes = mask_shapes(synthetic_masks(args.num_masks, args.mask_size))
+    rng = np.random.default_rng(4)
+    batch = [
+        {
+            "img": f"{i}.jpg",
+            "sam_embs": rng.standard_normal((args.num_masks, args.seg_emb_size)).tolist(),
+            "sam_shapes": shapes,
+            "gt_embs": rng.standard_normal((1, args.seg_emb_size)).tolist(),
+            "gt_shapes": shapes[:1],
+            "query": "What is in the image?",
+            "answer": "The object is in [SEG]",
+        }
+        for i in range(args.batch_size)
+    ]
+    return {"collate_fn": (lambda: collate_fn(batch), None, {"batch_size": args.batch_size, "masks": args.num_masks})}
+
+
+GROUP_CASES = {
+    "dynamic_vocab": dynamic_vocab_cases,
+    "adapter": adapter_cases,
+    "masks": mask_cases,
+    "metrics": metric_cases,
+    "draw": draw_cases,
+    "collate": collate_cases,
+}
+
+
+def run_micro(args) -> list[dict]:
+    """Run the selected groups, a group whose dependencies cannot be imported is reported as skipped"""
+    results = []
+    for group in args.groups:
+        try:
+            cases = GROUP_CASES[group](args)
+        except ImportError as e:
+            print(f"[{group}] skipped: {e}")
+            results.append({"group": group, "skipped": str(e)})
+            continue
+
+        with torch.no_grad():
+            for name, (fn, teardown, params) in cases.items():
+                stats = measure(fn, args.repeat, args.warmup, teardown)
+                print(f"{f'[{group}] {name}':<56} median {stats['median_ms']:10.3f} ms | p90 {stats['p90_ms']:10.3f} ms")
+                results.append({"group": group, "name": name, "params": params, **stats})
+    return results
+
+
+# ==========================
+# End-to-end benchmark
+# ==========================
+
+
+def build_tiny_llava(path: str, seed: int = 0) -> str:
+    """
+    Save a tiny randomly initialized LLava (Gemma text model, CLIP vision tower) and its processor to path, so that
+    LISA_Model can load it with from_pretrained without downloading anything.
+    The word-level vocabulary contains the words of the training templates, the other words are unknown tokens.
+
+    Returns:
+        str: path of the model
+    """
+    from tokenizers import Regex, Tokenizer, decoders, models, pre_tokenizers
+    from transformers import (
+        CLIPImageProcessor,
+        LlavaConfig,
+        LlavaForConditionalGeneration,
+        LlavaProcessor,
+        PreTrainedTokenizerFast,
+    )
+
+    chat_template = (
+        "{{ bos_token }}{% for message in messages %}"
+        "{% set role = 'model' if message['role'] == 'assistant' else message['role'] %}"
+        "{{ '<start_of_turn>' + role + '\\n' + message['content'] | trim + '<end_of_turn>\\n' }}{% endfor %}"
+        "{% if add_generation_prompt %}{{'<start_of_turn>model\\n'}}{% endif %}"
+    )
+    specials = ["<pad>", "<eos>", "<bos>", "<unk>", "<start_of_turn>", "<end_of_turn>", "\n", "user", "model"]
+    words = sorted({w for text in MASK_POSITION_TEXTS + OUTPUT_MASK_TEXTS for w in text.lower().split()})
+    words += [f"w{i}" for i in range(256)]
+    tokenizer = Tokenizer(models.WordLevel({t: i for i, t in enumerate(specials + words)}, unk_token="<unk>"))
+    tokenizer.pre_tokenizer = pre_tokenizers.Split(Regex(r"\n|[^\s]+"), behavior="removed", invert=True)
+    tokenizer.decoder = decoders.Fuse()
+    tokenizer = PreTrainedTokenizerFast(
+        tokenizer_object=tokenizer,
+        pad_token="<pad>",
+        eos_token="<eos>",
+        bos_token="<bos>",
+        unk_token="<unk>",
+        additional_special_tokens=["<start_of_turn>", "<end_of_turn>"],
+        model_input_names=["input_ids", "attention_mask"],
+    )
+    tokenizer.chat_template = chat_template
+    tokenizer.add_tokens(["<image>"], special_tokens=True)
+
+    image_processor = CLIPImageProcessor(size={"shortest_edge": 32}, crop_size={"height": 32, "width": 32})
+    processor = LlavaProcessor(image_processor=image_processor, tokenizer=tokenizer, chat_template=chat_template, image_token="<image>")
+    config = LlavaConfig(
+        vision_config={
+            "model_type": "clip_vision_model",
+            "hidden_size": 32,
+            "intermediate_size": 64,
+            "num_hidden_layers": 2,
+            "num_attention_heads": 2,
+            "image_size": 32,
+            "patch_size": 8,
+            "projection_dim": 32,
+        },
+        text_config={
+            "model_type": "gemma",
+            "vocab_size": tokenizer.vocab_size + 1,
+            "hidden_size": 64,
+            "intermediate_size": 128,
+            "num_hidden_layers": 2,
+            "num_attention_heads": 4,
+            "num_key_value_heads": 1,
+            "head_dim": 16,
+            "pad_token_id": 0,
+            "bos_token_id": 2,
+            "eos_token_id": 1,
+            "tie_word_embeddings": True,
+        },
+        image_token_index=tokenizer.convert_tokens_to_ids("<image>"),
+        vision_feature_select_strategy="default",
+        vision_feature_layer=-1,
+        tie_word_embeddings=True,
+    )
+    torch.manual_seed(seed)
+    LlavaForConditionalGeneration(config).save_pretrained(path)
+    processor.save_pretrained(path)
+    return path
+
+
+def synthetic_samples(num_samples: int, seg_emb_size: int, neg_masks: int, seed: int = 0) -> list[dict]:
+    """Samples in the format of the training batches: image, query, answer, ground truth and SAM embeddings"""
+    rng = np.random.default_rng(seed)
+    samples = []
+    for i in range(num_samples):
+        words = " ".join(f"w{w}" for w in rng.integers(0, 256, 6))
+        samples.append({
+            "image": Image.fromarray(rng.integers(0, 255, (480, 640, 3), dtype=np.uint8)),
+            "queries": f"{words} {OUTPUT_MASK_TEXTS[i % len(OUTPUT_MASK_TEXTS)]}",
+            "answer": f"{MASK_POSITION_TEXTS[i % len(MASK_POSITION_TEXTS)]} {words}",
+            "gt_embs": torch.from_numpy(rng.standard_normal((1, seg_emb_size), dtype=np.float32)),
+            "sam_embs": torch.from_numpy(rng.standard_normal((neg_masks, seg_emb_size), dtype=np.float32)),
+        })
+    return samples
+
+
+def seed_everything(seed: int):
+    random.seed(seed)
+    np.random.seed(seed)
+    torch.manual_seed(seed)
+
+
+def run_e2e(args) -> list[dict]:
+    """
+    Train, generate and serve a LISA_Model built around a tiny random LLava, in a temporary workspace (deleted after).
+
+    Every phase reports its latency percentiles, its throughput and the peak resident memory of the process after it.
+    The seeds and the inputs are fixed and the losses and generated tokens are reported, so that a change in the
+    results is noticed along with a change in the timings.
+    """
+    config = load_yaml_config(args.config)
+    workspace = tempfile.mkdtemp(prefix="lisa_benchmark_")
+    cwd = os.getcwd()
+    os.chdir(workspace)
+    try:
+        os.makedirs("models")
+        model_path = build_tiny_llava(os.path.join(workspace, "tiny-llava"), args.seed)
+        torch.save(torch.zeros(args.seg_emb_size), "models/train_embs_mean.pt")
+        model_params = {"model_name": model_path, "seg_emb_size": args.seg_emb_size, "q4": False, "lora_rank": 4}
+
+        seed_everything(args.seed)
+        model = LISA_Model(**model_params, device="cpu")
+        samples = synthetic_samples(args.e2e_batch_size * 4, args.seg_emb_size, args.neg_masks, args.seed)
+        batches = [collate_fn(samples[i : i + args.e2e_batch_size]) for i in range(0, len(samples), args.e2e_batch_size)]
+        params = {"batch_size": args.e2e_batch_size, "neg_masks": args.neg_masks, "seg_emb_size": args.seg_emb_size}
+        results = []
+
+        # ========= training =========
+        optimizer = torch.optim.AdamW([
+            {"params": model.adapter.parameters(), "lr": 1e-3},
+            {"params": [p for p in model.llava_model.llava_model.parameters() if p.requires_grad], "lr": 1e-3},
+        ])
+        losses = []
+        batch_iter = itertools.cycle(batches)
+
+        def train_step():
+            batch = next(batch_iter)
+            _, loss = model.optim_step(
+                batch["queries"], batch["image"], batch["answer"], batch["gt_embs"], batch["sam_embs"], optimizer
+            )
+            losses.append(None if loss is None else round(loss.item(), 4))
+
+        model.train()
+        stats = measure(train_step, args.repeat, args.warmup)
+        results.append({
+            "group": "e2e", "name": "LISA_Model.optim_step", "params": params, **stats,
+            "samples_per_sec": args.e2e_batch_size * 1000 / stats["mean_ms"],
+            "peak_rss_mb": peak_rss_mb(),
+            "losses": losses[args.warmup :],
+        })
+
+        # ========= generation =========
+        model.eval()
+        generated = []
+        batch_iter = itertools.cycle(batches)
+
+        def generate():
+            batch = next(batch_iter)
+            _, tokens = model.generate(
+                batch["queries"], batch["image"], batch["gt_embs"], batch["sam_embs"], max_new_tokens=args.max_new_tokens
+            )
+            generated.append([t.tolist() for t in tokens])
+
+        with torch.no_grad():
+            stats = measure(generate, args.repeat, args.warmup)
+        new_tokens = args.e2e_batch_size * args.max_new_tokens
+        results.append({
+            "group": "e2e", "name": "LISA_Model.generate", "params": {**params, "max_new_tokens": args.max_new_tokens}, **stats,
+            "samples_per_sec": args.e2e_batch_size * 1000 / stats["mean_ms"],
+            "max_tokens_per_sec": new_tokens * 1000 / stats["mean_ms"],
+            "peak_rss_mb": peak_rss_mb(),
+            "generated_tokens": generated[args.warmup],
+        })
+
+        # ========= inference pipeline =========
+        torch.save(model.state_dict(), "models/tiny.pth")
+        with open("models/tiny.json", "w") as f:
+            json.dump(model_params, f)
+        pipeline = InferencePipeline(config, "tiny", cache=PreprocessCache(cache_dir=None))
+        # the stored SAM embeddings skip SAM and AlphaCLIP, only the model is measured
+        inference_samples = [
+            InferenceSample(query=s["queries"], image=s["image"], sam_embs=s["sam_embs"], sam_shapes=[[]] * args.neg_masks)
+            for s in samples
+        ]
+        sample_iter = itertools.cycle(range(0, len(inference_samples), args.e2e_batch_size))
+
+        def infer():
+            start = next(sample_iter)
+            list(pipeline.inference(inference_samples[start : start + args.e2e_batch_size], max_new_tokens=args.max_new_tokens))
+
+        stats = measure(infer, args.repeat, args.warmup)
+        results.append({
+            "group": "e2e", "name": "InferencePipeline.inference", "params": {**params, "max_new_tokens": args.max_new_tokens}, **stats,
+            "samples_per_sec": args.e2e_batch_size * 1000 / stats["mean_ms"],
+            "peak_rss_mb": peak_rss_mb(),
+        })
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workspace, ignore_errors=True)
+
+    for result in results:
+        print(
+            f"{result['name']:<32} median {result['median_ms']:9.2f} ms | p90 {result['p90_ms']:9.2f} ms | "
+            f"p99 {result['p99_ms']:9.2f} ms | {result['samples_per_sec']:7.2f} samples/s | peak RSS {result['peak_rss_mb']:.0f} MiB"
+        )
+    return results
+
+
+# python benchmark.py micro --output output/benchmarks/micro.json
+# python benchmark.py micro --groups adapter draw --vocab_size 32000 --repeat 50
+# python benchmark.py e2e --threads 1 --repeat 20
+if __name__ == "__main__":
+    args = arg_parser()
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+    args.output = os.path.abspath(args.output or f"output/benchmarks/{args.command}.json")
+
+    results = run_micro(args) if args.command == "micro" else run_e2e(args)
+
+    os.makedirs(os.path.dirname(args.output) or ".", exist_ok=True)
+    with open(args.output, "w") as f:
+        json.dump({"benchmark": args.command, "environment": environment(), "args": vars(args), "results": results}, f, indent=2)
+    print(f"Results saved to {args.output}")
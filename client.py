@@ -0,0 +1,52 @@
+import argparse
+import asyncio
+import base64
+import time
+
+import httpx
+
+
+def arg_parser():
+    parser = argparse.ArgumentParser(description="Client of the HTTP inference server")
+    parser.add_argument("image", type=str, help="Path to the image")
+    parser.add_argument("queries", type=str, nargs="+", help="Queries about the image, sent at the same time")
+    parser.add_argument("--url", type=str, default="http://localhost:8000", help="Address of the server")
+    parser.add_argument("--max_new_tokens", type=int, default=100, help="Maximum number of tokens to generate")
+    parser.add_argument("--constrained", action="store_true", help="Only generate mask selection answers")
+    parser.add_argument("--repeat", type=int, default=1, help="Number of times every query is sent")
+    return parser.parse_args()
+
+
+async def infer(client: httpx.AsyncClient, url: str, payload: dict) -> dict:
+    response = await client.post(f"{url}/infer", json=payload, timeout=None)
+    response.raise_for_status()
+    return response.json()
+
+
+async def main(args):
+    with open(args.image, "rb") as f:
+        image = base64.b64encode(f.read()).decode()
+
+    payloads = [
+        {"query": query, "image": image, "max_new_tokens": args.max_new_tokens, "constrained": args.constrained}
+        for query in args.queries * args.repeat
+    ]
+
+    async with httpx.AsyncClient() as client:
+        health = (await client.get(f"{args.url}/health")).json()
+        print(f"Server: {health}")
+
+        # all the requests are sent concurrently so that the server can batch them
+        start = time.perf_counter()
+        results = await asyncio.gather(*[infer(client, args.url, payload) for payload in payloads])
+        elapsed = time.perf_counter() - start
+
+    for payload, result in zip(payloads, results):
+        print(f"Query: {payload['query']}")
+        print(f"Answer: {result['gen_text']}")
+        print(f"Masks: {result['chosen_tokens']} (batch of {result['batch_size']}, {result['latency_ms']:.0f} ms)")
+    print(f"{len(payloads)} requests in {elapsed:.2f} s ({len(payloads) / elapsed:.2f} requests/s)")
+
+
+if __name__ == "__main__":
+    asyncio.run(main(arg_parser()))
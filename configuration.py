@@ -1,7 +1,9 @@
 import os
+import re
 from dataclasses import dataclass as og_dataclass
 from dataclasses import is_dataclass
 
+import torch
 import yaml
 
 
@@ -46,15 +48,53 @@ class DatasetConfig:
         self.mask_dir = os.path.expanduser(self.mask_dir)
 
 
+@dataclass
+class MaskFilterConfig:
+    # masks smaller than this many pixels (at the SAM input resolution) are dropped
+    min_area: int = 0
+    # masks with a lower SAM stability score are dropped (null to keep them all)
+    min_stability: float = None
+    # a mask overlapping a better one by more than this IoU is dropped (null to disable)
+    nms_iou_thresh: float = None
+    # a mask whose intersection with a better one covers more than this fraction of the smaller of the two is dropped
+    # (null to disable, parts of objects are contained in them)
+    nms_containment_thresh: float = None
+    # size to which the masks are subsampled to compute their overlaps
+    nms_resolution: int = 256
+
+
+@dataclass
+class TilingConfig:
+    # images whose longest side exceeds this many pixels are segmented in tiles of this size at their full resolution
+    # instead of being resized to the SAM input size (null to always resize)
+    tile_size: int = None
+    # pixels shared by neighbouring tiles, objects cut by a tile border are joined in this band
+    overlap: int = 128
+    # IoU inside the band above which the masks of two tiles are the same object
+    merge_iou_thresh: float = 0.5
+
+    def __post_init__(self):
+        if self.tile_size is not None and not 0 <= self.overlap < self.tile_size:
+            raise ValueError(f"The tile overlap must be smaller than the tile size, got {self.overlap} and {self.tile_size}")
+
+
 @dataclass
 class SAMConfig:
     model: str
     checkpoint_dir: str
     resize: int
     n_masks: int
+    # masks removed before the n_masks largest ones are kept and encoded, nothing is removed if not given
+    filter: MaskFilterConfig = None
+    # segmentation of large images in tiles, disabled if not given
+    tiling: TilingConfig = None
 
     def __post_init__(self):
         self.checkpoint_dir = os.path.expanduser(self.checkpoint_dir)
+        if self.filter is None:
+            self.filter = MaskFilterConfig()
+        if self.tiling is None:
+            self.tiling = TilingConfig()
 
 
 @dataclass
@@ -72,6 +112,93 @@ class OthersConfig:
     def __post_init__(self):
         self.wandb_token = os.path.expanduser(self.wandb_token)
 
+@dataclass
+class ProfilingConfig:
+    # record the peak memory of the preprocessing and inference stages (see llava_finetune.profiling.MemoryTracker)
+    memory: bool = False
+    # also record the python allocations with tracemalloc (slow)
+    tracemalloc: bool = False
+    # directory of the memory reports
+    report_dir: str = "output/memory"
+
+    def __post_init__(self):
+        self.report_dir = os.path.expanduser(self.report_dir)
+
+
+# weights precision names of the performance section
+PRECISIONS = {"auto": None, "fp32": torch.float32, "fp16": torch.float16, "bf16": torch.bfloat16}
+# encodings of the AlphaCLIP embeddings (see llava_finetune.embeddings)
+EMBEDDING_ENCODINGS = ("fp32", "fp16", "int8")
+
+
+@dataclass
+class PerformanceConfig:
+    # device of the models: "auto" (cuda if available), "cpu", "cuda" or "cuda:<index>"
+    device: str = "auto"
+    # dtype of the LLava and AlphaCLIP weights: "auto" (fp32 LLava, fp16 AlphaCLIP on cuda), "fp32", "fp16" or "bf16"
+    precision: str = "auto"
+    # batch size of the training data loader and of the validation and test ones (training batch size if null)
+    train_batch_size: int = 2
+    eval_batch_size: int = None
+    # processes loading the batches of the data loaders (0 to load them in the main process)
+    num_workers: int = 0
+    # processes computing the IoU metrics in validation.py (0 to compute them in the main process)
+    metric_workers: int = 4
+    # SAM masks kept per image in the datasets
+    top_samples: int = 30
+    # grid of points prompted by the SAM automatic mask generator and points run through SAM at a time
+    sam_points_per_side: int = 50
+    sam_points_per_batch: int = 64
+    # tiles of a large image encoded by SAM at a time (see TilingConfig)
+    sam_tile_batch_size: int = 4
+    # masks encoded by AlphaCLIP at a time
+    alphaclip_batch_size: int = 32
+    # encoding of the embeddings written by preprocess.py and held in memory by the datasets: "fp32", "fp16" or "int8"
+    embedding_encoding: str = "fp32"
+    # disk tier (null to keep the cache in memory only) and memory budget of the inference preprocessing cache
+    cache_dir: str = "cache/preprocess"
+    cache_max_mb: int = 512
+
+    def __post_init__(self):
+        errors = []
+        if not re.fullmatch(r"auto|cpu|cuda(:\d+)?", self.device):
+            errors.append(f"device must be auto, cpu, cuda or cuda:<index>, got '{self.device}'")
+        if self.precision not in PRECISIONS:
+            errors.append(f"precision must be one of {list(PRECISIONS)}, got '{self.precision}'")
+        if self.embedding_encoding not in EMBEDDING_ENCODINGS:
+            errors.append(f"embedding_encoding must be one of {list(EMBEDDING_ENCODINGS)}, got '{self.embedding_encoding}'")
+        for name in ("train_batch_size", "top_samples", "sam_points_per_side", "sam_points_per_batch", "sam_tile_batch_size", "alphaclip_batch_size", "cache_max_mb"):
+            if not isinstance(getattr(self, name), int) or getattr(self, name) < 1:
+                errors.append(f"{name} must be a positive integer, got {getattr(self, name)!r}")
+        if self.eval_batch_size is not None and (not isinstance(self.eval_batch_size, int) or self.eval_batch_size < 1):
+            errors.append(f"eval_batch_size must be a positive integer or null, got {self.eval_batch_size!r}")
+        for name in ("num_workers", "metric_workers"):
+            if not isinstance(getattr(self, name), int) or getattr(self, name) < 0:
+                errors.append(f"{name} must be a non-negative integer, got {getattr(self, name)!r}")
+        if errors:
+            raise ValueError("Invalid performance configuration:\n  " + "\n  ".join(errors))
+
+        if self.eval_batch_size is None:
+            self.eval_batch_size = self.train_batch_size
+        if self.cache_dir:
+            self.cache_dir = os.path.expanduser(self.cache_dir)
+        else:
+            self.cache_dir = None
+
+    def resolve_device(self) -> str:
+        """Device of the models, an explicit cuda device fails when no GPU is available"""
+        if self.device == "auto":
+            return "cuda" if torch.cuda.is_available() else "cpu"
+        if self.device.startswith("cuda") and not torch.cuda.is_available():
+            raise ValueError(f"The performance section asks for device '{self.device}' but cuda is not available")
+        return self.device
+
+    @property
+    def dtype(self) -> torch.dtype:
+        """dtype of the weights, None to keep the default of each model"""
+        return PRECISIONS[self.precision]
+
+
 @dataclass
 class ProjectConfig:
     llava: LLavaConfig
@@ -79,6 +206,15 @@ class ProjectConfig:
     sam: SAMConfig
     alphaclip: AlphaCLIPConfig
     others: OthersConfig
+    profiling: ProfilingConfig = None
+    performance: PerformanceConfig = None
+
+    def __post_init__(self):
+        # optional sections
+        if self.profiling is None:
+            self.profiling = ProfilingConfig()
+        if self.performance is None:
+            self.performance = PerformanceConfig()
 
 
 def load_yaml_config(path) -> ProjectConfig:
@@ -0,0 +1,112 @@
+import argparse
+import json
+import os
+
+import torch
+from torch.utils.data import DataLoader
+
+from configuration import load_yaml_config
+from llava_finetune.embeddings import EMBEDDING_ENCODINGS, decode_embeddings, embedding_bytes, encode_embeddings, quantize
+from llava_finetune.functions import load_model, val_step
+from llava_finetune.utils import CustomDataset, collate_fn
+
+
+def arg_parser():
+    parser = argparse.ArgumentParser(description="Storage, memory and validation F1 of the embedding encodings of a preprocessed dataset")
+    parser.add_argument("--dataset", type=str, default="data/val-v3.jsonl", help="Dataset jsonl written by preprocess.py (any encoding)")
+    parser.add_argument("--encodings", type=str, nargs="+", default=list(EMBEDDING_ENCODINGS), choices=EMBEDDING_ENCODINGS, help="Encodings to compare")
+    parser.add_argument("--output_dir", type=str, default=None, help="Also write the dataset in every encoding to this directory")
+    parser.add_argument("--model_name", type=str, default=None, help="Model in the models directory whose validation F1 is measured with every encoding (skipped if not given)")
+    parser.add_argument("--config", type=str, default="config.yaml", help="Path to the project configuration (with --model_name)")
+    parser.add_argument("--image_dir", type=str, default=None, help="Directory of the images and queries of the dataset (default: the val directory of the config)")
+    parser.add_argument("--seed", type=int, default=42, help="Seed of the query of every image, the same for every encoding")
+    parser.add_argument("--output", type=str, default="output/embedding_report.json", help="JSON report")
+    return parser.parse_args()
+
+
+def encoding_stats(samples: list[dict], encoding: str, output_path: str = None) -> dict:
+    """Size of the jsonl and of the embeddings in memory with an encoding, and the error of the dequantized embeddings"""
+    file_bytes = memory_bytes = 0
+    errors, cosines = [], []
+    output = open(output_path, "w") if output_path else None
+    try:
+        for sample in samples:
+            encoded = dict(sample)
+            for key in ("gt_embs", "sam_embs"):
+                embs = decode_embeddings(sample[key])
+                encoded[key] = encode_embeddings(embs, encoding)
+                if len(embs) == 0:
+                    continue
+                values, scale = quantize(embs, encoding)
+                memory_bytes += embedding_bytes(values, scale)
+                restored = decode_embeddings(encoded[key])
+                errors.append((restored - embs).abs().max().item())
+                cosines.append(torch.nn.functional.cosine_similarity(restored, embs, dim=-1))
+            line = json.dumps(encoded) + "\n"
+            file_bytes += len(line)
+            if output:
+                output.write(line)
+    finally:
+        if output:
+            output.close()
+
+    cosines = torch.cat(cosines) if cosines else torch.ones(1)
+    return {
+        "file_mb": file_bytes / 2**20,
+        "memory_mb": memory_bytes / 2**20,
+        "max_abs_error": max(errors, default=0.0),
+        "min_cosine": cosines.min().item(),
+        "mean_cosine": cosines.mean().item(),
+    }
+
+
+def validation_f1(model, dataset_path: str, image_dir: str, encoding: str, batch_size: int, seed: int) -> float:
+    """Mask F1 of the model on the dataset with its embeddings held in the given encoding"""
+    dataset = CustomDataset(dataset_path, image_dir, embedding_encoding=encoding)
+    loader = DataLoader(dataset, batch_size=batch_size, shuffle=False, collate_fn=collate_fn)
+    # the same query of every image for every encoding
+    torch.manual_seed(seed)
+    return val_step(model, loader, 0)[3]
+
+
+# python embedding_report.py --dataset data/val-v3.jsonl
+# python embedding_report.py --dataset data/val-v3.jsonl --model_name shorter_big --output_dir data/encoded
+if __name__ == "__main__":
+    args = arg_parser()
+    with open(args.dataset, "r") as f:
+        samples = [json.loads(line) for line in f]
+    if args.output_dir:
+        os.makedirs(args.output_dir, exist_ok=True)
+
+    report = {}
+    for encoding in args.encodings:
+        name = os.path.splitext(os.path.basename(args.dataset))[0]
+        output_path = os.path.join(args.output_dir, f"{name}_{encoding}.jsonl") if args.output_dir else None
+        report[encoding] = encoding_stats(samples, encoding, output_path)
+
+    if args.model_name:
+        config = load_yaml_config(args.config)
+        performance = config.performance
+        image_dir = args.image_dir or os.path.join(config.dataset.image_dir, "val")
+        model = load_model(
+            f"models/{args.model_name}.pth", f"models/{args.model_name}.json", performance.resolve_device(), performance.dtype
+        )
+        for encoding in args.encodings:
+            report[encoding]["val_f1"] = validation_f1(model, args.dataset, image_dir, encoding, performance.eval_batch_size, args.seed)
+
+    reference = report[args.encodings[0]]
+    print(f"{len(samples)} samples of {args.dataset}:")
+    for encoding, stats in report.items():
+        line = (
+            f"  {encoding:<5} file {stats['file_mb']:8.2f} MiB ({reference['file_mb'] / stats['file_mb']:5.2f}x) | "
+            f"memory {stats['memory_mb']:8.2f} MiB ({reference['memory_mb'] / max(stats['memory_mb'], 1e-9):5.2f}x) | "
+            f"cosine min {stats['min_cosine']:.5f} mean {stats['mean_cosine']:.6f}"
+        )
+        if "val_f1" in stats:
+            line += f" | val F1 {stats['val_f1']:.4f} ({stats['val_f1'] - reference['val_f1']:+.4f})"
+        print(line)
+
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    with open(args.output, "w") as f:
+        json.dump({"dataset": args.dataset, "samples": len(samples), "encodings": report}, f, indent=2)
+    print(f"Report saved to {args.output}")
@@ -0,0 +1,34 @@
+import argparse
+import json
+import os
+import time
+
+from llava_finetune.utils import export_overlays
+
+
+def arg_parser():
+    parser = argparse.ArgumentParser(description="Draw the masks of every image of a dataset")
+    parser.add_argument("--dataset", type=str, default="data/val-v3.jsonl", help="Dataset jsonl with the shapes of every image")
+    parser.add_argument("--image_dir", type=str, required=True, help="Directory containing the images of the dataset")
+    parser.add_argument("--output_dir", type=str, default="output/overlays", help="Directory where the images are saved")
+    parser.add_argument("--shapes", type=str, default="sam_shapes", choices=["sam_shapes", "gt_shapes"], help="Masks to draw")
+    parser.add_argument("--workers", type=int, default=None, help="Number of processes (default: number of CPUs)")
+    return parser.parse_args()
+
+
+# python export_overlays.py --image_dir ReasonSeg/val --shapes gt_shapes
+if __name__ == "__main__":
+    args = arg_parser()
+    os.makedirs(args.output_dir, exist_ok=True)
+
+    jobs = []
+    with open(args.dataset, "r") as f:
+        for line in f:
+            sample = json.loads(line)
+            output_path = os.path.join(args.output_dir, os.path.splitext(sample["img"])[0] + ".png")
+            jobs.append((os.path.join(args.image_dir, sample["img"]), sample[args.shapes], output_path))
+
+    start = time.perf_counter()
+    export_overlays(jobs, args.workers)
+    elapsed = time.perf_counter() - start
+    print(f"Saved {len(jobs)} images to {args.output_dir} in {elapsed:.1f} s")
@@ -1,24 +1,64 @@
 import json
 import logging
 import os
+import threading
+from contextlib import contextmanager
+from typing import TYPE_CHECKING
 
 import matplotlib.pyplot as plt
+import numpy as np
 import torch
 from PIL import Image
 
 from configuration import ProjectConfig, dataclass, load_yaml_config
+from llava_finetune.adapter_export import optimize_adapter
 from llava_finetune.functions import load_model
-from llava_finetune.model import LISA_Model
+from llava_finetune.model import LISA_Model, SegAdapter
+from llava_finetune.profiling import MemoryTracker
+from llava_finetune.registry import ModelRegistry
+from llava_finetune.token_index import INDEX_PATH, TokenIndex
 from llava_finetune.utils import draw_shapes
-from preprocess import PreprocessPipeline
+from preprocessing.cache import PreprocessCache, config_key, weights_key
+
+if TYPE_CHECKING:
+    # SAM and AlphaCLIP are only imported when an image has to be preprocessed
+    from preprocess import PreprocessPipeline
+
+
+# SAM and AlphaCLIP can be shared by the pipelines of several threads, they preprocess one image at a time
+PREPROCESS_LOCK = threading.Lock()
+
+# an image is given as a path, a PIL image or an RGB array
+ImageInput = str | Image.Image | np.ndarray
+
+
+def to_rgb_array(image: ImageInput) -> np.ndarray:
+    """RGB uint8 array of an image given as a path, a PIL image or an array"""
+    if isinstance(image, str):
+        image = Image.open(image)
+    if isinstance(image, Image.Image):
+        return np.asarray(image.convert("RGB"))
+    return np.ascontiguousarray(image[..., :3], dtype=np.uint8)
+
+
+def to_pil(image: ImageInput) -> Image.Image:
+    """RGBA PIL image of an image given as a path, a PIL image or an array"""
+    if isinstance(image, str):
+        image = Image.open(image)
+    elif isinstance(image, np.ndarray):
+        image = Image.fromarray(image)
+    return image.convert("RGBA")
 
 
 @dataclass
 class InferenceSample:
     query: str
-    image: str
+    image: ImageInput
     new_tokens: list[int] = None
     new_tokens_shapes: list[list[int]] = None
+    # stored SAM embeddings and shapes of the image (e.g. from the dataset jsonl), preprocessing is skipped if given
+    sam_embs: list[list[float]] = None
+    sam_shapes: list[list[int]] = None
 
 
 class InferencePipeline:
@@ -28,9 +68,27 @@ class InferencePipeline:
 
     logger = logging.getLogger(__name__)
 
-    def __init__(self, config: ProjectConfig, model_name="longer"):
+    def __init__(
+        self,
+        config: ProjectConfig,
+        model_name="longer",
+        registry: ModelRegistry = None,
+        preprocess: "PreprocessPipeline" = None,
+        cache: PreprocessCache = None,
+        fast_adapter: bool = False,
+    ):
+        """
+        Args:
+            config: project configuration
+            model_name: name of the model in the models directory
+            registry: registry holding a shared base model, if given the model is attached to it instead of being loaded
+            preprocess: already loaded PreprocessPipeline to share between pipelines, otherwise it is loaded the first time an image has to be preprocessed
+            cache: cache of the preprocessed images to share between pipelines, a new one (budget and directory of the performance section) if not given
+            fast_adapter: replace the SegAdapter with its fused inference version (same outputs, lower latency, see adapter_export.py)
+        """
         self.config = config
-        self.logger.info("Loading PreprocessPipeline")
+        self.model_name = model_name
+        self.registry = registry
 
         default_additional_preprocess_params = {
             "model": "alpha-clip",
@@ -48,15 +106,120 @@ class InferencePipeline:
         # add them to the config
         config.additional_preprocess_params = default_additional_preprocess_params
 
-        self.pp = PreprocessPipeline(config)
-        self.device = "cuda" if torch.cuda.is_available() else "cpu"
+        self._pp = preprocess
+        performance = config.performance
+        self.cache = cache if cache is not None else PreprocessCache(performance.cache_max_mb * 2**20, performance.cache_dir)
+        # the model adds the masks of every request to its vocabulary, requests on the same model cannot overlap
+        self.model_lock = threading.Lock()
+        self.token_indexes: dict[str, TokenIndex] = {}
+        self.preprocess_config = config_key(config, self.only_masks)
 
         self.logger.info("Loading model")
-        self.model: LISA_Model = load_model(
-            f"models/{model_name}.pth", f"models/{model_name}.json", self.device
-        ).eval()
+        if registry is None:
+            self.device = performance.resolve_device()
+            self.model: LISA_Model = load_model(
+                f"models/{model_name}.pth", f"models/{model_name}.json", self.device, performance.dtype
+            ).eval()
+        else:
+            registry.register(model_name)
+            self.device = registry.device
+            self.model: LISA_Model = registry.base
+        # the cached SegAdapter outputs are tied to the weights that were loaded
+        model_path = os.path.join("models" if registry is None else registry.models_dir, f"{model_name}.pth")
+        self.adapter_key = weights_key(model_name, model_path)
+
+        if fast_adapter:
+            if registry is None:
+                self.model.adapter = optimize_adapter(self.model.adapter)
+            else:
+                with registry.lock:
+                    if isinstance(registry.adapters[model_name], SegAdapter):
+                        registry.adapters[model_name] = optimize_adapter(registry.adapters[model_name])
+                        # switched again on the next use so that the base model gets the new adapter
+                        if registry.active == model_name:
+                            registry.active = None
 
         self.tokenizer = self.model.llava_model.processor.tokenizer
+        # peak memory of the preprocessing and generation stages, enabled by the profiling section of the config
+        self.memory = MemoryTracker(config.profiling.memory, device=self.device, tracemalloc=config.profiling.tracemalloc)
+
+    @property
+    def pp(self) -> "PreprocessPipeline":
+        """PreprocessPipeline (SAM and AlphaCLIP), loaded on first use so that samples with stored embeddings never need it"""
+        if self._pp is None:
+            from preprocess import PreprocessPipeline
+
+            self.logger.info("Loading PreprocessPipeline")
+            self._pp = PreprocessPipeline(self.config)
+            # its stages are part of the report of this pipeline
+            self._pp.memory = self.memory
+        return self._pp
+
+    def use_model(self):
+        """
+        Context manager giving access to the model of this pipeline.
+        When the model lives in a shared registry it is switched to this pipeline's adapters for the duration.
+        """
+        if self.registry is None:
+            return self._locked_model()
+        return self.registry.use(self.model_name)
+
+    @contextmanager
+    def _locked_model(self):
+        with self.model_lock:
+            yield self.model
+
+    def image_key(self, image: ImageInput) -> str:
+        """Cache key of an image: hash of its content (file bytes or pixels) and of the preprocessing configuration"""
+        if isinstance(image, str):
+            with open(image, "rb") as f:
+                return PreprocessCache.key(f.read(), self.preprocess_config)
+        pixels = to_rgb_array(image)
+        return PreprocessCache.key(str(pixels.shape).encode() + pixels.tobytes(), self.preprocess_config)
+
+    def preprocess(self, image: ImageInput) -> dict:
+        """
+        SAM masks and AlphaCLIP embeddings of an image, only computed the first time the same image is seen.
+
+        Args:
+            image: path of the image, PIL image or RGB array
+
+        Returns:
+            dictionary containing the "sam_shapes" and "sam_embs" of the image
+        """
+        key = self.image_key(image)
+        result = self.cache.get(key)
+        if result is None:
+            with PREPROCESS_LOCK:
+                result = self.pp.inference_preprocess(image if isinstance(image, str) else to_rgb_array(image), self.only_masks)
+            self.cache.put(key, result)
+        return result
+
+    def token_index(self, metric: str) -> TokenIndex:
+        """Approximate nearest-neighbour index of the vocabulary for the given metric, None if it was not built"""
+        if metric not in self.token_indexes:
+            path = INDEX_PATH.format(metric=metric)
+            self.token_indexes[metric] = TokenIndex.load(path, self.device) if os.path.exists(path) else None
+        return self.token_indexes[metric]
+
+    def sample_preprocess(self, sample: InferenceSample) -> dict:
+        """Stored SAM embeddings and shapes of the sample if it has them, otherwise the preprocessing of its image"""
+        if sample.sam_embs is None:
+            return self.preprocess(sample.image)
+        embs = sample.sam_embs.tolist() if torch.is_tensor(sample.sam_embs) else list(sample.sam_embs)
+        return {"sam_shapes": list(sample.sam_shapes), "sam_embs": embs}
+
+    def adapter_embeddings(self, model: LISA_Model, image: ImageInput, sam_embs: list, new_tokens: list = None) -> torch.Tensor:
+        """SegAdapter output of the masks of an image (cached per model) followed by the one of the additional masks"""
+        key = self.image_key(image)
+        embs = self.cache.get_adapter(key, self.adapter_key)
+        if embs is None:
+            embs = model.adapter(torch.tensor(sam_embs).to(self.device))
+            self.cache.put_adapter(key, self.adapter_key, embs)
+        embs = embs.to(self.device)
+        if new_tokens:
+            embs = torch.cat([embs, model.adapter(torch.tensor(new_tokens).to(self.device))])
+        return embs
 
     def token_similarity(
         self,
@@ -64,6 +227,7 @@ class InferencePipeline:
         softmax: bool = True,
         temperature: float = 1.0,
         cosine_similarity: bool = False,
+        top_k: int = None,
     ) -> list[dict]:
         """
         Calculate the token similarity for a given image of each one of the produced semantic masks embeddings.
@@ -73,14 +237,16 @@ class InferencePipeline:
             softmax: whether to use softmax or not
             temperature: temperature to use in softmax
             cosine_similarity: whether to use cosine similarity or not
+            top_k: if given and the token index of the metric was built, only the top_k tokens of every mask are searched
+                   in the index and returned as "top_tokens" and "top_scores" (the same scores as the similarities with the
+                   whole vocabulary) instead of the similarities with the whole vocabulary. Not used with softmax, which
+                   normalizes every token over the masks and needs the scores of the whole vocabulary
 
         Returns:
-            list of dictionaries containing the token similarities for each image and the masks shapes ("token_similarities", "embs_similarities", "masks")
+            list of dictionaries containing the token similarities for each image and the masks shapes ("token_similarities" or "top_tokens" and "top_scores", "embs_similarities", "masks")
         """
 
-        for d in data:
-            if isinstance(d, dict):
-                d = InferenceSample(**d)
+        data = [InferenceSample(**d) if isinstance(d, dict) else d for d in data]
 
         self.logger.info("Calculating token similarity")
 
@@ -88,24 +254,35 @@ class InferencePipeline:
             return []
 
         with torch.no_grad():
-            preprocessed = [self.pp.inference_preprocess(d.image, self.only_masks) for d in data]    
+            preprocessed = [self.preprocess(d.image) for d in data]
             for i, d in enumerate(data):
                 if d.new_tokens is not None:
-                    preprocessed[i]["sam_embs"] += d.new_tokens
                     preprocessed[i]["sam_shapes"] += d.new_tokens_shapes
 
-            embs = [
-                self.model.adapter(torch.tensor(res.get("sam_embs")).to(self.device))
-                for res in preprocessed
-            ]
-            token_mat = self.model.llava_model.original_emb_matrix.T.to(embs[0].dtype)
+            with self.use_model() as model:
+                embs = [
+                    self.adapter_embeddings(model, d.image, res.get("sam_embs"), d.new_tokens)
+                    for d, res in zip(data, preprocessed)
+                ]
+            emb_matrix = self.model.llava_model.original_emb_matrix
+            index = self.token_index("cosine" if cosine_similarity else "ip") if top_k and not softmax else None
+
+            if index is not None:
+                # approximate search of the top tokens, the candidates are rescored with the exact embeddings
+                top = [index.search(emb, top_k, rerank=10 * top_k, emb_matrix=emb_matrix) for emb in embs]
+                top_scores = [scores / temperature for scores, _ in top]
+                top_tokens = [ids for _, ids in top]
+            else:
+                token_mat = emb_matrix.T.to(embs[0].dtype)
 
             # normalize embeddings if cosine similarity
             if cosine_similarity:
                 embs = [emb / emb.norm(dim=1, keepdim=True) for emb in embs]
-                token_mat = token_mat / token_mat.norm(dim=0, keepdim=True)
+                if index is None:
+                    token_mat = token_mat / token_mat.norm(dim=0, keepdim=True)
 
-            token_similarities = [torch.matmul(emb, token_mat) / temperature for emb in embs]
+            if index is None:
+                token_similarities = [torch.matmul(emb, token_mat) / temperature for emb in embs]
             embs_similarities = [torch.matmul(emb, emb.T) / temperature for emb in embs]
 
             if softmax:
@@ -115,11 +292,13 @@ class InferencePipeline:
             masks = [res.get("sam_shapes") for res in preprocessed]
 
             for i in range(len(data)):
-                yield {
-                    "token_similarities": token_similarities[i],
-                    "embs_similarities": embs_similarities[i],
-                    "masks": masks[i],
-                }
+                result = {"embs_similarities": embs_similarities[i], "masks": masks[i]}
+                if index is None:
+                    result["token_similarities"] = token_similarities[i]
+                else:
+                    result["top_tokens"] = top_tokens[i]
+                    result["top_scores"] = top_scores[i]
+                yield result
 
     def inference(
         self,
@@ -129,6 +308,7 @@ class InferencePipeline:
         repeat_penalty: float = 2.0,
         temperature: float = 0.8,
         do_sample: bool = False,
+        constrained: bool = False,
     ) -> list[dict]:
         """
         Perform inference on a list of InferenceSamples
@@ -141,41 +321,49 @@ class InferencePipeline:
             repeat_penalty: repetition penalty to use in beam search
             temperature: temperature to use in beam search
             do_sample: whether to sample or not during generation
+            constrained: only generate mask selection answers (template text, distinct masks of the image, end token)
 
         Returns:
             list of dictionaries containing the generated text, masks and chosen tokens
         """
-        for d in data:
-            if isinstance(d, dict):
-                d = InferenceSample(**d)
+        data = [InferenceSample(**d) if isinstance(d, dict) else d for d in data]
 
         self.logger.info("Performing inference with n_beams: ", n_beams)
         with torch.no_grad():
             queries = [d.query for d in data]
-            img_paths = [d.image for d in data]
 
-            preprocessed = [self.pp.inference_preprocess(img, self.only_masks) for img in img_paths]
+            with self.memory.stage("preprocess"):
+                preprocessed = [self.sample_preprocess(d) for d in data]
 
             embs = [res.get("sam_embs") for res in preprocessed]
             masks = [res.get("sam_shapes") for res in preprocessed]
             for i, d in enumerate(data):
                 if d.new_tokens is not None:
-                    embs[i] += d.new_tokens
                     masks[i] += d.new_tokens_shapes
 
-            images = [Image.open(img_path).convert("RGBA") for img_path in img_paths]
-
-            gen_texts, gen_tokens = self.model.generate(
-                queries,
-                images,
-                [torch.tensor([]) for q in queries],
-                [torch.tensor(emb) for emb in embs],
-                max_new_tokens=max_new_tokens,
-                n_beams=n_beams,
-                repetition_penalty=float(repeat_penalty),
-                do_sample=do_sample,
-                temperature=temperature,
-            )
+            images = [to_pil(d.image) for d in data]
+
+            with self.use_model() as model, self.memory.stage("generate"):
+                # SegAdapter outputs of the masks of the images, cached per model (stored embeddings are not cached)
+                mask_tokens = [
+                    self.adapter_embeddings(model, d.image, embs[i], d.new_tokens)
+                    if d.sam_embs is None
+                    else model.adapter(torch.tensor(embs[i] + (d.new_tokens or [])).to(self.device))
+                    for i, d in enumerate(data)
+                ]
+                gen_texts, gen_tokens = model.generate(
+                    queries,
+                    images,
+                    [torch.tensor([]) for q in queries],
+                    [torch.tensor(emb) for emb in embs],
+                    max_new_tokens=max_new_tokens,
+                    n_beams=n_beams,
+                    repetition_penalty=float(repeat_penalty),
+                    do_sample=do_sample,
+                    temperature=temperature,
+                    constrained=constrained,
+                    mask_tokens=mask_tokens,
+                )
 
             chosen_tokens = [
                 list(
@@ -199,46 +387,94 @@ class InferencePipeline:
                     "chosen_tokens": chosen_tokens[i],
                 }
 
+    def multi_query_inference(
+        self,
+        image: ImageInput,
+        queries: list[str],
+        max_new_tokens: int = 100,
+        repeat_penalty: float = 2.0,
+        temperature: float = 0.8,
+        do_sample: bool = False,
+        constrained: bool = False,
+        new_tokens: list[list[float]] = None,
+        new_tokens_shapes: list[list[int]] = None,
+    ) -> list[dict]:
+        """
+        Answer several queries about the same image.
+
+        The image is preprocessed (SAM and AlphaCLIP) once and the model encodes the image prompt once,
+        every query only adds the cost of its own text and answer. Answers are decoded greedily (or sampled).
+
+        Args:
+            image: path of the image, PIL image or RGB array
+            queries: queries about the image
+            max_new_tokens: maximum number of tokens to generate
+            repeat_penalty: repetition penalty to use in the generation
+            temperature: temperature to use when sampling
+            do_sample: whether to sample or not during generation
+            constrained: only generate mask selection answers (template text, distinct masks of the image, end token)
+            new_tokens: additional mask embeddings to add to the ones of the image
+            new_tokens_shapes: shapes of the additional masks
+
+        Returns:
+            list of dictionaries containing the generated text, masks and chosen tokens of every query
+        """
+        self.logger.info(f"Performing inference with {len(queries)} queries on the same image")
+        with torch.no_grad():
+            with self.memory.stage("preprocess"):
+                preprocessed = self.preprocess(image)
+            embs = preprocessed.get("sam_embs")
+            masks = preprocessed.get("sam_shapes")
+            if new_tokens is not None:
+                masks = masks + new_tokens_shapes
+
+            with self.use_model() as model, self.memory.stage("generate"):
+                gen_texts, gen_tokens = model.generate_multi_query(
+                    queries,
+                    to_pil(image),
+                    torch.tensor([]),
+                    torch.tensor(embs),
+                    max_new_tokens=max_new_tokens,
+                    repetition_penalty=float(repeat_penalty),
+                    do_sample=do_sample,
+                    temperature=temperature,
+                    constrained=constrained,
+                    mask_tokens=self.adapter_embeddings(model, image, embs, new_tokens),
+                )
+
+            vocab_size = self.model.llava_model.tokenizer_vocab_size
+            for gen_text, tokens in zip(gen_texts, gen_tokens):
+                chosen_tokens = list(set((tokens[tokens > vocab_size] - vocab_size - 1).tolist()))
+                yield {
+                    "gen_text": gen_text,
+                    "masks": [x for j, x in enumerate(masks) if j in chosen_tokens],
+                    "chosen_tokens": chosen_tokens,
+                }
+
 
 if __name__ == "__main__":
     config = load_yaml_config("config.yaml")
 
     ip = InferencePipeline(config, "shorter_big")
 
-    data = [
-        InferenceSample(
-            query="Which vehicle should I sleep in?",
-            image="inference/2593366765_589ca5148e_o.jpg",
-        ),
-        InferenceSample(
-            query="Where is the van?",
-            image="inference/2593366765_589ca5148e_o.jpg",
-        ),
-        InferenceSample(
-            query="Where is the roulotte?",
-            image="inference/2593366765_589ca5148e_o.jpg",
-        ),
-        InferenceSample(
-            query="Is there a ladder in this image?",
-            image="inference/2593366765_589ca5148e_o.jpg",
-        ),
-        InferenceSample(
-            query="Are there hot singles in the image?",
-            image="inference/2593366765_589ca5148e_o.jpg",
-        ),
-        InferenceSample(
-            query="Is there a vehicle with two wheels in the image?",
-            image="inference/2593366765_589ca5148e_o.jpg",
-        ),
+    image = "inference/2593366765_589ca5148e_o.jpg"
+    queries = [
+        "Which vehicle should I sleep in?",
+        "Where is the van?",
+        "Where is the roulotte?",
+        "Is there a ladder in this image?",
+        "Are there hot singles in the image?",
+        "Is there a vehicle with two wheels in the image?",
     ]
 
-    res = ip.inference(data, n_beams=5)
+    # all the queries are about the same image: preprocess and encode it once (answers are decoded greedily)
+    res = ip.multi_query_inference(image, queries)
 
     for i, r in enumerate(res):
-        print("Query: ", data[i].query)
+        print("Query: ", queries[i])
         print("Answer: ", r["gen_text"])
 
-        comb = draw_shapes(Image.open(data[i].image), r["masks"])
+        comb = draw_shapes(Image.open(image), r["masks"])
 
         plt.figure(figsize=(12, 8))
         plt.imshow(comb)
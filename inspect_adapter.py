@@ -1,5 +1,7 @@
 import os
-import glob
+import threading
+
+import numpy as np
 import torch
 import gradio as gr
 from PIL import Image
@@ -9,6 +11,7 @@ import warnings
 
 from configuration import load_yaml_config
 from inference import InferencePipeline, InferenceSample
+from llava_finetune.registry import ModelRegistry
 from llava_finetune.utils import (
     draw_shapes,
 )  # Ensure this points to the updated function
@@ -22,16 +25,21 @@ plt.ioff()
 # Load configuration
 config = load_yaml_config("config.yaml")
 
+# All the models share one base LLaVA model, each one only adds its LoRA weights and adapter
+registry = ModelRegistry("models", config.performance.resolve_device(), config.performance.dtype)
+
 # Retrieve available models from the 'models/' directory
-model_paths = glob.glob("models/*.pth")
-model_names = [os.path.basename(p).replace(".pth", "") for p in model_paths]
+model_names = registry.available()
+
+# Number of tokens searched for every mask when the token index of the vocabulary was built (see token_index.py)
+TOP_TOKENS_K = 100
+
+# Requests processed at the same time, the results of every user are kept in their own session state
+CONCURRENCY_LIMIT = int(os.environ.get("WEBAPP_CONCURRENCY", 4))
 
 # Initialize a dictionary to cache loaded models
 pipelines: dict[str, InferencePipeline] = {}
-global_data = {
-    "model": None,
-    "token_similarities": None,
-}
+pipelines_lock = threading.Lock()
 
 
 def load_selected_model(model_name):
@@ -44,7 +52,15 @@ def load_selected_model(model_name):
     Returns:
         torch.nn.Module: Loaded model.
     """
-    model = InferencePipeline(config, model_name)
+    # SAM and AlphaCLIP are shared between the pipelines as well, with the cache of the preprocessed images
+    first = next(iter(pipelines.values()), None)
+    model = InferencePipeline(
+        config,
+        model_name,
+        registry=registry,
+        preprocess=first.pp if first else None,
+        cache=first.cache if first else None,
+    )
     return model
 
 
@@ -62,45 +78,45 @@ def process_image(
         cosine_similarity (bool): Flag to use cosine similarity.
 
     Returns:
-        Tuple: Processed image, status message and mask choices.
+        Tuple: Processed image, status message, mask choices, similarity matrix and the session state.
     """
-    if model_name not in pipelines:
-        try:
-            pipelines[model_name] = load_selected_model(model_name)
-        except Exception as e:
-            return None, f"Error loading model '{model_name}': {str(e)}", None, None
+    with pipelines_lock:
+        if model_name not in pipelines:
+            try:
+                pipelines[model_name] = load_selected_model(model_name)
+            except Exception as e:
+                return None, f"Error loading model '{model_name}': {str(e)}", None, None, None
 
     model = pipelines[model_name]
 
     if image is None:
-        return None, "Please upload an image.", None, None
-
-    # Save the uploaded image temporarily
-    tmp_path = "inference/temp_in.png"
-    image.save(tmp_path)
+        return None, "Please upload an image.", None, None, None
 
-    # Preprocess the image to obtain segmentation embeddings and shapes
+    # Preprocess the image (in memory) to obtain segmentation embeddings and shapes
     try:
         results = model.token_similarity(
-            [InferenceSample(query="", image=tmp_path)],
+            [InferenceSample(query="", image=image)],
             softmax=softmax,
             temperature=temperature,
             cosine_similarity=cosine_similarity,
+            top_k=TOP_TOKENS_K,
         )
         result = next(results)
     except Exception as e:
-        return None, f"Error during preprocessing: {str(e)}", None, None
+        return None, f"Error during preprocessing: {str(e)}", None, None, None
 
     masks = result["masks"]
-    token_similarities = result["token_similarities"]
     embs_similarities = result["embs_similarities"]
 
-    image = draw_shapes(Image.open(tmp_path), masks, enumerate_masks=True)
+    image = draw_shapes(image, masks, enumerate_masks=True)
 
-    # global_data["masks"] = masks
-    global_data["model"] = model_name
-    global_data["token_similarities"] = token_similarities
-    global_data["embs_similarities"] = embs_similarities
+    session = {
+        "model": model_name,
+        # either the similarities with the whole vocabulary or the top tokens found in the index
+        "token_similarities": result.get("token_similarities"),
+        "top_tokens": result.get("top_tokens"),
+        "top_scores": result.get("top_scores"),
+    }
 
     mask_choices = [f"Mask {i+1}" for i in range(len(masks))]
 
@@ -110,36 +126,48 @@ def process_image(
     fig.colorbar(cax)
     ax.set_title("Intra-Mask Similarity Matrix")
     plt.tight_layout()
-    plot_path = "output/intra_mask_similarity.png"
-    plt.savefig(plot_path)
-    plt.close(fig)
+    plot = figure_to_image(fig)
 
     return (
         image,
         "Image processed successfully.",
         gr.update(choices=mask_choices),
-        Image.open(plot_path),
+        plot,
+        session,
     )
 
 
-def get_top_tokens(selected_mask, num_tokens=10):
+def figure_to_image(fig):
+    """Render a matplotlib figure to a PIL image in memory and close it"""
+    fig.canvas.draw()
+    image = Image.fromarray(np.asarray(fig.canvas.buffer_rgba())).convert("RGB")
+    plt.close(fig)
+    return image
+
+
+def get_top_tokens(selected_mask, num_tokens=10, session=None):
     """
     Retrieve and display the top similar tokens for the selected mask, visualized as a bar chart.
     """
-    if global_data["token_similarities"] is None:
+    if session is None:
         return "Please process an image first."
 
     if selected_mask is None:
         return "Please select a mask first."
 
     mask_idx = int(selected_mask.split()[-1]) - 1
-    token_similarities = global_data["token_similarities"]
+    num_tokens = int(num_tokens)
 
     # Retrieve the top similar tokens based on the selected mask
-    top_values, top_indices = torch.topk(token_similarities[mask_idx], num_tokens)
+    if session["top_tokens"] is not None:
+        num_tokens = min(num_tokens, TOP_TOKENS_K)
+        top_values = session["top_scores"][mask_idx][:num_tokens]
+        top_indices = session["top_tokens"][mask_idx][:num_tokens]
+    else:
+        top_values, top_indices = torch.topk(session["token_similarities"][mask_idx], num_tokens)
     # Decode token indices
     tokens = [
-        pipelines[global_data["model"]].tokenizer.decode([int(i)]) for i in top_indices
+        pipelines[session["model"]].tokenizer.decode([int(i)]) for i in top_indices
     ]
 
     # Convert tensors to CPU and numpy for plotting if needed
@@ -163,12 +191,8 @@ def get_top_tokens(selected_mask, num_tokens=10):
 
     fig.tight_layout()
 
-    # Save the plot as an image
-    plot_path = "output/top_tokens.png"
-    plt.savefig(plot_path)
-    plt.close(fig)
-
-    return Image.open(plot_path)
+    # Render the plot in memory, concurrent users would overwrite each other's files
+    return figure_to_image(fig)
 
 
 if __name__ == "__main__":
@@ -177,6 +201,8 @@ if __name__ == "__main__":
         title="Segmentation Mask Embeddings Explorer with Model Selection"
     ) as demo:
         gr.Markdown("# 🖼️ Segmentation Mask Embeddings Explorer")
+        # results of the last processed image of this user
+        session_state = gr.State(None)
 
         with gr.Row():
             with gr.Column():
@@ -263,13 +289,15 @@ if __name__ == "__main__":
                 status_message,
                 mask_dropdown,
                 intra_mask_output,
+                session_state,
             ],
         )
 
         get_tokens_button.click(
             fn=get_top_tokens,
-            inputs=[mask_dropdown, num_tokens_input],
+            inputs=[mask_dropdown, num_tokens_input, session_state],
             outputs=[token_output],
         )
 
+    demo.queue(default_concurrency_limit=CONCURRENCY_LIMIT)
     demo.launch(server_name="0.0.0.0", server_port=7860)
@@ -0,0 +1,238 @@
+import copy
+import json
+import os
+import time
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+from llava_finetune.model import QueryBlock, SegAdapter
+from llava_finetune.registry import LISA_PARAMS, split_model_params
+
+EXPORT_FORMATS = ("torchscript", "onnx")
+
+
+class FusedQueryBlock(nn.Module):
+    """
+    Inference-only version of a QueryBlock.
+
+    The learned queries do not depend on the input, their projection by the attention layer is computed once
+    instead of once per segment, and the key and value projections are a single Linear.
+    """
+
+    def __init__(self, block: QueryBlock):
+        """
+        Args:
+            block (QueryBlock): trained block, its weights are copied
+        """
+        super().__init__()
+        attention = block.attention
+        self.embed_dim = attention.embed_dim
+        self.num_heads = attention.num_heads
+        self.head_dim = self.embed_dim // self.num_heads
+
+        w_q, w_k, w_v = attention.in_proj_weight.detach().chunk(3)
+        b_q, b_k, b_v = attention.in_proj_bias.detach().chunk(3)
+        query = F.linear(block.query.detach(), w_q, b_q)
+        # (1, num_heads, num_queries, head_dim)
+        self.register_buffer("query", query.view(1, -1, self.num_heads, self.head_dim).transpose(1, 2).contiguous())
+
+        self.key_value = nn.Linear(self.embed_dim, 2 * self.embed_dim)
+        with torch.no_grad():
+            self.key_value.weight.copy_(torch.cat([w_k, w_v]))
+            self.key_value.bias.copy_(torch.cat([b_k, b_v]))
+        self.out_proj = nn.Linear(self.embed_dim, self.embed_dim)
+        self.out_proj.load_state_dict(attention.out_proj.state_dict())
+
+        self.ffn = block.ffn
+        self.norm = block.norm
+
+    def forward(self, input: torch.Tensor) -> torch.Tensor:
+        """Same as QueryBlock.forward in eval mode"""
+        n = input.size(0)
+        # (2, num_segments, num_heads, length, head_dim)
+        key, value = self.key_value(input).view(n, -1, 2, self.num_heads, self.head_dim).permute(2, 0, 3, 1, 4).unbind(0)
+        x = F.scaled_dot_product_attention(self.query.expand(n, -1, -1, -1), key, value)
+        x = self.out_proj(x.transpose(1, 2).reshape(n, -1, self.embed_dim))
+        return self.norm(self.ffn(x))
+
+
+class FusedSegAdapter(nn.Module):
+    """
+    Inference-only version of a trained SegAdapter, giving the same outputs with fewer kernels.
+
+    The num_linears projections of the segment embeddings are fused into a single Linear (one matmul instead of
+    one per projection), the blocks are FusedQueryBlocks, the training noise and dropout are gone, and the
+    constants of the adapter are buffers.
+    The module has no data-dependent control flow, so it can be traced to TorchScript, exported to ONNX,
+    dynamically quantized to int8 or compiled.
+    """
+
+    def __init__(self, adapter: SegAdapter):
+        """
+        Args:
+            adapter (SegAdapter): trained adapter, its weights are copied
+        """
+        super().__init__()
+        adapter = copy.deepcopy(adapter).eval()
+
+        self.register_buffer("mean_train_masks", adapter.mean_train_masks.clone())
+        self.input_norm = adapter.input_norm
+        self.mlp_adapter = adapter.mlp_adapter
+
+        if self.mlp_adapter:
+            self.mlp = adapter.mlp
+        else:
+            self.num_linears = len(adapter.linears)
+            self.hidden_dim = adapter.linears[0].out_features
+            self.linears = nn.Linear(adapter.linears[0].in_features, self.num_linears * self.hidden_dim)
+            with torch.no_grad():
+                self.linears.weight.copy_(torch.cat([linear.weight for linear in adapter.linears]))
+                self.linears.bias.copy_(torch.cat([linear.bias for linear in adapter.linears]))
+            self.blocks = nn.ModuleList([FusedQueryBlock(block) for block in adapter.blocks])
+            self.skips = adapter.skips
+            self.final_skip = adapter.final_skip
+
+        self.norm = adapter.norm
+        self.register_buffer("mean_emb", adapter.mean_emb.detach().clone())
+        self.register_buffer("std_emb", adapter.std_emb.detach().clone())
+        self.requires_grad_(False)
+
+    def forward(self, segment_embeddings: torch.Tensor) -> torch.Tensor:
+        """Same as SegAdapter.forward in eval mode"""
+        segment_embeddings = self.input_norm(segment_embeddings - self.mean_train_masks)
+
+        if self.mlp_adapter:
+            llava_input = self.mlp(segment_embeddings)
+        else:
+            llava_input = self.final_skip(segment_embeddings)
+            x = self.linears(segment_embeddings).view(-1, self.num_linears, self.hidden_dim)
+            for skip, block in zip(self.skips, self.blocks):
+                llava_input = llava_input + skip(x.mean(dim=1))
+                x = block(x)
+            llava_input = llava_input + x.mean(dim=1)
+
+        return self.norm(llava_input) * self.std_emb + self.mean_emb
+
+
+def load_adapter(model_name: str, models_dir: str = "models", mean_path: str = "models/train_embs_mean.pt") -> SegAdapter:
+    """
+    SegAdapter of a model trained by run_experiment, without loading the LLava model.
+
+    Args:
+        model_name (str): name of the model in models_dir (<name>.pth and <name>.json)
+        models_dir (str, optional): directory of the models. Defaults to "models".
+        mean_path (str, optional): mean of the training segment embeddings. Defaults to "models/train_embs_mean.pt".
+
+    Returns:
+        SegAdapter: adapter in eval mode, on the cpu
+    """
+    with open(os.path.join(models_dir, f"{model_name}.json"), "r") as f:
+        lisa_kwargs, adapter_kwargs = split_model_params(json.load(f))
+    state_dict = torch.load(os.path.join(models_dir, f"{model_name}.pth"), map_location="cpu")
+    state_dict = {k.removeprefix("adapter."): v for k, v in state_dict.items() if k.startswith("adapter.")}
+
+    adapter = SegAdapter(
+        lisa_kwargs.get("seg_emb_size", LISA_PARAMS["seg_emb_size"]),
+        # the size of the LLava embeddings is the one of the output norm
+        state_dict["norm.weight"].size(0),
+        dropout=lisa_kwargs.get("dropout", LISA_PARAMS["dropout"]),
+        mean_path=mean_path,
+        **adapter_kwargs,
+    )
+    adapter.load_state_dict(state_dict)
+    return adapter.eval()
+
+
+def optimize_adapter(adapter: SegAdapter, compile: bool = False, int8: bool = False) -> nn.Module:
+    """
+    Fast inference module of a trained adapter.
+
+    Args:
+        adapter (SegAdapter): trained adapter
+        compile (bool, optional): compile the module with torch.compile (dynamic number of segments). Defaults to False.
+        int8 (bool, optional): quantize the Linear weights to int8 with dynamic quantization of the activations,
+                               only supported on the cpu. Defaults to False.
+
+    Returns:
+        nn.Module: module with the same inputs and outputs as the adapter
+    """
+    module = FusedSegAdapter(adapter).eval()
+    if int8:
+        if module.mean_train_masks.device.type != "cpu":
+            raise ValueError("int8 dynamic quantization is only supported on the cpu")
+        module = torch.ao.quantization.quantize_dynamic(module, {nn.Linear}, dtype=torch.qint8)
+    if compile:
+        module = torch.compile(module, dynamic=True)
+    return module
+
+
+def export_adapter(module: nn.Module, path: str, format: str, example: torch.Tensor):
+    """
+    Save an adapter as a standalone artifact, usable without this repository.
+
+    Args:
+        module (nn.Module): adapter to export (a FusedSegAdapter, possibly quantized)
+        path (str): output file
+        format (str): "torchscript" (traced, loaded with torch.jit.load) or "onnx"
+        example (torch.Tensor): example segment embeddings (num_segments, input_segment_dim), the number of segments
+                                stays dynamic
+    """
+    if format not in EXPORT_FORMATS:
+        raise ValueError(f"Unknown export format '{format}', expected one of {EXPORT_FORMATS}")
+
+    with torch.no_grad():
+        if format == "torchscript":
+            torch.jit.save(torch.jit.trace(module, example), path)
+        else:
+            torch.onnx.export(
+                module,
+                (example,),
+                path,
+                input_names=["segment_embeddings"],
+                output_names=["llava_input"],
+                dynamic_axes={"segment_embeddings": {0: "num_segments"}, "llava_input": {0: "num_segments"}},
+                dynamo=False,
+            )
+
+
+def load_exported(path: str):
+    """
+    Callable of an exported adapter, mapping segment embeddings to LLava embeddings.
+    The ONNX models are run with onnxruntime (which has to be installed).
+    """
+    if not path.endswith(".onnx"):
+        return torch.jit.load(path, map_location="cpu").eval()
+
+    import onnxruntime
+
+    session = onnxruntime.InferenceSession(path, providers=["CPUExecutionProvider"])
+
+    def run(segment_embeddings: torch.Tensor) -> torch.Tensor:
+        inputs = {"segment_embeddings": segment_embeddings.cpu().float().numpy()}
+        return torch.from_numpy(session.run(None, inputs)[0])
+
+    return run
+
+
+def max_difference(reference: nn.Module, candidate, inputs: torch.Tensor) -> float:
+    """Maximum absolute difference between the outputs of two adapters, relative to the scale of the reference"""
+    with torch.no_grad():
+        expected = reference(inputs).float().cpu()
+        actual = candidate(inputs).float().cpu()
+    return ((expected - actual).abs().max() / expected.abs().max()).item()
+
+
+def benchmark(adapter, inputs: torch.Tensor, iters: int = 50, warmup: int = 5) -> float:
+    """Median latency of an adapter on the given inputs, in milliseconds"""
+    times = []
+    with torch.no_grad():
+        for i in range(warmup + iters):
+            start = time.perf_counter()
+            adapter(inputs)
+            if inputs.is_cuda:
+                torch.cuda.synchronize()
+            if i >= warmup:
+                times.append((time.perf_counter() - start) * 1000)
+    return sorted(times)[len(times) // 2]
@@ -0,0 +1,120 @@
+import torch
+from transformers import LogitsProcessor
+
+
+class SegVocabLogitsProcessor(LogitsProcessor):
+    """
+    Restrict every sample of a batch to its own SEG mask tokens during batched generation.
+
+    In batched generation the mask tokens of all the samples are added to the vocabulary one after the other
+    (sample 0 masks, then sample 1 masks, ...) starting from seg_start, every sample can only generate the ones
+    coming from its own masks, the others are set to -inf.
+    """
+
+    def __init__(self, seg_start: int, counts: list[int]):
+        """
+        Args:
+            seg_start (int): id of the first added mask token
+            counts (list[int]): number of mask tokens of every sample, in the order they were added
+        """
+        self.seg_start = seg_start
+        self.counts = counts
+        self.banned = None
+
+    def _build_banned(self, vocab_size: int, device: torch.device) -> torch.Tensor:
+        banned = torch.zeros(len(self.counts), vocab_size, dtype=torch.bool)
+        banned[:, self.seg_start : self.seg_start + sum(self.counts)] = True
+        offset = self.seg_start
+        for i, count in enumerate(self.counts):
+            banned[i, offset : offset + count] = False
+            offset += count
+        return banned.to(device)
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor) -> torch.FloatTensor:
+        if self.banned is None or self.banned.size(1) != scores.size(1):
+            self.banned = self._build_banned(scores.size(1), scores.device)
+        # with beam search every sample has num_beams consecutive rows
+        banned = self.banned.repeat_interleave(scores.size(0) // len(self.counts), dim=0)
+        return scores.masked_fill(banned, -float("inf"))
+
+
+def to_sample_ids(ids: torch.Tensor, seg_start: int, offset: int, count: int, total: int) -> torch.Tensor:
+    """
+    Convert token ids generated with the mask tokens of the whole batch to the ids the sample would have if it was
+    generated alone (its mask tokens starting at seg_start, the following tokens shifted by its own count only).
+
+    Args:
+        ids (torch.Tensor): token ids generated for the sample
+        seg_start (int): id of the first added mask token
+        offset (int): number of mask tokens added before the ones of the sample
+        count (int): number of mask tokens of the sample
+        total (int): number of mask tokens of the whole batch
+
+    Returns:
+        torch.Tensor: token ids in the vocabulary of the sample
+    """
+    ids = ids.clone()
+    seg = (ids >= seg_start) & (ids < seg_start + total)
+    tail = ids >= seg_start + total
+    ids[seg] -= offset
+    ids[tail] -= total - count
+    return ids
+
+
+class MaskSelectionLogitsProcessor(LogitsProcessor):
+    """
+    Constrain the answers to the mask selection grammar: the template text, then mask tokens of the sample
+    (each one at most once) and finally the end token.
+
+    The state of every sequence is recomputed from the tokens generated after the prompt, so the processor works
+    with greedy search, sampling and beam search (where beams are reordered at every step).
+    """
+
+    def __init__(
+        self,
+        prompt_len: int,
+        template_ids: list[int],
+        seg_ranges: list[tuple[int, int]],
+        end_token_id: int,
+        min_masks: int = 1,
+    ):
+        """
+        Args:
+            prompt_len (int): length of the (padded) prompt, the answer starts after it
+            template_ids (list[int]): token ids of the text generated before the masks
+            seg_ranges (list[tuple[int, int]]): id of the first mask token and number of mask tokens of every sample
+            end_token_id (int): token ending the answer
+            min_masks (int, optional): number of masks to select before the answer can end. Defaults to 1.
+        """
+        self.prompt_len = prompt_len
+        self.template_ids = list(template_ids)
+        self.seg_ranges = seg_ranges
+        self.end_token_id = end_token_id
+        self.min_masks = min_masks
+
+    def max_new_tokens(self) -> int:
+        """Longest answer allowed by the grammar (template, every mask once and the end token)"""
+        return len(self.template_ids) + max(count for _, count in self.seg_ranges) + 1
+
+    def allowed_tokens(self, generated: list[int], seg_start: int, count: int) -> list[int]:
+        """Tokens that can follow the generated ones"""
+        n_template = len(self.template_ids)
+        if len(generated) < n_template:
+            return [self.template_ids[len(generated)]]
+        if self.end_token_id in generated[n_template:]:
+            return [self.end_token_id]
+
+        selected = set(generated[n_template:])
+        allowed = [t for t in range(seg_start, seg_start + count) if t not in selected]
+        if len(selected) >= min(self.min_masks, count) or not allowed:
+            allowed.append(self.end_token_id)
+        return allowed
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor) -> torch.FloatTensor:
+        rows_per_sample = scores.size(0) // len(self.seg_ranges)
+        mask = torch.full_like(scores, -float("inf"))
+        generated = input_ids[:, self.prompt_len :].tolist()
+        for row, tokens in enumerate(generated):
+            allowed = self.allowed_tokens(tokens, *self.seg_ranges[row // rows_per_sample])
+            mask[row, allowed] = 0
+        return scores + mask
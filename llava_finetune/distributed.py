@@ -0,0 +1,168 @@
+import os
+
+import torch
+import torch.distributed as dist
+
+
+def init_distributed(backend: str = None):
+    """
+    Initialize torch.distributed from the environment variables set by torchrun.
+    Uses nccl when a GPU is available and gloo otherwise, when the script was not launched by torchrun
+    (or with a single process) nothing is initialized.
+
+    Args:
+        backend (str, optional): Force a backend instead of choosing it from the available hardware. Defaults to None.
+
+    Returns:
+        tuple[int, int, str]: rank of the process, number of processes and device to train on
+    """
+    world_size = int(os.environ.get("WORLD_SIZE", 1))
+    use_cuda = torch.cuda.is_available() and backend != "gloo"
+    if world_size == 1:
+        return 0, 1, "cuda" if use_cuda else "cpu"
+
+    local_rank = int(os.environ.get("LOCAL_RANK", 0))
+    if use_cuda:
+        torch.cuda.set_device(local_rank)
+        device = f"cuda:{local_rank}"
+    else:
+        device = "cpu"
+    dist.init_process_group(backend or ("nccl" if use_cuda else "gloo"))
+
+    return dist.get_rank(), dist.get_world_size(), device
+
+
+def cleanup():
+    """Destroy the process group if one was initialized"""
+    if dist.is_available() and dist.is_initialized():
+        dist.destroy_process_group()
+
+
+def is_distributed() -> bool:
+    return dist.is_available() and dist.is_initialized() and dist.get_world_size() > 1
+
+
+def get_rank() -> int:
+    return dist.get_rank() if is_distributed() else 0
+
+
+def get_world_size() -> int:
+    return dist.get_world_size() if is_distributed() else 1
+
+
+def is_main_process() -> bool:
+    """Only the main process writes logs and checkpoints"""
+    return get_rank() == 0
+
+
+def barrier():
+    if is_distributed():
+        dist.barrier()
+
+
+def _collective_device():
+    # nccl only works on cuda tensors
+    return torch.device("cuda", torch.cuda.current_device()) if dist.get_backend() == "nccl" else torch.device("cpu")
+
+
+def average_gradients(params):
+    """
+    Average the gradients of the given parameters across all the processes.
+    Gradients are all-reduced in one flat buffer per dtype and device instead of one call per parameter.
+
+    Args:
+        params (Iterable[torch.nn.Parameter]): trainable parameters (the adapter and LoRA parameters of the optimizer)
+    """
+    if not is_distributed():
+        return
+
+    buckets = {}
+    for p in params:
+        if p.requires_grad:
+            buckets.setdefault((p.dtype, p.device), []).append(p)
+
+    world_size = get_world_size()
+    for bucket in buckets.values():
+        # every process has to send the same buffer, missing gradients count as zeros
+        flat = torch.cat([
+            (p.grad if p.grad is not None else torch.zeros_like(p)).reshape(-1) for p in bucket
+        ])
+        dist.all_reduce(flat)
+        flat /= world_size
+
+        offset = 0
+        for p in bucket:
+            grad = flat[offset : offset + p.numel()].view_as(p)
+            if p.grad is None:
+                p.grad = grad.clone()
+            else:
+                p.grad.copy_(grad)
+            offset += p.numel()
+
+
+def any_across_ranks(flag: bool) -> bool:
+    """Whether the flag is set in at least one process"""
+    if not is_distributed():
+        return bool(flag)
+    tensor = torch.tensor([float(flag)], device=_collective_device())
+    dist.all_reduce(tensor, op=dist.ReduceOp.MAX)
+    return bool(tensor.item())
+
+
+def broadcast_flag(flag: bool) -> bool:
+    """Take the value of the flag in the main process"""
+    if not is_distributed():
+        return bool(flag)
+    tensor = torch.tensor([float(flag)], device=_collective_device())
+    dist.broadcast(tensor, src=0)
+    return bool(tensor.item())
+
+
+def all_reduce_sums(values: list[float]) -> list[float]:
+    """Sum a list of numbers across all the processes"""
+    if not is_distributed():
+        return list(values)
+    tensor = torch.tensor(values, dtype=torch.float64, device=_collective_device())
+    dist.all_reduce(tensor)
+    return tensor.tolist()
+
+
+def gather_objects(obj) -> list:
+    """Gather a picklable object from every process, returns the list ordered by rank"""
+    if not is_distributed():
+        return [obj]
+    objects = [None] * get_world_size()
+    dist.all_gather_object(objects, obj)
+    return objects
+
+
+def _smoke_test(rank, world_size, port):
+    # each process gets different gradients, after averaging they all must hold the mean
+    os.environ.update(
+        {"RANK": str(rank), "LOCAL_RANK": str(rank), "WORLD_SIZE": str(world_size),
+         "MASTER_ADDR": "127.0.0.1", "MASTER_PORT": str(port)}
+    )
+    init_distributed(backend="gloo")
+
+    layer = torch.nn.Linear(4, 2)
+    frozen = torch.nn.Parameter(torch.ones(3), requires_grad=False)
+    for p in layer.parameters():
+        p.grad = torch.full_like(p, float(rank))
+    average_gradients(list(layer.parameters()) + [frozen])
+
+    expected = sum(range(world_size)) / world_size
+    assert all(torch.allclose(p.grad, torch.full_like(p, expected)) for p in layer.parameters())
+    assert frozen.grad is None
+    assert any_across_ranks(rank == world_size - 1)
+    assert all_reduce_sums([1.0, rank]) == [world_size, sum(range(world_size))]
+    print(f"Rank {rank}/{world_size}: OK")
+
+    cleanup()
+
+
+if __name__ == "__main__":
+    # python -m llava_finetune.distributed: check the collectives with several CPU processes
+    import torch.multiprocessing as mp
+
+    processes = 2
+    mp.spawn(_smoke_test, args=(processes, 29517), nprocs=processes)
@@ -0,0 +1,113 @@
+import base64
+
+import numpy as np
+import torch
+
+# encodings of the AlphaCLIP embeddings in the preprocessed jsonl files and in the memory of the datasets
+EMBEDDING_ENCODINGS = ("fp32", "fp16", "int8")
+
+STORAGE_DTYPES = {"fp32": torch.float32, "fp16": torch.float16, "int8": torch.int8}
+
+
+def quantize(embs: torch.Tensor, encoding: str) -> tuple[torch.Tensor, torch.Tensor]:
+    """
+    Embeddings in a compact dtype.
+
+    int8 is symmetric with one scale per vector: the embeddings are L2-normalized, their largest coordinate sets the
+    scale and the others keep about 2 significant digits.
+
+    Args:
+        embs (torch.Tensor): embeddings (num_embeddings, dim)
+        encoding (str): "fp32", "fp16" or "int8"
+
+    Returns:
+        tuple[torch.Tensor, torch.Tensor]: values in the dtype of the encoding and the scale of every vector
+                                           (num_embeddings, 1), None unless the encoding is int8
+    """
+    if encoding not in EMBEDDING_ENCODINGS:
+        raise ValueError(f"Unknown embedding encoding '{encoding}', expected one of {EMBEDDING_ENCODINGS}")
+    embs = embs.detach().float().cpu()
+    if encoding != "int8":
+        return embs.to(STORAGE_DTYPES[encoding]), None
+
+    scale = (embs.abs().amax(dim=-1, keepdim=True) / 127).clamp_min(torch.finfo(torch.float32).tiny)
+    return torch.round(embs / scale).clamp(-127, 127).to(torch.int8), scale
+
+
+def dequantize(values: torch.Tensor, scale: torch.Tensor = None) -> torch.Tensor:
+    """float32 embeddings of quantized values (see quantize)"""
+    if scale is None:
+        return values.float()
+    return values.float() * scale
+
+
+def encode_embeddings(embs, encoding: str = "fp32"):
+    """
+    JSON value of embeddings.
+
+    fp32 gives the list of vectors of the original format, fp16 and int8 give a dict with the base64 bytes of the
+    values (and of the fp32 scales for int8).
+
+    Args:
+        embs (torch.Tensor | list[torch.Tensor]): embeddings (num_embeddings, dim) or list of vectors
+        encoding (str, optional): "fp32", "fp16" or "int8". Defaults to "fp32".
+
+    Returns:
+        list | dict: JSON serializable embeddings, decoded by decode_embeddings
+    """
+    if not torch.is_tensor(embs):
+        if len(embs) == 0:
+            return []
+        embs = torch.stack([torch.as_tensor(emb) for emb in embs])
+    if len(embs) == 0:
+        return []
+
+    values, scale = quantize(embs, encoding)
+    if encoding == "fp32":
+        return values.tolist()
+
+    encoded = {"encoding": encoding, "shape": list(values.shape), "data": _to_base64(values)}
+    if scale is not None:
+        encoded["scale"] = _to_base64(scale)
+    return encoded
+
+
+def decode_embeddings(value) -> torch.Tensor:
+    """
+    float32 embeddings (num_embeddings, dim) of a JSON value written by encode_embeddings.
+
+    Args:
+        value (list | dict): list of vectors or encoded dict
+
+    Returns:
+        torch.Tensor: embeddings, (0, 0) when there are none
+    """
+    if isinstance(value, dict):
+        values = _from_base64(value["data"], STORAGE_DTYPES[value["encoding"]], value["shape"])
+        scale = _from_base64(value["scale"], torch.float32, (value["shape"][0], 1)) if "scale" in value else None
+        return dequantize(values, scale)
+    if len(value) == 0:
+        return torch.empty(0, 0)
+    return torch.tensor(value, dtype=torch.float32).view(len(value), -1)
+
+
+def num_embeddings(value) -> int:
+    """Number of embeddings of a JSON value written by encode_embeddings, without decoding it"""
+    return value["shape"][0] if isinstance(value, dict) else len(value)
+
+
+def embedding_bytes(values: torch.Tensor, scale: torch.Tensor = None) -> int:
+    """Memory used by quantized embeddings"""
+    size = values.numel() * values.element_size()
+    if scale is not None:
+        size += scale.numel() * scale.element_size()
+    return size
+
+
+def _to_base64(tensor: torch.Tensor) -> str:
+    return base64.b64encode(tensor.contiguous().numpy().tobytes()).decode("ascii")
+
+
+def _from_base64(data: str, dtype: torch.dtype, shape) -> torch.Tensor:
+    array = np.frombuffer(base64.b64decode(data), dtype=torch.empty(0, dtype=dtype).numpy().dtype)
+    return torch.from_numpy(array.copy()).view(*shape)
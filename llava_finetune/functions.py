@@ -1,17 +1,27 @@
 from copy import deepcopy
 import json
+import random
+import time
+import numpy as np
 import torch
-from llava_finetune.utils import initialize_wandb
+from llava_finetune.distributed import all_reduce_sums, barrier, broadcast_flag, gather_objects, get_rank, get_world_size, is_main_process
+from llava_finetune.utils import HardNegativeSampler, initialize_wandb
 from llava_finetune.model import LISA_Model
+from llava_finetune.profiling import MemoryTracker, StageTimer
 from tqdm.auto import tqdm
 import os
 import wandb
 from bitsandbytes.optim import AdamW8bit
 
+# Report of the peak memory of the stages of an experiment (memory_profile in the experiment config)
+MEMORY_REPORT_PATH = "output/memory/{exp_name}.json"
+
 # ==========================
 # 1. Train step
 # ==========================
-def train_step(model, data_loader, optimizer, epoch, EPOCHS, log_interval):
+def train_step(
+    model, data_loader, optimizer, epoch, EPOCHS, log_interval, start_batch=0, losses=None, on_step=None, negative_sampler=None
+):
     """
     Train the model for one epoch.
 
@@ -21,15 +31,31 @@ def train_step(model, data_loader, optimizer, epoch, EPOCHS, log_interval):
         optimizer (torch.optim.Optimizer): The optimizer to use.
         epoch (int): The current epoch number.
         EPOCHS (int): The total number of epochs.
-        log_interval (int): How often to log to wandb.
+        log_interval (int): How often to log to wandb (and the stage timings and memory when they are enabled).
+        start_batch (int, optional): Index of the first batch when resuming an epoch. Defaults to 0.
+        losses (list, optional): Losses of the batches already done in this epoch when resuming. Defaults to None.
+        on_step (callable, optional): Called after every step with the index of the next batch, the step time and the losses. Defaults to None.
+        negative_sampler (HardNegativeSampler, optional): Selects the negative masks of every step, all the masks of the samples if None. Defaults to None.
 
     Returns:
         float: The average loss for the epoch.
     """
     model.train()
-    losses = []
-    pbar = tqdm(data_loader, desc=f"Epoch {epoch+1}/{EPOCHS}", leave=False)
-    for batch_i, batch in enumerate(pbar):
+    losses = losses if losses is not None else []
+    # do not count the time spent outside of the epoch (validation, checkpoints) in the throughput
+    model.timer.reset()
+    pbar = tqdm(
+        data_loader,
+        desc=f"Epoch {epoch+1}/{EPOCHS}",
+        leave=False,
+        initial=start_batch,
+        total=start_batch + len(data_loader),
+        disable=not is_main_process(),
+    )
+    for batch_i, batch in enumerate(pbar, start=start_batch):
+        step_start = time.perf_counter()
+        if negative_sampler is not None:
+            batch = negative_sampler(batch)
         _, loss = model.optim_step(
             batch["queries"],
             batch["image"],
@@ -38,9 +64,19 @@ def train_step(model, data_loader, optimizer, epoch, EPOCHS, log_interval):
             batch["sam_embs"],
             optimizer,
         )
-        losses.append(loss.item())
-        if batch_i % log_interval == 0:
-            wandb.log({"train/loss": loss.item(), "epoch": epoch + 1})
+        if loss is not None:
+            losses.append(loss.item())
+            if batch_i % log_interval == 0:
+                wandb.log({"train/loss": loss.item(), "epoch": epoch + 1})
+        if model.timer.enabled and (batch_i + 1) % log_interval == 0:
+            timings = model.timer.summary()
+            wandb.log({**timings, "epoch": epoch + 1})
+            if is_main_process():
+                tqdm.write(f"Stage timings at batch {batch_i + 1}:\n{StageTimer.format(timings)}")
+        if model.memory.enabled and (batch_i + 1) % log_interval == 0:
+            wandb.log({**model.memory.summary(), "epoch": epoch + 1})
+        if on_step is not None:
+            on_step(batch_i + 1, time.perf_counter() - step_start, losses)
 
     avg_loss = sum(losses) / len(losses) if losses else 0
     return avg_loss
@@ -51,9 +87,54 @@ def train_step(model, data_loader, optimizer, epoch, EPOCHS, log_interval):
 # ==========================
 
 
+def mask_metrics(tp, fp, fn, tn):
+    """
+    Metrics of the masks selected for one sample, and of a random guess selecting half of the masks.
+
+    Args:
+        tp (int): positive masks selected
+        fp (int): negative masks selected
+        fn (int): positive masks not selected
+        tn (int): negative masks not selected
+
+    Returns:
+        tuple: accuracy, precision, recall, F1 and the same metrics for the random guess
+    """
+    accuracy = (tp + tn) / (tp + tn + fp + fn) if (tp + tn + fp + fn) > 0 else 0
+    precision = tp / (tp + fp) if (tp + fp) > 0 else 0
+    recall = tp / (tp + fn) if (tp + fn) > 0 else 0
+    f1 = 2 * tp / (2 * tp + fp + fn) if (2 * tp + fp + fn) > 0 else 0
+
+    # Random guess metrics
+    rand_tp = (tp + fn) / 2
+    rand_fp = (fp + tn) / 2
+    rand_fn = (tp + fn) / 2
+    rand_tn = (fp + tn) / 2
+
+    rand_accuracy = (
+        (rand_tp + rand_tn) / (rand_tp + rand_tn + rand_fp + rand_fn)
+        if (rand_tp + rand_tn + rand_fp + rand_fn) > 0
+        else 0
+    )
+    rand_precision = rand_tp / (rand_tp + rand_fp) if (rand_tp + rand_fp) > 0 else 0
+    rand_recall = rand_tp / (rand_tp + rand_fn) if (rand_tp + rand_fn) > 0 else 0
+    rand_f1 = (
+        2 * rand_tp / (2 * rand_tp + rand_fp + rand_fn)
+        if (2 * rand_tp + rand_fp + rand_fn) > 0
+        else 0
+    )
+    return accuracy, precision, recall, f1, rand_accuracy, rand_precision, rand_recall, rand_f1
+
+
+def average_metrics(sample_metrics):
+    """Average the metrics of all the samples (over the samples of all the processes when distributed)"""
+    *sums, count = all_reduce_sums([sum(m[k] for m in sample_metrics) for k in range(8)] + [len(sample_metrics)])
+    return tuple(s / count if count else 0 for s in sums)
+
+
 def val_step(model, data_val_loader, epoch):
     """
-    Run the validation step for the model.
+    Run the validation step for the model, generating the answers and checking the generated masks.
 
     Args:
         model (LISA_Model): The model to validate.
@@ -64,18 +145,11 @@ def val_step(model, data_val_loader, epoch):
         tuple: A tuple containing the average accuracy, precision, recall, F1, and random guess metrics.
     """
     model.eval()
-    accuracy = []
-    rand_accuracy = []
-    precision = []
-    rand_precision = []
-    recall = []
-    rand_recall = []
-    f1 = []
-    rand_f1 = []
+    sample_metrics = []
 
     with torch.no_grad():
         for batch in tqdm(
-            data_val_loader, desc=f"Validation Epoch {epoch+1}", leave=False
+            data_val_loader, desc=f"Validation Epoch {epoch+1}", leave=False, disable=not is_main_process()
         ):
             texts, tokens = model.generate(
                 [q+" Output the segmentation mask for the object in the image" for q in batch["queries"]],
@@ -103,99 +177,252 @@ def val_step(model, data_val_loader, epoch):
                 fp = len(generated_masks.intersection(negative_masks))
                 fn = len(positive_masks.difference(generated_masks))
                 tn = len(negative_masks.difference(generated_masks))
+                sample_metrics.append(mask_metrics(tp, fp, fn, tn))
 
-                accuracy.append(
-                    (tp + tn) / (tp + tn + fp + fn) if (tp + tn + fp + fn) > 0 else 0
-                )
-                precision.append(tp / (tp + fp) if (tp + fp) > 0 else 0)
-                recall.append(tp / (tp + fn) if (tp + fn) > 0 else 0)
-                f1.append(2 * tp / (2 * tp + fp + fn) if (2 * tp + fp + fn) > 0 else 0)
-
-                # Random guess metrics
-                rand_tp = len(positive_masks) / 2
-                rand_fp = len(negative_masks) / 2
-                rand_fn = len(positive_masks) / 2
-                rand_tn = len(negative_masks) / 2
-
-                rand_accuracy.append(
-                    (rand_tp + rand_tn) / (rand_tp + rand_tn + rand_fp + rand_fn)
-                    if (rand_tp + rand_tn + rand_fp + rand_fn) > 0
-                    else 0
-                )
-                rand_precision.append(
-                    rand_tp / (rand_tp + rand_fp) if (rand_tp + rand_fp) > 0 else 0
-                )
-                rand_recall.append(
-                    rand_tp / (rand_tp + rand_fn) if (rand_tp + rand_fn) > 0 else 0
-                )
-                rand_f1.append(
-                    2 * rand_tp / (2 * rand_tp + rand_fp + rand_fn)
-                    if (2 * rand_tp + rand_fp + rand_fn) > 0
-                    else 0
-                )
+    return average_metrics(sample_metrics)
 
-    # Calculate averages
-    accuracy_avg = sum(accuracy) / len(accuracy) if accuracy else 0
-    precision_avg = sum(precision) / len(precision) if precision else 0
-    recall_avg = sum(recall) / len(recall) if recall else 0
-    f1_avg = sum(f1) / len(f1) if f1 else 0
-    rand_accuracy_avg = sum(rand_accuracy) / len(rand_accuracy) if rand_accuracy else 0
-    rand_precision_avg = (
-        sum(rand_precision) / len(rand_precision) if rand_precision else 0
-    )
-    rand_recall_avg = sum(rand_recall) / len(rand_recall) if rand_recall else 0
-    rand_f1_avg = sum(rand_f1) / len(rand_f1) if rand_f1 else 0
-
-    return (
-        accuracy_avg,
-        precision_avg,
-        recall_avg,
-        f1_avg,
-        rand_accuracy_avg,
-        rand_precision_avg,
-        rand_recall_avg,
-        rand_f1_avg,
-    )
+
+def teacher_forced_val_step(model, data_val_loader, epoch):
+    """
+    Fast validation step: a single teacher-forced forward pass per batch scores the mask tokens
+    instead of generating the answers (see LISA_Model.score_masks).
+
+    Args:
+        model (LISA_Model): The model to validate.
+        data_val_loader (DataLoader): The DataLoader for the validation data.
+        epoch (int): The current epoch number.
+
+    Returns:
+        tuple: A tuple containing the average accuracy, precision, recall, F1, random guess metrics and the loss.
+    """
+    model.eval()
+    sample_metrics = []
+    loss_sum, batches = 0.0, 0
+
+    with torch.no_grad():
+        for batch in tqdm(
+            data_val_loader, desc=f"Fast Validation Epoch {epoch+1}", leave=False, disable=not is_main_process()
+        ):
+            tp, fp, fn, tn, loss = model.score_masks(
+                [q+" Output the segmentation mask for the object in the image" for q in batch["queries"]],
+                batch["image"],
+                batch["gt_embs"],
+                batch["sam_embs"],
+            )
+            counts = torch.stack([tp, fp, fn, tn], dim=1).tolist()
+            sample_metrics += [mask_metrics(*c) for c in counts]
+            if not torch.isnan(loss):
+                loss_sum += loss.item()
+                batches += 1
+
+    loss_sum, batches = all_reduce_sums([loss_sum, batches])
+    return average_metrics(sample_metrics) + (loss_sum / batches if batches else 0,)
 
 
 # ==========================
-# 3. Run Experiment Function
+# 3. Training State Checkpoints
 # ==========================
-def run_experiment(exp_name, exp_config, config, data_loaders):
+class CheckpointManager:
+    """
+    Periodically saves the full training state so that a preempted run can be resumed.
+
+    Saves are rate-limited: one is done only after every_steps steps and only if the total time spent
+    saving stays under max_overhead times the time spent training.
+    """
+
+    def __init__(self, path, every_steps=50, max_overhead=0.05):
+        """
+        Args:
+            path (str): Path of the checkpoint file.
+            every_steps (int, optional): Minimum number of steps between two saves. Defaults to 50.
+            max_overhead (float, optional): Maximum fraction of the training time spent saving. Defaults to 0.05.
+        """
+        self.path = path
+        self.every_steps = every_steps
+        self.max_overhead = max_overhead
+
+        self.train_time = 0.0
+        self.save_time = 0.0
+        self.last_save_time = 0.0
+        self.steps_since_save = 0
+
+    def step(self, step_time, get_state):
+        """
+        Account for a training step and save the state if the rate limit allows it.
+
+        Args:
+            step_time (float): Duration of the step in seconds.
+            get_state (callable): Returns the state to save, only called when saving.
+
+        Returns:
+            bool: Whether the state was saved.
+        """
+        self.train_time += step_time
+        self.steps_since_save += 1
+        # assume the next save costs as much as the last one
+        due = (
+            self.steps_since_save >= self.every_steps
+            and self.save_time + self.last_save_time <= self.max_overhead * self.train_time
+        )
+        # every process has to take part in the save (RNG states are gathered), the main process decides
+        if not broadcast_flag(due):
+            return False
+        self.save(get_state())
+        return True
+
+    def save(self, state):
+        """Atomically write the state to the checkpoint file (only in the main process)"""
+        start = time.perf_counter()
+        if is_main_process():
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            torch.save(state, self.path + ".tmp")
+            os.replace(self.path + ".tmp", self.path)
+
+        self.last_save_time = time.perf_counter() - start
+        self.save_time += self.last_save_time
+        self.steps_since_save = 0
+
+    def load(self):
+        """Load the last saved state, None if there is no checkpoint"""
+        if not os.path.exists(self.path):
+            return None
+        return torch.load(self.path, map_location="cpu", weights_only=False)
+
+
+def get_training_state(model, optimizer, scheduler, epoch, batch, losses, best_f1, wandb_id):
+    """
+    Collect everything needed to resume training from the given position.
+
+    Args:
+        model (LISA_Model): The model being trained, only the trainable parameters are saved.
+        optimizer (torch.optim.Optimizer): The optimizer.
+        scheduler (torch.optim.lr_scheduler.LRScheduler): The learning rate scheduler.
+        epoch (int): The current epoch.
+        batch (int): Index of the next batch to train on in the epoch.
+        losses (list): Losses of the batches already done in the epoch.
+        best_f1 (float): Best validation F1 so far.
+        wandb_id (str): Id of the wandb run.
+
+    Returns:
+        dict: The training state.
+    """
+    return {
+        "model": {n: p.detach().cpu() for n, p in model.named_parameters() if p.requires_grad},
+        "optimizer": optimizer.state_dict(),
+        "scheduler": scheduler.state_dict(),
+        "epoch": epoch,
+        "batch": batch,
+        "losses": list(losses),
+        "best_f1": best_f1,
+        "wandb_id": wandb_id,
+        "world_size": get_world_size(),
+        # one entry per process
+        "rng": gather_objects({
+            "python": random.getstate(),
+            "numpy": np.random.get_state(),
+            "torch": torch.get_rng_state(),
+            "cuda": torch.cuda.get_rng_state_all() if torch.cuda.is_available() else None,
+        }),
+    }
+
+
+def restore_training_state(state, model, optimizer, scheduler):
+    """
+    Restore the model weights, optimizer, scheduler and RNG states saved by get_training_state.
+
+    Args:
+        state (dict): The training state.
+        model (LISA_Model): The model being trained.
+        optimizer (torch.optim.Optimizer): The optimizer.
+        scheduler (torch.optim.lr_scheduler.LRScheduler): The learning rate scheduler.
+    """
+    if state["world_size"] != get_world_size():
+        raise ValueError(
+            f"The checkpoint was saved with {state['world_size']} processes, resume with the same number of processes"
+        )
+    model.load_state_dict(state["model"], strict=False)
+    optimizer.load_state_dict(state["optimizer"])
+    scheduler.load_state_dict(state["scheduler"])
+
+    rng = state["rng"][get_rank()]
+    random.setstate(rng["python"])
+    np.random.set_state(rng["numpy"])
+    torch.set_rng_state(rng["torch"])
+    if rng["cuda"] is not None and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(rng["cuda"])
+
+
+# ==========================
+# 4. Run Experiment Function
+# ==========================
+def run_experiment(exp_name, exp_config, config, data_loaders, resume=False, device=None, stop_at_epoch=None):
     """
     Executes the training, validation, and testing pipeline for a given experiment.
 
+    With stop_at_epoch the training stops (after a validation) once that epoch is reached, the experiment can then
+    be continued later with resume=True: the learning rate schedule is the same as for an uninterrupted run.
+
     Args:
         exp_name (str): Name of the experiment.
         exp_config (dict): Configuration dictionary for the experiment.
         config (object): Global configuration object loaded from YAML.
         data_loaders (tuple): Tuple containing training, validation, and test DataLoaders.
+        resume (bool, optional): Resume from the last training state checkpoint of the experiment if there is one. Defaults to False.
+        device (str, optional): Device to train on, with several processes the device of this process. Defaults to the device of the performance section of the config.
+        stop_at_epoch (int, optional): Stop the training after this many epochs, without testing. Defaults to None.
+
+    Returns:
+        dict: number of trained epochs, best validation F1 and last validation and test metrics
     """
-    print(
+    # with several processes only the main one writes logs, models and checkpoints
+    main_process = is_main_process()
+
+    def log(message):
+        if main_process:
+            tqdm.write(message)
+
+    log(
         f"========================\nRunning Experiment: {exp_name}\n========================"
     )
     os.makedirs("models", exist_ok=True)
 
+    # Full training state checkpoints to resume preempted runs
+    checkpoint_config = exp_config.get("checkpoint", {})
+    checkpointer = CheckpointManager(
+        f"models/checkpoints/{exp_name}.pt",
+        every_steps=checkpoint_config.get("every_steps", 50),
+        max_overhead=checkpoint_config.get("max_overhead", 0.05),
+    )
+    state = checkpointer.load() if resume else None
+    if resume and state is None:
+        log("No checkpoint found, starting from scratch")
+
     # Initialize wandb for this experiment
-    initialize_wandb(exp_name, exp_config)
+    wandb_id = initialize_wandb(exp_name, exp_config, state["wandb_id"] if state else None, enabled=main_process)
 
     # Unpack data loaders
     data_loader, data_val_loader, data_test_loader = data_loaders
+    device = device or config.performance.resolve_device()
 
     # Load model with experiment-specific parameters
-    print("Loading Model")
+    log("Loading Model")
     model = LISA_Model(
         model_name=config.llava.model,
         seg_emb_size=data_loader.dataset[0]["gt_embs"].shape[1],
-        **exp_config.get("model_params", {}),
+        **{**exp_config.get("model_params", {}), "device": device, "dtype": config.performance.dtype},
     )
-    model.to("cuda")
-    # save model params in json file
-    with open(f"models/{exp_name}.json", "w") as f:
-        json.dump({"model_name": config.llava.model, "seg_emb_size": data_loader.dataset[0]["gt_embs"].shape[1], **exp_config.get("model_params", {})}, f)
-    # save preprocess params in json file
-    with open(f"models/preprocess_{exp_name}.json", "w") as f:
-        json.dump(exp_config.get("preprocess_params", {}), f)
+    # per-stage timing of the training step, logged every log_interval batches
+    model.timer.enabled = exp_config.get("profile", False)
+    # peak memory of the stages of the training step, validation and test, saved to MEMORY_REPORT_PATH
+    model.memory.enabled = exp_config.get("memory_profile", False)
+    model.memory.tracemalloc = exp_config.get("memory_tracemalloc", False)
+    if main_process:
+        # save model params in json file
+        with open(f"models/{exp_name}.json", "w") as f:
+            json.dump({"model_name": config.llava.model, "seg_emb_size": data_loader.dataset[0]["gt_embs"].shape[1], **exp_config.get("model_params", {})}, f)
+        # save preprocess params in json file
+        with open(f"models/preprocess_{exp_name}.json", "w") as f:
+            json.dump(exp_config.get("preprocess_params", {}), f)
     
     def verify_models_equality(model1, model2):
         # 1. Compare parameters
@@ -221,6 +448,8 @@ def run_experiment(exp_name, exp_config, config, data_loaders):
         return True
 
     def save_state_dict(model, path):
+        if not main_process:
+            return
         # Get state dict and ensure it's on CPU
         state_dict = model.state_dict()
         # Remove quantization-specific keys
@@ -247,25 +476,57 @@ def run_experiment(exp_name, exp_config, config, data_loaders):
     scheduler = torch.optim.lr_scheduler.CosineAnnealingLR(optimizer, T_max=exp_config["epochs"], eta_min=exp_config["scheduler"]["eta_min"])
 
     best_f1 = 0
-    print("Starting Training")
+    start_epoch, start_batch, epoch_losses = 0, 0, []
+    if state is not None:
+        restore_training_state(state, model, optimizer, scheduler)
+        best_f1 = state["best_f1"]
+        start_epoch, start_batch, epoch_losses = state["epoch"], state["batch"], state["losses"]
+        log(f"Resuming from epoch {start_epoch+1}, batch {start_batch}")
+    log("Starting Training")
 
     EPOCHS = exp_config["epochs"]
     SKIP_VAL_TEST = exp_config.get("skip_test_val", False)
     log_interval = exp_config.get("log_interval", 10)
     val_every = exp_config.get("val_every", 10)
+    # "teacher_forced" validates with a single forward pass per batch, the generate-based validation
+    # then only runs every full_val_every epochs as a slower check
+    val_mode = exp_config.get("val_mode", "generate")
+    full_val_every = exp_config.get("full_val_every", None)
+    # only the hardest negatives (plus a few random ones) are injected in every training step
+    hard_negatives = exp_config.get("hard_negatives", None)
+    negative_sampler = HardNegativeSampler(**hard_negatives) if hard_negatives else None
+    last_epoch = min(stop_at_epoch or EPOCHS, EPOCHS)
+    results = {"epochs": max(start_epoch, last_epoch), "best_val_f1": best_f1}
+
+    for epoch in tqdm(range(start_epoch, last_epoch), initial=start_epoch, total=EPOCHS, disable=not main_process):
+        # the order of the epoch only depends on its index, so the skipped batches are the ones already seen
+        data_loader.sampler.set_epoch(epoch, start_batch * data_loader.batch_size)
+
+        def on_step(next_batch, step_time, losses):
+            checkpointer.step(
+                step_time,
+                lambda: get_training_state(model, optimizer, scheduler, epoch, next_batch, losses, best_f1, wandb_id),
+            )
 
-    for epoch in tqdm(range(EPOCHS)):
         avg_loss = train_step(
-            model, data_loader, optimizer, epoch, EPOCHS, log_interval
+            model, data_loader, optimizer, epoch, EPOCHS, log_interval, start_batch, epoch_losses, on_step, negative_sampler
         )
-        tqdm.write(f"Epoch {epoch+1}/{EPOCHS} - Train Loss: {avg_loss:.4f}")
+        start_batch, epoch_losses = 0, []
+        log(f"Epoch {epoch+1}/{EPOCHS} - Train Loss: {avg_loss:.4f}")
         wandb.log({"train/avg_loss": avg_loss, "train/adapter_lr": optimizer.param_groups[0]["lr"], "train/lora_lr": optimizer.param_groups[1]["lr"], "epoch": epoch + 1})
 
         scheduler.step()
 
-        # Validation every val_every epochs or last epoch
-        if (epoch + 1) % val_every == 0 or (epoch + 1) == EPOCHS:
+        # Validation every val_every epochs, last epoch or before stopping
+        if (epoch + 1) % val_every == 0 or (epoch + 1) == last_epoch:
             if not SKIP_VAL_TEST:
+                with model.memory.stage("validation"):
+                    if val_mode == "teacher_forced":
+                        *val_metrics, val_loss = teacher_forced_val_step(model, data_val_loader, epoch)
+                        log(f"Validation Loss: {val_loss:.4f}")
+                        wandb.log({"val/loss": val_loss, "epoch": epoch + 1})
+                    else:
+                        val_metrics = val_step(model, data_val_loader, epoch)
                 (
                     accuracy_avg,
                     precision_avg,
@@ -275,17 +536,17 @@ def run_experiment(exp_name, exp_config, config, data_loaders):
                     rand_precision_avg,
                     rand_recall_avg,
                     rand_f1_avg,
-                ) = val_step(model, data_val_loader, epoch)
+                ) = val_metrics
 
-                tqdm.write(f"Validation - Epoch {epoch+1}")
-                tqdm.write(
+                log(f"Validation - Epoch {epoch+1}")
+                log(
                     f"Accuracy: {accuracy_avg:.4f} vs (rand) {rand_accuracy_avg:.4f}"
                 )
-                tqdm.write(
+                log(
                     f"Precision: {precision_avg:.4f} vs (rand) {rand_precision_avg:.4f}"
                 )
-                tqdm.write(f"Recall: {recall_avg:.4f} vs (rand) {rand_recall_avg:.4f}")
-                tqdm.write(f"F1: {f1_avg:.4f} vs (rand) {rand_f1_avg:.4f}")
+                log(f"Recall: {recall_avg:.4f} vs (rand) {rand_recall_avg:.4f}")
+                log(f"F1: {f1_avg:.4f} vs (rand) {rand_f1_avg:.4f}")
 
                 wandb.log(
                     {
@@ -297,23 +558,52 @@ def run_experiment(exp_name, exp_config, config, data_loaders):
                     }
                 )
 
+                results.update({"val_accuracy": accuracy_avg, "val_precision": precision_avg, "val_recall": recall_avg, "val_f1": f1_avg})
                 if f1_avg > best_f1:
                     best_f1 = f1_avg
-                    tqdm.write(f"New Best F1: {best_f1:.4f}")
+                    results["best_val_f1"] = best_f1
+                    log(f"New Best F1: {best_f1:.4f}")
                     wandb.log({"best_val_f1": best_f1})
                     save_state_dict(model, f"models/{exp_name}.pth")
+
+                if val_mode == "teacher_forced" and full_val_every and (
+                    (epoch + 1) % full_val_every == 0 or (epoch + 1) == EPOCHS
+                ):
+                    gen_accuracy, gen_precision, gen_recall, gen_f1, *_ = val_step(model, data_val_loader, epoch)
+                    log(f"Generate Validation - F1: {gen_f1:.4f}, Precision: {gen_precision:.4f}, Recall: {gen_recall:.4f}")
+                    wandb.log(
+                        {
+                            "val_generate/accuracy": gen_accuracy,
+                            "val_generate/precision": gen_precision,
+                            "val_generate/recall": gen_recall,
+                            "val_generate/f1": gen_f1,
+                            "epoch": epoch + 1,
+                        }
+                    )
+
+        # always keep the state at the end of an epoch
+        checkpointer.save(get_training_state(model, optimizer, scheduler, epoch + 1, 0, [], best_f1, wandb_id))
+
+    if last_epoch < EPOCHS:
+        save_memory_report(model.memory, exp_name, main_process)
+        wandb.finish()
+        log(f"Experiment stopped at epoch {last_epoch}/{EPOCHS}")
+        return results
                 
-    if  not os.path.exists(f"models/{exp_name}.pth") or SKIP_VAL_TEST:
-        print("Best model not found, using the last model for testing")
+    if main_process and (not os.path.exists(f"models/{exp_name}.pth") or SKIP_VAL_TEST):
+        log("Best model not found, using the last model for testing")
         save_state_dict(model, f"models/{exp_name}.pth")
+    barrier()
     
     # ==========================
     # 7. Testing
     # ==========================
     if not SKIP_VAL_TEST:
-        model.load_state_dict(torch.load(f"models/{exp_name}.pth"))
+        model.load_state_dict(torch.load(f"models/{exp_name}.pth", map_location=device))
 
-        print("Starting Testing")
+        log("Starting Testing")
+        with model.memory.stage("test"):
+            test_metrics = val_step(model, data_test_loader, EPOCHS)
         (
             accuracy_test,
             precision_test,
@@ -323,16 +613,16 @@ def run_experiment(exp_name, exp_config, config, data_loaders):
             rand_precision_avg_test,
             rand_recall_avg_test,
             rand_f1_avg_test,
-        ) = val_step(model, data_test_loader, EPOCHS)
+        ) = test_metrics
 
-        tqdm.write(f"Test Results:")
-        tqdm.write(f"Accuracy: {accuracy_test:.4f} vs (rand) {rand_accuracy_avg_test:.4f}")
-        tqdm.write(
+        log(f"Test Results:")
+        log(f"Accuracy: {accuracy_test:.4f} vs (rand) {rand_accuracy_avg_test:.4f}")
+        log(
             f"Precision: {precision_test:.4f} vs (rand) {rand_precision_avg_test:.4f}"
         )
-        tqdm.write(f"Recall: {recall_test:.4f} vs (rand) {rand_recall_avg_test:.4f}")
-        tqdm.write(f"F1: {f1_test:.4f} vs (rand) {rand_f1_avg_test:.4f}")
-        tqdm.write(f"Best F1 (Val): {best_f1:.4f}")
+        log(f"Recall: {recall_test:.4f} vs (rand) {rand_recall_avg_test:.4f}")
+        log(f"F1: {f1_test:.4f} vs (rand) {rand_f1_avg_test:.4f}")
+        log(f"Best F1 (Val): {best_f1:.4f}")
 
         wandb.log(
             {
@@ -343,14 +633,17 @@ def run_experiment(exp_name, exp_config, config, data_loaders):
                 "best_val_f1": best_f1,
             }
         )
+        results.update({"test_accuracy": accuracy_test, "test_precision": precision_test, "test_recall": recall_test, "test_f1": f1_test})
+    save_memory_report(model.memory, exp_name, main_process)
     wandb.finish()
-    print("Experiment Completed Successfully")
+    log("Experiment Completed Successfully")
+    return results
 
 
 # ==========================
-# 4. Other Utility Functions
+# 5. Other Utility Functions
 # ==========================
-def load_model(model_path, model_params, device):
+def load_model(model_path, model_params, device, dtype=None):
     """
     Load the trained LISA_Model from the saved state_dict.
 
@@ -358,6 +651,7 @@ def load_model(model_path, model_params, device):
         model_path (str): Path to the saved model state_dict.
         model_params (str): Path to the model parameters JSON file.
         device (str): Device to load the model on.
+        dtype (torch.dtype, optional): dtype of the LLava weights. Defaults to the one of the checkpoint.
 
     Returns:
         LISA_Model: Loaded model.
@@ -370,10 +664,22 @@ def load_model(model_path, model_params, device):
     with open(model_params, "r") as file:
         model_params = json.load(file)
 
-    model = LISA_Model(**model_params)
-    model.load_state_dict(torch.load(model_path), strict=False)
+    model = LISA_Model(**{**model_params, "device": device, "dtype": dtype})
+    state_dict = torch.load(model_path, map_location=device)
+    # the quantized base weights of a checkpoint trained on GPU do not fit an unquantized model (e.g. on CPU),
+    # they are the pretrained weights anyway: only the LoRA weights and the adapter are needed
+    model_state = model.state_dict()
+    skipped = [k for k, v in state_dict.items() if k in model_state and model_state[k].shape != v.shape]
+    if skipped:
+        print(f"Skipping {len(skipped)} quantized base weights of the checkpoint")
+    model.load_state_dict({k: v for k, v in state_dict.items() if k not in skipped}, strict=False)
     model = model.to(device)
     model.eval()
 
     print("Model loaded successfully.")
-    return model
\ No newline at end of file
+    return model
+
+def save_memory_report(memory: MemoryTracker, exp_name: str, main_process: bool = True):
+    """Save and print the memory report of an experiment when its memory is recorded"""
+    if memory.enabled and main_process:
+        memory.save(MEMORY_REPORT_PATH.format(exp_name=exp_name))
@@ -0,0 +1,126 @@
+from multiprocessing import Pool
+
+import cv2
+import numpy as np
+
+
+def _contours(shapes) -> list[np.ndarray]:
+    """Contours of a list of shapes (each one a list of contours of [x, y] points) as int32 arrays"""
+    return [np.rint(np.asarray(contour, dtype=np.float64).reshape(-1, 2)).astype(np.int32) for shape in shapes for contour in shape]
+
+
+def rasterize(contours: list[np.ndarray], origin: np.ndarray, size: tuple[int, int]) -> np.ndarray:
+    """
+    Union of the filled contours as a boolean mask.
+
+    Every contour is filled on its own, so self-intersecting contours are kept (and not dropped as invalid polygons)
+    and nested contours are merged as in the union of the polygons.
+
+    Args:
+        contours (list[np.ndarray]): contours of [x, y] points
+        origin (np.ndarray): coordinates of the top-left pixel of the mask
+        size (tuple[int, int]): height and width of the mask
+
+    Returns:
+        np.ndarray: uint8 mask of the given size (1 inside the contours)
+    """
+    mask = np.zeros(size, dtype=np.uint8)
+    for contour in contours:
+        cv2.fillPoly(mask, [contour - origin], 1)
+    return mask
+
+
+def compute_IoU(gt_shapes, pred_shapes) -> dict:
+    """
+    Compute IoU and gIoU of the union of the predicted shapes with the union of the ground truth shapes.
+
+    The shapes are rasterized on the smallest canvas containing both of them and the areas are pixel counts.
+    The gIoU uses the convex hull of all the points as the enclosing area.
+
+    Args:
+        gt_shapes (list): List of ground truth shapes, each shape is a list of polygons of [x,y] points.
+        pred_shapes (list): List of predicted shapes, each shape is a list of polygons of [x,y] points.
+
+    Returns:
+        dict: IoU and gIoU scores, intersection and union areas and the number of contours with less than 3 points.
+    """
+    gt = _contours(gt_shapes)
+    pred = _contours(pred_shapes)
+    # contours with less than 3 points have no area
+    invalid = sum(len(c) < 3 for c in gt + pred)
+    gt = [c for c in gt if len(c) >= 3]
+    pred = [c for c in pred if len(c) >= 3]
+
+    if len(gt) == 0 or len(pred) == 0:
+        return {"intersection": 0.0, "union": 0.0, "IoU": 0.0, "gIoU": 0.0, "invalid": invalid}
+
+    points = np.concatenate(gt + pred)
+    origin = points.min(axis=0)
+    size = tuple((points.max(axis=0) - origin + 1)[::-1])
+
+    gt_mask = rasterize(gt, origin, size)
+    pred_mask = rasterize(pred, origin, size)
+    union_mask = cv2.bitwise_or(gt_mask, pred_mask)
+    intersection = float(cv2.countNonZero(cv2.bitwise_and(gt_mask, pred_mask)))
+    union = float(cv2.countNonZero(union_mask))
+    if union == 0:
+        return {"intersection": intersection, "union": union, "IoU": 0.0, "gIoU": 0.0, "invalid": invalid}
+
+    # the rasterized shapes can stick out of the rasterized hull by a boundary pixel, so the hull is drawn over them
+    cv2.fillConvexPoly(union_mask, cv2.convexHull(points - origin), 1)
+    hull_area = float(cv2.countNonZero(union_mask))
+
+    iou = intersection / union
+    return {
+        "intersection": intersection,
+        "union": union,
+        "IoU": iou,
+        "gIoU": iou - (hull_area - union) / hull_area,
+        "invalid": invalid,
+    }
+
+
+def _compute_pair(pair):
+    return compute_IoU(*pair)
+
+
+def compute_metrics(gt_shapes: list, pred_shapes: list, workers: int = 0, chunksize: int = 32) -> list[dict]:
+    """
+    Compute the metrics of every sample, in a pool of processes for large evaluation sets.
+
+    Args:
+        gt_shapes (list): ground truth shapes of every sample
+        pred_shapes (list): predicted shapes of every sample
+        workers (int, optional): number of processes, 0 to compute them in the current process. Defaults to 0.
+        chunksize (int, optional): number of samples sent to a process at a time. Defaults to 32.
+
+    Returns:
+        list[dict]: metrics of every sample (see compute_IoU), in the order of the samples
+    """
+    pairs = list(zip(gt_shapes, pred_shapes))
+    if workers <= 0 or len(pairs) < 2 * chunksize:
+        return [compute_IoU(gt, pred) for gt, pred in pairs]
+    with Pool(workers) as pool:
+        return pool.map(_compute_pair, pairs, chunksize=chunksize)
+
+
+def summarize_metrics(metrics: list[dict]) -> dict:
+    """
+    Aggregate the metrics of the samples.
+
+    Args:
+        metrics (list[dict]): metrics of every sample
+
+    Returns:
+        dict: mean IoU and gIoU over the samples, cIoU (total intersection over total union) and number of invalid contours
+    """
+    if len(metrics) == 0:
+        return {"mean_IoU": 0.0, "mean_gIoU": 0.0, "cIoU": 0.0, "invalid": 0}
+    values = {key: np.array([m[key] for m in metrics]) for key in metrics[0]}
+    union = values["union"].sum()
+    return {
+        "mean_IoU": float(values["IoU"].mean()),
+        "mean_gIoU": float(values["gIoU"].mean()),
+        "cIoU": float(values["intersection"].sum() / union) if union > 0 else 0.0,
+        "invalid": int(values["invalid"].sum()),
+    }
@@ -1,16 +1,82 @@
+import copy
+from contextlib import contextmanager
+
 import torch
 import torch.nn as nn
 from peft import LoraConfig, get_peft_model
 from PIL import Image
 from transformers import (
     BitsAndBytesConfig,
+    DynamicCache,
     LlavaForConditionalGeneration,
     LlavaProcessor,
+    LogitsProcessorList,
     PreTrainedModel,
+    RepetitionPenaltyLogitsProcessor,
+    TemperatureLogitsWarper,
+    TopKLogitsWarper,
+    TopPLogitsWarper,
 )
 
+from llava_finetune.decoding import MaskSelectionLogitsProcessor, SegVocabLogitsProcessor, to_sample_ids
+from llava_finetune.distributed import any_across_ranks, average_gradients
+from llava_finetune.profiling import MemoryTracker, StageTimer
+
 DEBUG_PRINTS = False
 
+# Sentences introducing the mask tokens in the answers used for training
+MASK_POSITION_TEXTS = [
+    "The segmentation mask for the object in the image is",
+    "The requested object cab be found in",
+    "You can find the segmentation mask for the object in the image at",
+    "The object is located in",
+    "The object is in",
+    "You can find the object in",
+    "Concering the object location, it is in",
+    "The object is located at",
+    "The object is at",
+    "The object can be found in",
+    "The object is in the image at",
+]
+# Requests for the masks added to the queries used for training
+OUTPUT_MASK_TEXTS = [
+    "Output the segmentation mask for the object in the image",
+    "Output the mask for the object in the image",
+    "Output the segmentation mask",
+    "Output the mask",
+    "Generate the segmentation mask for the object",
+    "Generate the mask for the object",
+    "Generate the segmentation mask",
+    "Generate the mask",
+    "Provide the segmentation mask for the object",
+    "Provide the mask for the object",
+    "Provide the segmentation mask",
+    "Provide the mask",
+]
+
+
+def build_lora_config(lora_rank: int = 16) -> LoraConfig:
+    """
+    Build the LoRA configuration applied on top of the LLava model
+
+    Args:
+        lora_rank (int, optional): Rank of the LoRA model. Defaults to 16.
+
+    Returns:
+        LoraConfig: LoRA configuration for peft
+    """
+    return LoraConfig(
+        r=lora_rank,
+        lora_alpha=lora_rank*2,
+        target_modules=[
+            "q_proj",
+            "v_proj",
+            "output_proj"
+        ],  # Adjust based on the actual module names
+        bias="none",
+        task_type="CAUSAL_LM",
+    )
+
 
 class QueryBlock(nn.Module):
     def __init__(
@@ -61,7 +127,8 @@ class QueryBlock(nn.Module):
         Returns:
             x (torch.Tensor): Output tensor with shape (num_segments, output_dim)
         """
-        query = self.query.repeat(input.size(0), 1, 1)
+        # a view of the learned queries, they are the same for every segment
+        query = self.query.expand(input.size(0), -1, -1)
         x, _ = self.attention(query=query, key=input, value=input)
 
         x = self.ffn(x)
@@ -88,6 +155,7 @@ class SegAdapter(nn.Module):
         dropout: float = 0.25,
         noise_level: float = 1e-4,
         mlp_adapter: bool = False,
+        mean_path: str = "models/train_embs_mean.pt",
     ):
         """
         Adapter module from the output of AlphaClip from the segmentation model to the input of the LLava model
@@ -102,13 +170,15 @@ class SegAdapter(nn.Module):
             num_heads (int): Number of heads to use in the multi-head attention layer
             num_queries (int): Number of queries to use in the multi-head attention layer
             blocks (int): Number of blocks to use in the adapter module
+            mean_path (str): Mean of the training segment embeddings, subtracted from the inputs
         """
         super().__init__()
 
         if hidden_dim is None:
             hidden_dim = llava_embedding_dim
 
-        self.mean_train_masks = torch.load("models/train_embs_mean.pt")
+        # buffer: moved with the module instead of on every call, not saved in the checkpoints (loaded from mean_path)
+        self.register_buffer("mean_train_masks", torch.load(mean_path, map_location="cpu"), persistent=False)
         self.input_norm = nn.LayerNorm(input_segment_dim)
         
         self.mlp_adapter = mlp_adapter
@@ -165,7 +235,7 @@ class SegAdapter(nn.Module):
         Returns:
             llava_input (torch.Tensor): Input tensor for the LLava model with shape (seq_length, llava_embedding_dim)
         """
-        segment_embeddings = segment_embeddings - self.mean_train_masks.to(segment_embeddings.device).to(segment_embeddings.dtype)
+        segment_embeddings = segment_embeddings - self.mean_train_masks.to(segment_embeddings.dtype)
         segment_embeddings = self.input_norm(segment_embeddings)
 
         if not self.mlp_adapter:
@@ -173,10 +243,7 @@ class SegAdapter(nn.Module):
 
             #print std and mean of the embeddings
             # print(f"Mean: {segment_embeddings.mean()} - Std: {segment_embeddings.std()}")
-            x = [
-                    linear(segment_embeddings + torch.randn_like(segment_embeddings) * self.noise_level * (1 if self.training else 0))
-                    for linear in self.linears
-                ]
+            x = [linear(self._add_noise(segment_embeddings)) for linear in self.linears]
             if len(x) == 0:
                 x = segment_embeddings
                 
@@ -189,7 +256,7 @@ class SegAdapter(nn.Module):
             x = x.mean(dim=1)
             llava_input += x
         else:
-            segment_embeddings = segment_embeddings + torch.randn_like(segment_embeddings) * self.noise_level * (1 if self.training else 0)
+            segment_embeddings = self._add_noise(segment_embeddings)
             llava_input = self.mlp(segment_embeddings)
 
         llava_input = self.norm(llava_input)
@@ -199,6 +266,12 @@ class SegAdapter(nn.Module):
 
         return llava_input
 
+    def _add_noise(self, x: torch.Tensor) -> torch.Tensor:
+        # the noise is only a training regularization, nothing is sampled at inference
+        if self.training and self.noise_level > 0:
+            return x + torch.randn_like(x) * self.noise_level
+        return x
+
 
 # Define the custom model class
 class DynamicVocabLlavaModel(nn.Module):
@@ -218,6 +291,8 @@ class DynamicVocabLlavaModel(nn.Module):
         self.original_emb_matrix = model.get_input_embeddings().weight.clone().detach()
         self.tokenizer_vocab_size = processor.tokenizer.vocab_size
         self.processor = processor
+        # shared with the LISA_Model to time the stages of the training step
+        self.timer = StageTimer()
 
     def forward(
         self,
@@ -242,6 +317,7 @@ class DynamicVocabLlavaModel(nn.Module):
         """
         # Add new tokens to the vocabulary and the model's embedding layer
         self.add_tokens(additional_tokens)
+        self.timer.lap("add_tokens")
 
         # Prepare inputs for generation
         inputs = self.llava_model.prepare_inputs_for_generation(
@@ -254,6 +330,7 @@ class DynamicVocabLlavaModel(nn.Module):
             return_dict=True,
         )
         logits = outputs.logits
+        self.timer.lap("forward")
 
         if token_masks is not None:
             # logits is (batch_size, seq_length, vocab_size) and token_masks is (batch_size, vocab_size) so we need to expand token_masks
@@ -348,6 +425,7 @@ class LISA_Model(nn.Module):
         q8: bool = False,
         dropout: float = 0.1,
         device: str = "cuda",
+        dtype: torch.dtype = None,
         **adapter_kwargs,
     ):
         """Initialize the LISA model
@@ -367,6 +445,7 @@ class LISA_Model(nn.Module):
             q8 (bool, optional): Load the model in 8-bit quantization. Defaults to False.
             dropout (float, optional): Dropout rate to apply in the adapter module. Defaults to 0.1.
             device (str, optional): Device to run the model on. Defaults to "cuda"
+            dtype (torch.dtype, optional): dtype of the LLava weights (the adapter stays in fp32). Defaults to the one of the checkpoint.
 
         """
         super(LISA_Model, self).__init__()
@@ -382,31 +461,24 @@ class LISA_Model(nn.Module):
 
         # Configuration for quantization
         assert not (q4 and q8), "Only one of q4 or q8 should be True"
+        if (q4 or q8) and torch.device(device).type != "cuda":
+            # bitsandbytes quantization needs a GPU, the model is loaded unquantized instead
+            print(f"Quantization is not available on {device}, loading the model without quantization")
+            q4 = q8 = False
         bnb_config = BitsAndBytesConfig(
             load_in_4bit=q4,
             load_in_8bit=q8,
-        )
+        ) if q4 or q8 else None
 
         # Load the pre-trained LLava model and wrap it with the custom model
         model = LlavaForConditionalGeneration.from_pretrained(
-            model_name, quantization_config=bnb_config
+            model_name, quantization_config=bnb_config, torch_dtype=dtype
         )
         for param in model.parameters():
             param.requires_grad = False
 
         # Apply LoRA to the LLava model
-        lora_config = LoraConfig(
-            r=lora_rank,
-            lora_alpha=lora_rank*2,
-            target_modules=[
-                "q_proj",
-                "v_proj",
-                "output_proj"
-            ],  # Adjust based on the actual module names
-            bias="none",
-            task_type="CAUSAL_LM",
-        )
-        model = get_peft_model(model, lora_config)
+        model = get_peft_model(model, build_lora_config(lora_rank))
 
         self.adapter = SegAdapter(
             seg_emb_size, model.get_input_embeddings().weight.size(1), dropout=dropout, **adapter_kwargs
@@ -423,6 +495,11 @@ class LISA_Model(nn.Module):
         self.device = device
         self.pos_weight = pos_weight
         self.neg_weight = neg_weight
+
+        # per-stage timing and peak memory of optim_step, disabled by default
+        self.memory = MemoryTracker(device=device)
+        self.timer = StageTimer(device=device, memory=self.memory)
+        self.llava_model.timer = self.timer
         
         self.to(device)
 
@@ -449,26 +526,13 @@ class LISA_Model(nn.Module):
         Returns:
             Tuple[torch.Tensor]: Logits for the next tokens computed for the last num_generate tokens in the input sequence and the loss
         """
+        self.timer.begin()
         input_texts = []
         free_token = 1
         new_tokens = []
         
         seg_pos = self.seg_pos
         
-        possible_texts = [
-            "The segmentation mask for the object in the image is",
-            "The requested object cab be found in",
-            "You can find the segmentation mask for the object in the image at",
-            "The object is located in",
-            "The object is in",
-            "You can find the object in",
-            "Concering the object location, it is in",
-            "The object is located at",
-            "The object is at",
-            "The object can be found in",
-            "The object is in the image at",
-        ]
-
         num_new_tokens = sum(
             [pos_mask_embeds[i].size(0) for i in range(len(pos_mask_embeds))]
             + [neg_mask_embeds[i].size(0) for i in range(len(neg_mask_embeds))]
@@ -488,7 +552,7 @@ class LISA_Model(nn.Module):
                 seg_pos = "before" if torch.rand(1) < 0.5 else "after"
                 
             if seg_pos == "after" and self.text:
-                labels[i] = labels[i] + " "+possible_texts[torch.randint(0, len(possible_texts), (1,)).item()]
+                labels[i] = labels[i] + " "+MASK_POSITION_TEXTS[torch.randint(0, len(MASK_POSITION_TEXTS), (1,)).item()]
             elif seg_pos == "before" and self.text:
                 labels[i] = ". " + labels[i]
             for j in range(pos_mask_embeds[i].size(0)):
@@ -501,33 +565,18 @@ class LISA_Model(nn.Module):
                 free_token += 1
 
             if seg_pos == "before" and self.text:
-                labels[i] =  possible_texts[torch.randint(0, len(possible_texts), (1,)).item()] + labels[i]
+                labels[i] =  MASK_POSITION_TEXTS[torch.randint(0, len(MASK_POSITION_TEXTS), (1,)).item()] + labels[i]
             elif seg_pos == "after" and self.text:
                 labels[i] = labels[i] + "."
 
             # apply the chat template to the texts
-            possibile_output_texts = [
-                "Output the segmentation mask for the object in the image",
-                "Output the mask for the object in the image",
-                "Output the segmentation mask",
-                "Output the mask",
-                "Generate the segmentation mask for the object",
-                "Generate the mask for the object",
-                "Generate the segmentation mask",
-                "Generate the mask",
-                "Provide the segmentation mask for the object",
-                "Provide the mask for the object",
-                "Provide the segmentation mask",
-                "Provide the mask",
-            ]
-            
             if self.seg_pos == "randomized":
                 seg_pos = "before" if torch.rand(1) < 0.5 else "after"
                 
             if seg_pos == "after":
-                user_message = f"<image>\n{texts[i]} {possibile_output_texts[torch.randint(0, len(possibile_output_texts), (1,)).item()]}."
+                user_message = f"<image>\n{texts[i]} {OUTPUT_MASK_TEXTS[torch.randint(0, len(OUTPUT_MASK_TEXTS), (1,)).item()]}."
             elif seg_pos == "before":
-                user_message = f"<image>\n{possibile_output_texts[torch.randint(0, len(possibile_output_texts), (1,)).item()]}. {texts[i]}"
+                user_message = f"<image>\n{OUTPUT_MASK_TEXTS[torch.randint(0, len(OUTPUT_MASK_TEXTS), (1,)).item()]}. {texts[i]}"
                 
             input_texts.append(
                 self.llava_model.processor.tokenizer.apply_chat_template(
@@ -556,7 +605,9 @@ class LISA_Model(nn.Module):
                 free_token += 1
 
         new_tokens = torch.stack(new_tokens)
+        self.timer.lap("template")
         new_tokens = self.adapter(new_tokens.to(self.device))
+        self.timer.lap("adapter")
 
         
         # tokenize the texts
@@ -585,6 +636,7 @@ class LISA_Model(nn.Module):
             add_special_tokens=False,
         )
         labels_input_ids = labels_ids["input_ids"].to(self.device)
+        self.timer.lap("tokenize")
 
         # print()
         # print("MODEL TOKENS INPUT")
@@ -627,16 +679,20 @@ class LISA_Model(nn.Module):
         # # penilize the model for not generating the end tokens
         # weights[labels_input_ids == self.tokenized_end_token] = 1.5
         loss = (loss * weights).mean()
+        self.timer.lap("loss")
         
-        # if loss is nan break
-        if torch.isnan(loss):
+        # if loss is nan break (in every process, they have to do the same collectives)
+        if any_across_ranks(torch.isnan(loss).item()):
             print("NAN LOSS")
+            self.llava_model.reset_tokens()
+            self.timer.cancel()
             return None, None
 
         # backward pass
         optimizer.zero_grad()
 
         loss.backward()
+        self.timer.lap("backward")
 
         # copy the gradients to the mask embeddings
         emb_grads = self.llava_model.llava_model.get_input_embeddings().weight.grad
@@ -648,13 +704,148 @@ class LISA_Model(nn.Module):
                 + 1
             ]
         )
+        self.timer.lap("backward_adapter")
+
+        # average the adapter and LoRA gradients across processes when training distributed
+        average_gradients(p for group in optimizer.param_groups for p in group["params"])
+        self.timer.lap("grad_sync")
 
         optimizer.step()
+        self.timer.lap("optimizer")
 
         self.llava_model.reset_tokens()
+        self.timer.lap("reset_tokens")
+        if self.timer.enabled:
+            # counting the tokens needs a device sync, only done when timing
+            pad_token_id = self.llava_model.processor.tokenizer.pad_token_id
+            n_tokens = int(inputs["attention_mask"].sum() + (labels_input_ids != pad_token_id).sum())
+            self.timer.end(samples=len(texts), tokens=n_tokens)
+        else:
+            self.memory.end()
 
         return logits, loss
 
+    def score_masks(
+        self,
+        texts: list[str],
+        images: list[Image.Image],
+        pos_mask_embeds: list[torch.Tensor],
+        neg_mask_embeds: list[torch.Tensor],
+    ):
+        """
+        Teacher-forced scoring of the mask tokens, a single forward pass instead of generating the answers.
+
+        The answer of every sample contains its positive mask tokens (with a fixed template). At every mask position
+        the most likely token, among the normal tokens and the mask tokens of the sample, is the one the model would
+        generate there given the correct previous tokens, every candidate mask predicted at some position counts as
+        selected.
+
+        Args:
+            texts (list[str]): List of input text sequences
+            images (list[Image.Image]): List of input images
+            pos_mask_embeds (list[torch.Tensor]): List of positive mask embeddings with shape (num_pos_masks, seg_emb_size)
+            neg_mask_embeds (list[torch.Tensor]): List of negative mask embeddings with shape (num_neg_masks, seg_emb_size)
+
+        Returns:
+            Tuple[torch.Tensor]: true positives, false positives, false negatives and true negatives of every sample (batch_size,) and the loss
+        """
+        tokenizer = self.llava_model.processor.tokenizer
+        seg_start = self.llava_model.tokenizer_vocab_size + 1
+
+        n_pos = [pos.size(0) for pos in pos_mask_embeds]
+        counts = [pos.size(0) + neg.size(0) for pos, neg in zip(pos_mask_embeds, neg_mask_embeds)]
+        offsets = [sum(counts[:i]) for i in range(len(counts))]
+
+        # the mask tokens of every sample are added one after the other, as in batched generation
+        new_tokens = torch.cat([torch.cat([pos, neg]) for pos, neg in zip(pos_mask_embeds, neg_mask_embeds)])
+        new_tokens = self.adapter(new_tokens.to(self.device))
+
+        input_texts = []
+        labels = []
+        for i in range(len(texts)):
+            masks = "".join(f" <SEG_MASK_{offsets[i] + j + 1}>" for j in range(n_pos[i]))
+            label = f"{MASK_POSITION_TEXTS[0]}{masks}." if self.text else masks
+            input_texts.append(
+                tokenizer.apply_chat_template(
+                    [
+                        {"role": "user", "content": f"<image>\n{texts[i]}"},
+                        {"role": "assistant", "content": label},
+                    ],
+                    tokenize=False,
+                    add_generation_prompt=False,
+                )
+            )
+            labels.append(label + self.end_token)
+
+        with self._left_padding():
+            inputs = self.llava_model.processor(
+                text=input_texts,
+                images=list(images),
+                return_tensors="pt",
+                padding=True,
+                add_special_tokens=False,
+            ).to(self.device)
+            labels_input_ids = self.llava_model.processor(
+                text=labels,
+                return_tensors="pt",
+                padding=True,
+                add_special_tokens=False,
+            )["input_ids"].to(self.device)
+        # remove last token from the input text, the last positions predict the labels
+        inputs["input_ids"] = inputs["input_ids"][:, :-1]
+        inputs["attention_mask"] = inputs["attention_mask"][:, :-1]
+
+        try:
+            logits = self.llava_model(
+                **inputs,
+                additional_tokens=new_tokens,
+                num_generate=labels_input_ids.size(1),
+            )
+        finally:
+            self.llava_model.reset_tokens()
+
+        # every sample only sees its own mask tokens
+        logits = SegVocabLogitsProcessor(seg_start, counts)(None, logits.flatten(0, 1).float()).view(logits.shape)
+        loss = nn.functional.cross_entropy(
+            logits.flatten(0, 1) / self.temperature,
+            labels_input_ids.flatten(),
+            ignore_index=tokenizer.pad_token_id,
+        )
+
+        # candidate masks predicted at the mask positions of the answer
+        offsets = torch.tensor(offsets, device=self.device).unsqueeze(1)
+        seg_positions = (labels_input_ids >= seg_start) & (labels_input_ids < seg_start + sum(counts))
+        candidate = logits.argmax(dim=-1) - seg_start - offsets
+        counts = torch.tensor(counts, device=self.device).unsqueeze(1)
+        predicted_at = seg_positions & (candidate >= 0) & (candidate < counts)
+
+        max_count = int(counts.max())
+        predicted = torch.zeros(len(texts), max_count + 1, dtype=torch.bool, device=self.device)
+        # positions without a predicted mask are sent to the extra last column
+        predicted.scatter_(1, torch.where(predicted_at, candidate, max_count), True)
+        predicted = predicted[:, :max_count]
+
+        index = torch.arange(max_count, device=self.device).unsqueeze(0)
+        valid = index < counts
+        positive = index < torch.tensor(n_pos, device=self.device).unsqueeze(1)
+
+        tp = (predicted & positive).sum(dim=1)
+        fp = (predicted & ~positive & valid).sum(dim=1)
+        fn = (~predicted & positive).sum(dim=1)
+        tn = (~predicted & ~positive & valid).sum(dim=1)
+        return tp, fp, fn, tn, loss
+
+    @contextmanager
+    def _left_padding(self):
+        # batched prompts have to end at the same position
+        tokenizer = self.llava_model.processor.tokenizer
+        padding_side = tokenizer.padding_side
+        tokenizer.padding_side = "left"
+        try:
+            yield
+        finally:
+            tokenizer.padding_side = padding_side
+
     def generate(
         self,
         texts: list[str],
@@ -666,6 +857,9 @@ class LISA_Model(nn.Module):
         repetition_penalty: float = 1.0,
         do_sample: bool = False,
         temperature: float = 0.1,
+        batched: bool = True,
+        constrained: bool = False,
+        mask_tokens: list[torch.Tensor] = None,
     ):
         """
         Generate text from the model
@@ -680,59 +874,289 @@ class LISA_Model(nn.Module):
             repetition_penalty (float, optional): Repetition penalty to apply in the generation. Defaults to 1.0.
             do_sample (bool, optional): Whether to sample or not during generation. Defaults to False.
             temperature (float, optional): Temperature to apply in the generation. Defaults to 0.1.
+            batched (bool, optional): Generate all the samples together instead of one at a time. Defaults to True.
+            constrained (bool, optional): Only generate mask selection answers (template text, distinct mask tokens of the sample, end token). Defaults to False.
+            mask_tokens (list[torch.Tensor], optional): SegAdapter outputs of the positive then negative masks of every sample, e.g. cached
+                                                        by the inference pipeline. Computed from the mask embeddings if not given. Defaults to None.
 
         Returns:
             Tuple[list[str], list[torch.Tensor]]: List of generated text sequences and the corresponding token IDs
         """
+        if mask_tokens is None:
+            # a single call of the adapter for the masks of all the samples
+            counts = [pos.size(0) + neg.size(0) for pos, neg in zip(pos_mask_embeds, neg_mask_embeds)]
+            new_tokens = torch.cat([torch.cat([pos, neg]) for pos, neg in zip(pos_mask_embeds, neg_mask_embeds)])
+            mask_tokens = self.adapter(new_tokens.to(self.device)).split(counts)
+        else:
+            mask_tokens = [tokens.to(self.device) for tokens in mask_tokens]
+        generate_kwargs = {
+            "num_beams": n_beams,
+            "max_new_tokens": max_new_tokens,
+            "eos_token_id": self.tokenized_end_token,
+            "do_sample": do_sample,
+            "repetition_penalty": repetition_penalty,
+            "temperature": temperature,
+        }
+        if batched:
+            return self._generate_batched(texts, images, mask_tokens, generate_kwargs, constrained)
+        return self._generate_sequential(texts, images, mask_tokens, generate_kwargs, constrained)
+
+    def _mask_selection_kwargs(self, generate_kwargs: dict, prompt_len: int, seg_ranges: list[tuple[int, int]]) -> dict:
+        # constrained decoding: the answer is the template text, the selected masks and the end token
+        template = MASK_POSITION_TEXTS[0] if self.text else ""
+        constraint = MaskSelectionLogitsProcessor(
+            prompt_len,
+            self.llava_model.processor.tokenizer.encode(template, add_special_tokens=False),
+            seg_ranges,
+            self.tokenized_end_token,
+        )
+        return {
+            **generate_kwargs,
+            # no need to decode further than the longest answer of the grammar
+            "max_new_tokens": min(generate_kwargs["max_new_tokens"], constraint.max_new_tokens()),
+            "logits_processor": LogitsProcessorList([constraint]),
+        }
+
+    def _generation_prompt(self, text: str) -> str:
+        # apply the chat template to the texts
+        return self.llava_model.processor.tokenizer.apply_chat_template(
+            [
+                {"role": "user", "content": f"<image>\n{text}"},
+            ],
+            tokenize=False,
+            add_generation_prompt=True,
+        )
+
+    def _decode_generated(self, generated_tok: torch.Tensor) -> str:
+        generated = self.llava_model.processor.batch_decode(
+            generated_tok.unsqueeze(0),
+            skip_special_tokens=False,
+            clean_up_tokenization_spaces=False,
+        )[0]
+        # get only from model\n afterwords
+        return generated.split("model\n")[1]
+
+    def _generate_sequential(self, texts, images, mask_tokens, generate_kwargs, constrained=False):
         outputs = []
         tokens = []
         for i in range(len(texts)):
-            new_tokens = torch.cat([pos_mask_embeds[i], neg_mask_embeds[i]])
-            new_tokens = self.adapter(new_tokens.to(self.device))
+            new_tokens = mask_tokens[i]
             self.llava_model.add_tokens(new_tokens)
 
-            # apply the chat template to the texts
-            input_text = self.llava_model.processor.tokenizer.apply_chat_template(
-                [
-                    {"role": "user", "content": f"<image>\n{texts[i]}"},
-                ],
-                tokenize=False,
-                add_generation_prompt=True,
-            )
-            
             # tokenize the texts
             inputs = self.llava_model.processor(
-                text=input_text,
+                text=self._generation_prompt(texts[i]),
                 images=images[i],
                 return_tensors="pt",
                 padding=True,
                 add_special_tokens=False,
             ).to(self.device)
 
+            sample_kwargs = generate_kwargs
+            if constrained:
+                seg_range = (self.llava_model.tokenizer_vocab_size + 1, new_tokens.size(0))
+                sample_kwargs = self._mask_selection_kwargs(generate_kwargs, inputs["input_ids"].size(1), [seg_range])
+
             # call generate on the model
+            generated_tok = self.llava_model.llava_model.generate(**inputs, **sample_kwargs)
+
+            generated = self._decode_generated(generated_tok[0])
+            self.llava_model.reset_tokens()
+
+            outputs.append(generated)
+            tokens.append(generated_tok[0])
+        return outputs, tokens
+
+    def _generate_batched(self, texts, images, mask_tokens, generate_kwargs, constrained=False):
+        """
+        Generate all the samples with a single call to generate.
+
+        The mask tokens of every sample are added to the vocabulary one after the other and a logits processor only
+        lets each sample generate its own ones. The prompts are left padded so that every sample generates from the
+        end of its prompt. The returned ids are converted back to the vocabulary the sample would have alone, so the
+        outputs are the same as the sequential generation.
+        """
+        tokenizer = self.llava_model.processor.tokenizer
+        seg_start = self.llava_model.tokenizer_vocab_size + 1
+
+        counts = [tokens.size(0) for tokens in mask_tokens]
+        offsets = [sum(counts[:i]) for i in range(len(counts))]
+        total = sum(counts)
+
+        self.llava_model.add_tokens(torch.cat(mask_tokens))
+
+        with self._left_padding():
+            inputs = self.llava_model.processor(
+                text=[self._generation_prompt(text) for text in texts],
+                images=list(images),
+                return_tensors="pt",
+                padding=True,
+                add_special_tokens=False,
+            ).to(self.device)
+
+        if constrained:
+            # the grammar already limits every sample to its own mask tokens
+            seg_ranges = [(seg_start + offset, count) for offset, count in zip(offsets, counts)]
+            generate_kwargs = self._mask_selection_kwargs(generate_kwargs, inputs["input_ids"].size(1), seg_ranges)
+        else:
+            generate_kwargs = {
+                **generate_kwargs,
+                "logits_processor": LogitsProcessorList([SegVocabLogitsProcessor(seg_start, counts)]),
+            }
+
+        try:
             generated_tok = self.llava_model.llava_model.generate(
                 **inputs,
-                num_beams=n_beams,
-                max_new_tokens=max_new_tokens,
-                eos_token_id=self.tokenized_end_token,
-                do_sample=do_sample,
-                repetition_penalty=repetition_penalty,
-                temperature=temperature,
+                **generate_kwargs,
+                pad_token_id=tokenizer.pad_token_id,
             )
+        finally:
+            self.llava_model.reset_tokens()
+
+        outputs = []
+        tokens = []
+        prompt_len = inputs["input_ids"].size(1)
+        for i in range(len(texts)):
+            # remove the left padding of the prompt and what comes after the end token
+            prompt = generated_tok[i, prompt_len - int(inputs["attention_mask"][i].sum()) : prompt_len]
+            new = generated_tok[i, prompt_len:]
+            end = (new == self.tokenized_end_token).nonzero()
+            if len(end) > 0:
+                new = new[: end[0, 0] + 1]
+
+            sample_tok = to_sample_ids(torch.cat([prompt, new]), seg_start, offsets[i], counts[i], total)
+            outputs.append(self._decode_generated(sample_tok))
+            tokens.append(sample_tok)
+        return outputs, tokens
+
+    def generate_multi_query(
+        self,
+        texts: list[str],
+        image: Image.Image,
+        pos_mask_embeds: torch.Tensor,
+        neg_mask_embeds: torch.Tensor,
+        max_new_tokens: int = 100,
+        repetition_penalty: float = 1.0,
+        do_sample: bool = False,
+        temperature: float = 0.1,
+        constrained: bool = False,
+        mask_tokens: torch.Tensor = None,
+    ):
+        """
+        Generate the answers to several queries about the same image.
 
-            generated = self.llava_model.processor.batch_decode(
-                generated_tok,
-                skip_special_tokens=False,
-                clean_up_tokenization_spaces=False,
-            )[0]
-            # get only from model\n afterwords
-            generated = generated.split("model\n")[1]
+        The mask tokens are added once and the prompt up to the image (chat template prefix and image tokens) is
+        encoded once, its KV cache is then copied for every query which only has to encode its own text.
+        Each answer is decoded greedily or sampled (with the temperature, top_k and top_p warpers of generate), beam search
+        is not supported.
+
+        Args:
+            texts (list[str]): queries about the image
+            image (Image.Image): input image
+            pos_mask_embeds (torch.Tensor): positive mask embeddings of the image with shape (num_pos_masks, seg_emb_size)
+            neg_mask_embeds (torch.Tensor): negative mask embeddings of the image with shape (num_neg_masks, seg_emb_size)
+            max_new_tokens (int, optional): Maximum number of tokens to generate. Defaults to 100.
+            repetition_penalty (float, optional): Repetition penalty to apply in the generation. Defaults to 1.0.
+            do_sample (bool, optional): Whether to sample or not during generation. Defaults to False.
+            temperature (float, optional): Temperature to apply when sampling. Defaults to 0.1.
+            constrained (bool, optional): Only generate mask selection answers. Defaults to False.
+            mask_tokens (torch.Tensor, optional): SegAdapter outputs of the positive then negative masks of the image,
+                                                  computed from the mask embeddings if not given. Defaults to None.
+
+        Returns:
+            Tuple[list[str], list[torch.Tensor]]: List of generated text sequences and the corresponding token IDs
+        """
+        tokenizer = self.llava_model.processor.tokenizer
+        llava_model = self.llava_model.llava_model
+
+        if mask_tokens is None:
+            mask_tokens = self.adapter(torch.cat([pos_mask_embeds, neg_mask_embeds]).to(self.device))
+        new_tokens = mask_tokens.to(self.device)
+        self.llava_model.add_tokens(new_tokens)
+
+        try:
+            prompts = [self._generation_prompt(text) for text in texts]
+            # the prompts only differ after the image token
+            split = prompts[0].index("<image>") + len("<image>")
+            prefix_inputs = self.llava_model.processor(
+                text=prompts[0][:split],
+                images=image,
+                return_tensors="pt",
+                add_special_tokens=False,
+            ).to(self.device)
+            prefix_cache = llava_model(
+                **prefix_inputs, past_key_values=DynamicCache(), use_cache=True, num_logits_to_keep=1
+            ).past_key_values
+
+            outputs = []
+            tokens = []
+            for prompt in prompts:
+                suffix_ids = tokenizer(prompt[split:], return_tensors="pt", add_special_tokens=False)["input_ids"]
+                input_ids = torch.cat([prefix_inputs["input_ids"], suffix_ids.to(self.device)], dim=1)
+
+                processors = LogitsProcessorList()
+                if repetition_penalty != 1.0:
+                    processors.append(RepetitionPenaltyLogitsProcessor(repetition_penalty))
+                if constrained:
+                    processors += self._mask_selection_kwargs(
+                        {"max_new_tokens": max_new_tokens},
+                        input_ids.size(1),
+                        [(self.llava_model.tokenizer_vocab_size + 1, new_tokens.size(0))],
+                    )["logits_processor"]
+                if do_sample:
+                    processors += self._sampling_warpers(temperature)
+
+                generated_tok = self._decode_with_cache(
+                    copy.deepcopy(prefix_cache), input_ids, input_ids.size(1) - suffix_ids.size(1), processors, max_new_tokens, do_sample
+                )
+                outputs.append(self._decode_generated(generated_tok[0]))
+                tokens.append(generated_tok[0])
+        finally:
             self.llava_model.reset_tokens()
 
-            outputs.append(generated)
-            tokens.append(generated_tok[0])
         return outputs, tokens
 
+    def _sampling_warpers(self, temperature: float) -> LogitsProcessorList:
+        # the warpers generate applies when sampling: temperature, then the top_k and top_p of the generation config
+        generation_config = self.llava_model.llava_model.generation_config
+        warpers = LogitsProcessorList([TemperatureLogitsWarper(temperature)])
+        if generation_config.top_k:
+            warpers.append(TopKLogitsWarper(generation_config.top_k))
+        if generation_config.top_p is not None and generation_config.top_p < 1.0:
+            warpers.append(TopPLogitsWarper(generation_config.top_p))
+        return warpers
+
+    def _decode_with_cache(self, cache, input_ids, n_cached, processors, max_new_tokens, do_sample):
+        """Decode one sequence from a KV cache holding its first n_cached input ids"""
+        llava_model = self.llava_model.llava_model
+        # the image tokens may take more positions in the cache than in the input ids
+        position = cache.get_seq_length()
+        next_input = input_ids[:, n_cached:]
+
+        for _ in range(max_new_tokens):
+            cache_position = torch.arange(position, position + next_input.size(1), device=self.device)
+            logits = llava_model(
+                input_ids=next_input,
+                past_key_values=cache,
+                cache_position=cache_position,
+                position_ids=cache_position.unsqueeze(0),
+                use_cache=True,
+                num_logits_to_keep=1,
+            ).logits
+            position += next_input.size(1)
+
+            scores = processors(input_ids, logits[:, -1].float())
+            if do_sample:
+                next_token = torch.multinomial(torch.softmax(scores, dim=-1), num_samples=1)
+            else:
+                next_token = scores.argmax(dim=-1, keepdim=True)
+            input_ids = torch.cat([input_ids, next_token], dim=1)
+
+            if next_token.item() == self.tokenized_end_token:
+                break
+            next_input = next_token
+        return input_ids
+
     def forward(self, **kwargs):
         if self.training:
             return self.optim_step(**kwargs)
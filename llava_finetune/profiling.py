@@ -0,0 +1,375 @@
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+import numpy as np
+import torch
+
+
+class StageTimer:
+    """
+    Lightweight wall-clock timer of the stages of a step.
+
+    A step is timed with `begin()`, then `lap(name)` after every stage (the time since the previous lap is assigned to
+    the stage) and `end()`. Laps outside of a step are ignored, so the same code can be timed in the training step
+    and left untimed in generation. `stage(name)` times a single block instead.
+    On GPU the device is synchronized before reading the clock, otherwise asynchronous kernels would be assigned to
+    the wrong stage. When disabled every call returns immediately.
+    The calls are forwarded to an optional MemoryTracker, so that the same stages also record their memory.
+    """
+
+    def __init__(self, enabled: bool = False, device: str = None, memory: "MemoryTracker" = None):
+        """
+        Args:
+            enabled (bool, optional): Whether to time the stages. Defaults to False.
+            device (str, optional): Device to synchronize before reading the clock (only cuda devices are synchronized). Defaults to None.
+            memory (MemoryTracker, optional): Tracker recording the memory of the same stages. Defaults to None.
+        """
+        self.enabled = enabled
+        self.sync = device is not None and torch.device(device).type == "cuda"
+        self.memory = memory
+        self.reset()
+
+    def reset(self):
+        """Forget the collected times and counts"""
+        self.times: dict[str, list[float]] = {}
+        self.samples = 0
+        self.tokens = 0
+        self.window_start = time.perf_counter()
+        self._step_start = None
+        self._last = None
+
+    def _now(self) -> float:
+        if self.sync:
+            torch.cuda.synchronize()
+        return time.perf_counter()
+
+    def _record(self, name: str, duration: float):
+        self.times.setdefault(name, []).append(duration)
+
+    def begin(self):
+        """Start timing a step"""
+        if self.memory is not None:
+            self.memory.begin()
+        if not self.enabled:
+            return
+        self._step_start = self._last = self._now()
+
+    def lap(self, name: str):
+        """Assign the time since the previous lap (or the start of the step) to the given stage"""
+        if self.memory is not None:
+            self.memory.lap(name)
+        if not self.enabled or self._last is None:
+            return
+        now = self._now()
+        self._record(name, now - self._last)
+        self._last = now
+
+    def end(self, samples: int = 0, tokens: int = 0):
+        """
+        Stop timing the step and count the processed samples and tokens for the throughput.
+
+        Args:
+            samples (int, optional): Number of samples in the step. Defaults to 0.
+            tokens (int, optional): Number of tokens in the step. Defaults to 0.
+        """
+        if self.memory is not None:
+            self.memory.end()
+        if not self.enabled or self._step_start is None:
+            return
+        self._record("step", self._now() - self._step_start)
+        self.samples += samples
+        self.tokens += tokens
+        self._step_start = self._last = None
+
+    def cancel(self):
+        """Stop timing the step without recording it (e.g. skipped steps)"""
+        if self.memory is not None:
+            self.memory.cancel()
+        self._step_start = self._last = None
+
+    @contextmanager
+    def stage(self, name: str):
+        """Context manager timing the enclosed block as the given stage"""
+        if self.memory is not None:
+            with self.memory.stage(name), self._timed(name):
+                yield
+        else:
+            with self._timed(name):
+                yield
+
+    @contextmanager
+    def _timed(self, name: str):
+        if not self.enabled:
+            yield
+            return
+        start = self._now()
+        try:
+            yield
+        finally:
+            self._record(name, self._now() - start)
+
+    def summary(self, reset: bool = True) -> dict[str, float]:
+        """
+        Aggregate the times collected since the last summary.
+
+        Args:
+            reset (bool, optional): Start a new window after the summary. Defaults to True.
+
+        Returns:
+            dict[str, float]: mean, p50 and p90 time of every stage in milliseconds and samples/tokens per second
+        """
+        elapsed = time.perf_counter() - self.window_start
+        summary = {}
+        for name, times in self.times.items():
+            times_ms = np.asarray(times) * 1000
+            summary[f"time/{name}_mean_ms"] = float(times_ms.mean())
+            summary[f"time/{name}_p50_ms"] = float(np.percentile(times_ms, 50))
+            summary[f"time/{name}_p90_ms"] = float(np.percentile(times_ms, 90))
+        if elapsed > 0:
+            summary["throughput/samples_per_sec"] = self.samples / elapsed
+            summary["throughput/tokens_per_sec"] = self.tokens / elapsed
+        if reset:
+            self.reset()
+        return summary
+
+    @staticmethod
+    def format(summary: dict[str, float]) -> str:
+        """One line per stage with its mean and percentiles, followed by the throughput"""
+        # stages in the order they were first recorded
+        stages = dict.fromkeys(key.split("/")[1].rsplit("_", 2)[0] for key in summary if key.startswith("time/"))
+        lines = [
+            f"{name:>16}: mean {summary[f'time/{name}_mean_ms']:8.2f} ms | "
+            f"p50 {summary[f'time/{name}_p50_ms']:8.2f} ms | p90 {summary[f'time/{name}_p90_ms']:8.2f} ms"
+            for name in stages
+        ]
+        if "throughput/samples_per_sec" in summary:
+            lines.append(
+                f"{'throughput':>16}: {summary['throughput/samples_per_sec']:.2f} samples/s | "
+                f"{summary['throughput/tokens_per_sec']:.1f} tokens/s"
+            )
+        return "\n".join(lines)
+
+
+class MemoryTracker:
+    """
+    Peak memory of the stages of a run, to find the stage that sets the peak and size the batches accordingly.
+
+    Same interface as StageTimer: `begin()`, `lap(name)` after every stage and `end()`, or `stage(name)` around a block.
+    Every stage records the peak, the rise of the peak above the memory at the start of the stage and the change of
+    the resident memory of the process (RSS) and of the memory allocated by torch on the accelerator (cuda devices
+    only), and optionally the rise of the python allocations (tracemalloc, which slows python code down noticeably). The peaks are reset at the start of every stage (the RSS peak through
+    /proc/self/clear_refs, on other systems it is the peak of the whole process). A stage inside another one also
+    counts in the peak of the outer stage. Every thread has its own stages, but the peaks are those of the process:
+    stages running at the same time in different threads share their peaks. When disabled every call returns immediately.
+    """
+
+    METRICS = ("rss_peak_mb", "rss_rise_mb", "rss_delta_mb", "cuda_peak_mb", "cuda_rise_mb", "cuda_delta_mb", "py_rise_mb")
+    # metrics whose maximum over the calls of a stage is reported, the mean is reported for the others
+    PEAK_METRICS = ("rss_peak_mb", "rss_rise_mb", "cuda_peak_mb", "cuda_rise_mb", "py_rise_mb")
+
+    def __init__(self, enabled: bool = False, device: str = None, tracemalloc: bool = False):
+        """
+        Args:
+            enabled (bool, optional): Whether to record the memory of the stages. Defaults to False.
+            device (str, optional): Device whose memory is recorded (only cuda devices are). Defaults to None.
+            tracemalloc (bool, optional): Also record the python allocations with tracemalloc. Defaults to False.
+        """
+        self.enabled = enabled
+        self.cuda = device is not None and torch.device(device).type == "cuda" and torch.cuda.is_available()
+        self.device = device
+        self.tracemalloc = tracemalloc
+        self.reset()
+
+    def reset(self):
+        """Forget the recorded stages"""
+        self.records: dict[str, list[dict[str, float]]] = {}
+        # frames of the stages being measured by every thread (the innermost last) and whether it is in a step
+        self._local = threading.local()
+
+    @property
+    def _frames(self) -> list[dict]:
+        if not hasattr(self._local, "frames"):
+            self._local.frames = []
+        return self._local.frames
+
+    @property
+    def _in_step(self) -> bool:
+        return getattr(self._local, "in_step", False)
+
+    @_in_step.setter
+    def _in_step(self, value: bool):
+        self._local.in_step = value
+
+    @staticmethod
+    def _rss() -> tuple[float, float]:
+        """Current and peak resident memory of the process in MiB"""
+        try:
+            with open("/proc/self/status") as f:
+                status = {line.split(":")[0]: line.split()[1] for line in f if line.startswith(("VmRSS", "VmHWM"))}
+            return int(status["VmRSS"]) / 1024, int(status["VmHWM"]) / 1024
+        except (OSError, KeyError):
+            import resource
+
+            # peak of the whole process, the current RSS is not available
+            peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+            return peak, peak
+
+    def _read(self) -> dict[str, float]:
+        current, peak = self._rss()
+        values = {"rss": current, "rss_peak": peak}
+        if self.cuda:
+            values["cuda"] = torch.cuda.memory_allocated(self.device) / 2**20
+            values["cuda_peak"] = torch.cuda.max_memory_allocated(self.device) / 2**20
+        if self.tracemalloc:
+            import tracemalloc
+
+            values["py"], values["py_peak"] = (v / 2**20 for v in tracemalloc.get_traced_memory())
+        return values
+
+    def _reset_peaks(self):
+        try:
+            with open("/proc/self/clear_refs", "w") as f:
+                f.write("5")
+        except OSError:
+            pass
+        if self.cuda:
+            torch.cuda.reset_peak_memory_stats(self.device)
+        if self.tracemalloc:
+            import tracemalloc
+
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+            tracemalloc.reset_peak()
+
+    @staticmethod
+    def _fold_peaks(frame: dict, values: dict[str, float]):
+        for key in ("rss_peak", "cuda_peak", "py_peak"):
+            if key in values:
+                frame["peaks"][key] = max(frame["peaks"].get(key, 0.0), values[key])
+
+    def _push(self):
+        # the peaks are about to be reset, keep the one of the enclosing stage so far
+        if self._frames:
+            self._fold_peaks(self._frames[-1], self._read())
+        self._reset_peaks()
+        self._frames.append({"start": self._read(), "peaks": {}})
+
+    def _pop(self, name: str = None):
+        frame = self._frames.pop()
+        values = self._read()
+        self._fold_peaks(frame, values)
+        if self._frames:
+            self._fold_peaks(self._frames[-1], frame["peaks"])
+        if name is None:
+            return
+
+        start, peaks = frame["start"], frame["peaks"]
+        record = {
+            "rss_peak_mb": peaks["rss_peak"],
+            "rss_rise_mb": peaks["rss_peak"] - start["rss"],
+            "rss_delta_mb": values["rss"] - start["rss"],
+        }
+        if self.cuda:
+            record.update(
+                cuda_peak_mb=peaks["cuda_peak"],
+                cuda_rise_mb=peaks["cuda_peak"] - start["cuda"],
+                cuda_delta_mb=values["cuda"] - start["cuda"],
+            )
+        if self.tracemalloc:
+            record["py_rise_mb"] = peaks["py_peak"] - start["py"]
+        self.records.setdefault(name, []).append(record)
+
+    def begin(self):
+        """Start measuring a step"""
+        if not self.enabled:
+            return
+        if self._in_step:
+            # the previous step was never ended
+            self._pop()
+        self._push()
+        self._in_step = True
+
+    def lap(self, name: str):
+        """Record the memory since the previous lap (or the start of the step) as the given stage"""
+        if not self.enabled or not self._in_step:
+            return
+        self._pop(name)
+        self._push()
+
+    def end(self):
+        """Stop measuring the step"""
+        if not self.enabled or not self._in_step:
+            return
+        self._pop()
+        self._in_step = False
+
+    cancel = end
+
+    @contextmanager
+    def stage(self, name: str):
+        """Context manager recording the memory of the enclosed block as the given stage"""
+        if not self.enabled:
+            yield
+            return
+        self._push()
+        try:
+            yield
+        finally:
+            self._pop(name)
+
+    def report(self) -> dict:
+        """
+        Aggregate the recorded stages.
+
+        Returns:
+            dict: for every stage ("stages") the number of calls, the maximum of the peaks and rises and the mean of the
+                  changes, and for every peak and rise metric the stage that sets it ("peaks")
+        """
+        stages = {}
+        for name, records in self.records.items():
+            stage = {"calls": len(records)}
+            for metric in self.METRICS:
+                values = [r[metric] for r in records if metric in r]
+                if values:
+                    stage[metric] = float(max(values) if metric in self.PEAK_METRICS else np.mean(values))
+            stages[name] = stage
+
+        peaks = {}
+        for metric in self.PEAK_METRICS:
+            measured = {name: stage[metric] for name, stage in stages.items() if metric in stage}
+            if measured:
+                name = max(measured, key=measured.get)
+                peaks[metric] = {"stage": name, "mb": measured[name]}
+        return {"stages": stages, "peaks": peaks}
+
+    def summary(self) -> dict[str, float]:
+        """Flat version of the report for wandb: memory/<stage>_<metric>"""
+        return {
+            f"memory/{name}_{metric}": value
+            for name, stage in self.report()["stages"].items()
+            for metric, value in stage.items()
+            if metric != "calls"
+        }
+
+    def save(self, path: str, verbose: bool = True):
+        """Save the report as JSON (and print it if verbose)"""
+        report = self.report()
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with open(path, "w") as f:
+            json.dump(report, f, indent=2)
+        if verbose:
+            print(f"Peak memory per stage (saved to {path}):\n{self.format(report)}")
+
+    @staticmethod
+    def format(report: dict) -> str:
+        """One line per stage with its peaks and changes, followed by the stages setting each peak"""
+        lines = []
+        for name, stage in report["stages"].items():
+            values = " | ".join(f"{metric} {stage[metric]:9.1f}" for metric in MemoryTracker.METRICS if metric in stage)
+            lines.append(f"{name:>16}: {values} ({stage['calls']} calls)")
+        for metric, peak in report["peaks"].items():
+            lines.append(f"{'peak ' + metric:>16}: {peak['mb']:.1f} MiB in {peak['stage']}")
+        return "\n".join(lines)
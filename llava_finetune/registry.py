@@ -0,0 +1,192 @@
+import glob
+import inspect
+import json
+import os
+import threading
+from contextlib import contextmanager
+
+import torch
+
+from llava_finetune.model import LISA_Model, SegAdapter, build_lora_config
+
+# Parameters of LISA_Model.__init__ and their defaults (everything else is forwarded to the SegAdapter)
+LISA_PARAMS = {
+    name: param.default
+    for name, param in inspect.signature(LISA_Model.__init__).parameters.items()
+    if name not in ("self", "adapter_kwargs")
+}
+# Parameters that have to match for two models to share the same LLava base model
+BASE_PARAMS = ("model_name", "seg_emb_size", "q4", "q8")
+# Prefix of the peft model inside the LISA_Model state dict
+PEFT_PREFIX = "llava_model.llava_model."
+
+
+def split_model_params(model_params: dict) -> tuple[dict, dict]:
+    """
+    Split the parameters saved by run_experiment into LISA_Model parameters and SegAdapter parameters
+
+    Args:
+        model_params (dict): content of the models/<name>.json file
+
+    Returns:
+        tuple[dict, dict]: LISA_Model keyword arguments and SegAdapter keyword arguments
+    """
+    lisa_kwargs = {k: v for k, v in model_params.items() if k in LISA_PARAMS}
+    adapter_kwargs = {k: v for k, v in model_params.items() if k not in LISA_PARAMS}
+    return lisa_kwargs, adapter_kwargs
+
+
+class ModelRegistry:
+    """
+    Serve several finetuned LISA models from a single LLava base model.
+
+    All the models trained by run_experiment share the same (quantized) LLava weights and only differ in their
+    LoRA weights and SegAdapter. The registry loads the base model once and attaches each registered model as a
+    named peft adapter plus its own SegAdapter, switching between them without reloading anything.
+    """
+
+    def __init__(self, models_dir: str = "models", device: str = None, dtype: torch.dtype = None):
+        """
+        Args:
+            models_dir (str, optional): Directory containing the <name>.pth and <name>.json files. Defaults to "models".
+            device (str, optional): Device to load the models on. Defaults to cuda if available, else cpu.
+            dtype (torch.dtype, optional): dtype of the LLava weights of the base model. Defaults to the one of the checkpoint.
+        """
+        self.models_dir = models_dir
+        self.device = device or ("cuda" if torch.cuda.is_available() else "cpu")
+        self.dtype = dtype
+
+        self.base: LISA_Model = None
+        self.base_params: dict = None
+        self.adapters: dict[str, SegAdapter] = {}
+        self.settings: dict[str, dict] = {}
+        self.active: str = None
+
+        # guards both registration and the active model, the base model is shared by every request
+        self.lock = threading.RLock()
+
+    def available(self) -> list[str]:
+        """Names of the models in models_dir that can be registered"""
+        return sorted(
+            os.path.basename(p).removesuffix(".pth")
+            for p in glob.glob(os.path.join(self.models_dir, "*.pth"))
+            if os.path.exists(p.removesuffix(".pth") + ".json")
+        )
+
+    def register_all(self):
+        """Register every model available in models_dir"""
+        for name in self.available():
+            self.register(name)
+
+    def register(self, name: str):
+        """
+        Attach the LoRA weights and SegAdapter of a trained model to the shared base model.
+
+        Args:
+            name (str): name of the model, the files models_dir/<name>.pth and models_dir/<name>.json must exist
+        """
+        with self.lock:
+            if name in self.adapters:
+                return
+
+            model_path = os.path.join(self.models_dir, f"{name}.pth")
+            params_path = os.path.join(self.models_dir, f"{name}.json")
+            if not os.path.exists(model_path):
+                raise FileNotFoundError(f"Model file not found at: {model_path}")
+            with open(params_path, "r") as file:
+                model_params = json.load(file)
+            lisa_kwargs, adapter_kwargs = split_model_params(model_params)
+
+            if self.base is None:
+                self._load_base(model_params)
+            else:
+                mismatch = [
+                    k for k in BASE_PARAMS
+                    if lisa_kwargs.get(k, LISA_PARAMS[k]) != self.base_params[k]
+                ]
+                if mismatch:
+                    raise ValueError(
+                        f"Model '{name}' does not share the base model of the registry (mismatch on {', '.join(mismatch)})"
+                    )
+
+            print(f"Registering model '{name}'")
+            state_dict = torch.load(model_path, map_location="cpu")
+            peft_model = self.base.llava_model.llava_model
+
+            # LoRA weights become a named peft adapter (they are saved under the "default" adapter name)
+            peft_model.add_adapter(name, build_lora_config(lisa_kwargs.get("lora_rank", LISA_PARAMS["lora_rank"])))
+            lora_state = {
+                k.removeprefix(PEFT_PREFIX).replace(".default.", f".{name}."): v
+                for k, v in state_dict.items()
+                if k.startswith(PEFT_PREFIX) and "lora_" in k
+            }
+            unexpected = peft_model.load_state_dict(lora_state, strict=False).unexpected_keys
+            if unexpected:
+                raise ValueError(f"Unexpected LoRA weights for model '{name}': {unexpected[:5]}")
+
+            adapter = SegAdapter(
+                model_params["seg_emb_size"],
+                peft_model.get_input_embeddings().weight.size(1),
+                dropout=lisa_kwargs.get("dropout", LISA_PARAMS["dropout"]),
+                **adapter_kwargs,
+            )
+            adapter.load_state_dict(
+                {k.removeprefix("adapter."): v for k, v in state_dict.items() if k.startswith("adapter.")}
+            )
+            self.adapters[name] = adapter.to(self.device).eval()
+
+            end_token = lisa_kwargs.get("end_turn_token", LISA_PARAMS["end_turn_token"])
+            self.settings[name] = {
+                "seg_pos": lisa_kwargs.get("seg_pos", LISA_PARAMS["seg_pos"]),
+                "text": lisa_kwargs.get("text", LISA_PARAMS["text"]),
+                "end_token": end_token,
+                "tokenized_end_token": self.base.llava_model.processor.tokenizer.encode(
+                    end_token, add_special_tokens=False
+                )[0],
+            }
+
+            # the adapter created with the base model is not used by any registered model
+            if "default" in peft_model.peft_config:
+                peft_model.set_adapter(name)
+                peft_model.base_model.delete_adapter("default")
+                self.active = None
+
+    def activate(self, name: str) -> LISA_Model:
+        """
+        Switch the shared model to the given registered model (registering it if needed).
+
+        Callers sharing the registry between threads should use `use` instead, which holds the lock.
+
+        Args:
+            name (str): name of the model
+
+        Returns:
+            LISA_Model: the shared model with the LoRA weights and SegAdapter of the requested model
+        """
+        with self.lock:
+            if name not in self.adapters:
+                self.register(name)
+            if self.active != name:
+                self.base.llava_model.llava_model.set_adapter(name)
+                self.base.adapter = self.adapters[name]
+                for attr, value in self.settings[name].items():
+                    setattr(self.base, attr, value)
+                self.active = name
+            return self.base
+
+    @contextmanager
+    def use(self, name: str):
+        """
+        Context manager giving exclusive access to the shared model switched to the given model.
+
+        Args:
+            name (str): name of the model
+        """
+        with self.lock:
+            yield self.activate(name)
+
+    def _load_base(self, model_params: dict):
+        print("Initializing the shared base model")
+        self.base = LISA_Model(**{**model_params, "device": self.device, "dtype": self.dtype})
+        self.base.eval()
+        self.base_params = {k: model_params.get(k, LISA_PARAMS[k]) for k in BASE_PARAMS}
@@ -0,0 +1,296 @@
+import copy
+import csv
+import itertools
+import math
+import os
+import queue
+import random
+import traceback
+
+import numpy as np
+import torch
+import torch.multiprocessing as mp
+
+from llava_finetune.functions import run_experiment
+from llava_finetune.utils import make_dataloaders
+
+# Columns of the results table, followed by the swept parameters
+RESULT_COLUMNS = [
+    "name", "status", "device", "epochs", "best_val_f1", "val_f1", "val_accuracy", "val_precision", "val_recall",
+    "test_f1", "test_accuracy", "test_precision", "test_recall", "error",
+]
+
+# Seconds between two checks that the workers are still alive while waiting for results
+WORKER_POLL_SECONDS = 10
+
+
+# ==========================
+# 1. Sweep Definition
+# ==========================
+def set_dotted(config: dict, key: str, value):
+    """Set a nested value of a config dictionary from a dotted key (e.g. "optimizer.adapter_lr")"""
+    *parents, last = key.split(".")
+    for parent in parents:
+        config = config.setdefault(parent, {})
+    config[last] = value
+
+
+def expand_grid(base_config: dict, grid: dict = None, configs: list[dict] = None) -> list[tuple[str, dict, dict]]:
+    """
+    Build the experiment configurations of a sweep.
+
+    Args:
+        base_config (dict): experiment configuration shared by every run (same format as in train.py)
+        grid (dict, optional): dotted keys and the list of values to try, every combination is a run. Defaults to None.
+        configs (list[dict], optional): explicit list of dotted key overrides, one run each. Defaults to None.
+
+    Returns:
+        list[tuple[str, dict, dict]]: name, full experiment configuration and overridden parameters of each run
+    """
+    overrides = list(configs or [])
+    if grid:
+        keys = list(grid)
+        overrides += [dict(zip(keys, values)) for values in itertools.product(*grid.values())]
+    if not overrides:
+        overrides = [{}]
+
+    runs = []
+    for i, params in enumerate(overrides):
+        exp_config = copy.deepcopy(base_config)
+        for key, value in params.items():
+            set_dotted(exp_config, key, value)
+        runs.append((f"run{i:03d}", exp_config, params))
+    return runs
+
+
+def rung_epochs(max_epochs: int, min_epochs: int, reduction_factor: int) -> list[int]:
+    """
+    Epochs at which the runs are compared in successive halving, the budget grows by reduction_factor every rung.
+
+    Args:
+        max_epochs (int): epochs of a full run
+        min_epochs (int): epochs trained by every run before the first comparison
+        reduction_factor (int): a run goes to the next rung only if it is in the best 1/reduction_factor
+
+    Returns:
+        list[int]: epochs of each rung, the last one is always max_epochs
+    """
+    rungs = []
+    epochs = max(1, min_epochs)
+    while epochs < max_epochs:
+        rungs.append(epochs)
+        epochs *= reduction_factor
+    return rungs + [max_epochs]
+
+
+def available_slots(cpu_slots: int = None, runs_per_gpu: int = 1) -> list[str]:
+    """
+    Devices of the sweep workers, one entry per run that can be trained at the same time.
+
+    Args:
+        cpu_slots (int, optional): number of CPU workers when there is no GPU. Defaults to half the CPU cores.
+        runs_per_gpu (int, optional): runs trained at the same time on each GPU. Defaults to 1.
+
+    Returns:
+        list[str]: device of every worker
+    """
+    if torch.cuda.is_available():
+        return [f"cuda:{i}" for i in range(torch.cuda.device_count()) for _ in range(runs_per_gpu)]
+    return ["cpu"] * (cpu_slots or max(1, (os.cpu_count() or 2) // 2))
+
+
+# ==========================
+# 2. Workers
+# ==========================
+def _worker(slot, device, threads, datasets, loader_params, config, jobs, results):
+    """
+    Train the jobs of the queue on a device until it gets None, the datasets are shared with the other workers.
+    Every job is announced with ("started", slot, name) and ends with ("done", slot, name, metrics, error).
+    """
+    if device == "cpu":
+        torch.set_num_threads(threads)
+    else:
+        torch.cuda.set_device(device)
+    data_loaders = make_dataloaders(datasets, **loader_params)
+
+    while (job := jobs.get()) is not None:
+        name, exp_config, stop_at_epoch, resume = job
+        results.put(("started", slot, name))
+        # a run always starts from the same seed, when it is continued the RNG comes from its checkpoint
+        seed = loader_params.get("seed", 42)
+        torch.manual_seed(seed)
+        random.seed(seed)
+        np.random.seed(seed)
+        try:
+            metrics = run_experiment(
+                exp_name=name,
+                exp_config=exp_config,
+                config=config,
+                data_loaders=data_loaders,
+                resume=resume,
+                device=device,
+                stop_at_epoch=stop_at_epoch,
+            )
+            results.put(("done", slot, name, metrics, None))
+        except Exception:
+            results.put(("done", slot, name, None, traceback.format_exc()))
+        finally:
+            if device != "cpu":
+                torch.cuda.empty_cache()
+
+
+# ==========================
+# 3. Successive Halving
+# ==========================
+def write_results(path: str, trials: list[dict], param_keys: list[str]):
+    """Write the results table of the sweep as a csv file (rewritten after every rung)"""
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=RESULT_COLUMNS + param_keys, extrasaction="ignore")
+        writer.writeheader()
+        for trial in sorted(trials, key=lambda t: t.get("best_val_f1") or 0, reverse=True):
+            writer.writerow({**trial, **trial["params"]})
+    os.replace(tmp_path, path)
+
+
+def _fail(trial: dict, error: str):
+    print(f"Run {trial['name']} failed:\n{error}")
+    trial.update({"status": "failed", "error": error.strip().splitlines()[-1]})
+
+
+def _collect_results(trials: dict, pending: set, workers: list, slots: list, results):
+    """
+    Wait for the results of the pending runs of a rung.
+
+    A worker that dies without reporting (killed for lack of memory, crash of the CUDA driver) fails the run it was
+    training, and when no worker is left the runs still in the queue fail as well instead of waiting forever.
+    """
+    running = {}
+    while pending:
+        try:
+            message = results.get(timeout=WORKER_POLL_SECONDS)
+        except queue.Empty:
+            for slot, worker in enumerate(workers):
+                if not worker.is_alive() and slot in running:
+                    name = running.pop(slot)
+                    pending.discard(name)
+                    _fail(trials[name], f"Worker on {slots[slot]} exited with code {worker.exitcode}")
+            if not any(worker.is_alive() for worker in workers):
+                for name in pending:
+                    _fail(trials[name], "No sweep worker left to train the run")
+                pending.clear()
+            continue
+
+        kind, slot, name, *outcome = message
+        trials[name]["device"] = slots[slot]
+        if kind == "started":
+            running[slot] = name
+            continue
+        running.pop(slot, None)
+        pending.discard(name)
+        metrics, error = outcome
+        if error is not None:
+            _fail(trials[name], error)
+        else:
+            trials[name].update(metrics)
+
+
+def run_sweep(
+    sweep_name,
+    runs,
+    config,
+    datasets,
+    batch_size=2,
+    eval_batch_size=None,
+    seed=42,
+    min_epochs=1,
+    reduction_factor=2,
+    slots=None,
+    resume=False,
+    results_dir="sweeps",
+):
+    """
+    Train several experiment configurations concurrently and stop the worst ones early with successive halving.
+
+    Every run trains up to the epochs of the current rung, then only the best 1/reduction_factor runs by validation
+    F1 continue (from their training state checkpoint) to the next rung, until the survivors reach the full number
+    of epochs and are tested. Runs are distributed over one worker process per slot, the datasets are loaded once
+    and shared with the workers through shared memory.
+
+    Args:
+        sweep_name (str): name of the sweep, the runs are saved as models/<sweep_name>_<run>.pth
+        runs (list[tuple[str, dict, dict]]): runs built by expand_grid
+        config (ProjectConfig): Global configuration object loaded from YAML.
+        datasets (tuple): training, validation, and test datasets
+        batch_size (int, optional): batch size of the data loaders. Defaults to 2.
+        eval_batch_size (int, optional): batch size of the validation and test data loaders. Defaults to batch_size.
+        seed (int, optional): seed of the runs and of the training data order. Defaults to 42.
+        min_epochs (int, optional): epochs trained by every run before the first comparison. Defaults to 1.
+        reduction_factor (int, optional): fraction (1/reduction_factor) of the runs kept at every rung. Defaults to 2.
+        slots (list[str], optional): device of every worker. Defaults to available_slots().
+        resume (bool, optional): continue the runs of an interrupted sweep from their checkpoints. Defaults to False.
+        results_dir (str, optional): directory of the results table. Defaults to "sweeps".
+
+    Returns:
+        list[dict]: status, metrics and parameters of every run
+    """
+    slots = slots or available_slots()
+    max_epochs = max(exp_config["epochs"] for _, exp_config, _ in runs)
+    rungs = rung_epochs(max_epochs, min_epochs, reduction_factor)
+
+    os.makedirs(results_dir, exist_ok=True)
+    results_path = os.path.join(results_dir, f"{sweep_name}.csv")
+    param_keys = sorted({key for _, _, params in runs for key in params})
+    trials = {
+        f"{sweep_name}_{name}": {"name": f"{sweep_name}_{name}", "status": "running", "params": params, "exp_config": exp_config}
+        for name, exp_config, params in runs
+    }
+
+    # many small tensors are shared, file descriptors would run out with the default strategy
+    mp.set_sharing_strategy("file_system")
+    for dataset in datasets:
+        dataset.share_memory()
+
+    ctx = mp.get_context("spawn")
+    jobs, results = ctx.Queue(), ctx.Queue()
+    threads = max(1, (os.cpu_count() or 1) // len(slots))
+    loader_params = {"batch_size": batch_size, "eval_batch_size": eval_batch_size, "seed": seed}
+    workers = [
+        ctx.Process(target=_worker, args=(slot, device, threads, datasets, loader_params, config, jobs, results), daemon=True)
+        for slot, device in enumerate(slots)
+    ]
+    for worker in workers:
+        worker.start()
+    print(f"Sweep {sweep_name}: {len(trials)} runs on {len(slots)} workers, rungs at epochs {rungs}")
+
+    try:
+        for rung, epochs in enumerate(rungs):
+            alive = [t for t in trials.values() if t["status"] == "running"]
+            # a single survivor does not need intermediate comparisons anymore
+            if len(alive) == 1 and epochs != rungs[-1]:
+                continue
+            print(f"Rung {rung + 1}/{len(rungs)}: training {len(alive)} runs up to epoch {epochs}")
+
+            for trial in alive:
+                jobs.put((trial["name"], trial["exp_config"], epochs, resume or rung > 0))
+            _collect_results(trials, {t["name"] for t in alive}, workers, slots, results)
+
+            survivors = sorted(
+                (t for t in alive if t["status"] == "running"), key=lambda t: t.get("best_val_f1") or 0, reverse=True
+            )
+            if epochs == rungs[-1]:
+                for trial in survivors:
+                    trial["status"] = "completed"
+            else:
+                keep = max(1, math.ceil(len(survivors) / reduction_factor))
+                for trial in survivors[keep:]:
+                    trial["status"] = f"pruned@{epochs}"
+            write_results(results_path, list(trials.values()), param_keys)
+    finally:
+        for _ in workers:
+            jobs.put(None)
+        for worker in workers:
+            worker.join()
+
+    print(f"Sweep results saved to {results_path}")
+    return list(trials.values())
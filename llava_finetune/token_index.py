@@ -0,0 +1,234 @@
+import os
+
+import torch
+
+METRICS = ("ip", "cosine")
+# default location of the index of each metric, built with token_index.py
+INDEX_PATH = "models/token_index_{metric}.pt"
+
+
+def kmeans(x: torch.Tensor, n_clusters: int, iters: int = 20, seed: int = 0, batch_size: int = 16384) -> torch.Tensor:
+    """
+    Euclidean k-means.
+
+    Args:
+        x (torch.Tensor): vectors to cluster (N, D)
+        n_clusters (int): number of clusters
+        iters (int, optional): number of Lloyd iterations. Defaults to 20.
+        seed (int, optional): seed of the initial centroids. Defaults to 0.
+        batch_size (int, optional): vectors assigned at a time, bounds the size of the distance matrix. Defaults to 16384.
+
+    Returns:
+        torch.Tensor: centroids (n_clusters, D)
+    """
+    generator = torch.Generator().manual_seed(seed)
+    centroids = x[torch.randperm(len(x), generator=generator)[:n_clusters].to(x.device)].clone()
+    for _ in range(iters):
+        assign = assign_clusters(x, centroids, batch_size)
+        sums = torch.zeros_like(centroids).index_add_(0, assign, x)
+        counts = torch.bincount(assign, minlength=n_clusters).unsqueeze(1)
+        # empty clusters keep their previous centroid
+        centroids = torch.where(counts > 0, sums / counts.clamp(min=1), centroids)
+    return centroids
+
+
+def assign_clusters(x: torch.Tensor, centroids: torch.Tensor, batch_size: int = 16384) -> torch.Tensor:
+    """Index of the nearest centroid of every vector"""
+    norms = (centroids**2).sum(1)
+    # ||x - c||^2 = ||x||^2 - 2 x.c + ||c||^2, the first term does not change the argmin
+    return torch.cat([(norms - 2 * x[i : i + batch_size] @ centroids.T).argmin(1) for i in range(0, len(x), batch_size)])
+
+
+class TokenIndex:
+    """
+    Approximate nearest-neighbour index (IVF with product quantization) over the embedding matrix of the vocabulary.
+
+    The embeddings are split in n_lists clusters (inverted lists) and the residual of every embedding with respect to
+    its cluster centroid is compressed with a product quantizer: the residual is cut in n_subvectors pieces and each
+    piece is replaced by the index of its nearest codeword (256 per piece, one byte). A query only scores the tokens of
+    the n_probe clusters with the most similar centroids, using lookup tables of the query pieces with the codewords,
+    and the best candidates can be rescored exactly with the original matrix.
+
+    With the "cosine" metric the embeddings and the queries are normalized, with "ip" the raw inner product is used.
+    """
+
+    def __init__(self, metric: str, centroids: torch.Tensor, codebooks: torch.Tensor, codes: torch.Tensor, token_ids: torch.Tensor, offsets: torch.Tensor):
+        """
+        Args:
+            metric (str): "ip" or "cosine"
+            centroids (torch.Tensor): centroids of the inverted lists (n_lists, D)
+            codebooks (torch.Tensor): codewords of every piece of the residuals (n_subvectors, 256, D / n_subvectors)
+            codes (torch.Tensor): codes of the tokens sorted by inverted list (V, n_subvectors) uint8
+            token_ids (torch.Tensor): token id of every row of codes (V,)
+            offsets (torch.Tensor): start of every inverted list in codes, followed by V (n_lists + 1,)
+        """
+        if metric not in METRICS:
+            raise ValueError(f"Unknown metric {metric}, expected one of {METRICS}")
+        self.metric = metric
+        self.centroids = centroids
+        self.codebooks = codebooks
+        self.codes = codes
+        self.token_ids = token_ids
+        self.offsets = offsets
+
+    @classmethod
+    def build(
+        cls,
+        emb_matrix: torch.Tensor,
+        metric: str = "cosine",
+        n_lists: int = 1024,
+        n_subvectors: int = 64,
+        train_size: int = 65536,
+        iters: int = 20,
+        seed: int = 0,
+    ) -> "TokenIndex":
+        """
+        Train the index on the embedding matrix and encode all the tokens.
+
+        Args:
+            emb_matrix (torch.Tensor): embeddings of the vocabulary (V, D)
+            metric (str, optional): "ip" or "cosine". Defaults to "cosine".
+            n_lists (int, optional): number of inverted lists. Defaults to 1024.
+            n_subvectors (int, optional): number of pieces of the product quantizer, must divide D. Defaults to 64.
+            train_size (int, optional): number of embeddings used to train the quantizers. Defaults to 65536.
+            iters (int, optional): k-means iterations. Defaults to 20.
+            seed (int, optional): seed of the training sample and of the k-means initialization. Defaults to 0.
+
+        Returns:
+            TokenIndex: the built index
+        """
+        if metric not in METRICS:
+            raise ValueError(f"Unknown metric {metric}, expected one of {METRICS}")
+        x = emb_matrix.float()
+        if metric == "cosine":
+            x = torch.nn.functional.normalize(x, dim=1)
+        n_tokens, dim = x.shape
+        if dim % n_subvectors != 0:
+            raise ValueError(f"n_subvectors ({n_subvectors}) must divide the embedding size ({dim})")
+
+        generator = torch.Generator().manual_seed(seed)
+        train = x[torch.randperm(n_tokens, generator=generator)[:train_size].to(x.device)]
+
+        centroids = kmeans(train, n_lists, iters, seed)
+        train_residuals = (train - centroids[assign_clusters(train, centroids)]).view(len(train), n_subvectors, -1)
+        codebooks = torch.stack([kmeans(train_residuals[:, m], 256, iters, seed + m + 1) for m in range(n_subvectors)])
+
+        assign = assign_clusters(x, centroids)
+        residuals = (x - centroids[assign]).view(n_tokens, n_subvectors, -1)
+        codes = torch.stack(
+            [assign_clusters(residuals[:, m], codebooks[m]) for m in range(n_subvectors)], dim=1
+        ).to(torch.uint8)
+
+        # tokens sorted by inverted list, every list is a contiguous slice
+        order = torch.argsort(assign, stable=True)
+        offsets = torch.zeros(n_lists + 1, dtype=torch.long, device=x.device)
+        offsets[1:] = torch.cumsum(torch.bincount(assign, minlength=n_lists), 0)
+        return cls(metric, centroids, codebooks, codes[order], order, offsets)
+
+    def to(self, device) -> "TokenIndex":
+        """Move the index to the given device"""
+        for name in ("centroids", "codebooks", "codes", "token_ids", "offsets"):
+            setattr(self, name, getattr(self, name).to(device))
+        return self
+
+    def save(self, path: str):
+        """Save the index to a file"""
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        torch.save(
+            {
+                "metric": self.metric,
+                "centroids": self.centroids.cpu(),
+                "codebooks": self.codebooks.cpu(),
+                "codes": self.codes.cpu(),
+                "token_ids": self.token_ids.cpu(),
+                "offsets": self.offsets.cpu(),
+            },
+            path,
+        )
+
+    @classmethod
+    def load(cls, path: str, device: str = "cpu") -> "TokenIndex":
+        """Load an index saved with save"""
+        return cls(**torch.load(path, map_location="cpu")).to(device)
+
+    def search(
+        self,
+        queries: torch.Tensor,
+        k: int = 10,
+        n_probe: int = 16,
+        rerank: int = 0,
+        emb_matrix: torch.Tensor = None,
+    ) -> tuple[torch.Tensor, torch.Tensor]:
+        """
+        Approximate top-k tokens of every query.
+
+        Args:
+            queries (torch.Tensor): query embeddings (Q, D)
+            k (int, optional): number of tokens to return. Defaults to 10.
+            n_probe (int, optional): number of inverted lists scored for every query. Defaults to 16.
+            rerank (int, optional): number of candidates rescored exactly with emb_matrix, 0 to return the approximate scores. Defaults to 0.
+            emb_matrix (torch.Tensor, optional): embeddings of the vocabulary, required to rerank. Defaults to None.
+
+        Returns:
+            tuple[torch.Tensor, torch.Tensor]: scores and token ids of the top-k tokens of every query (Q, k), best first
+        """
+        q = queries.float().to(self.centroids.device)
+        if self.metric == "cosine":
+            q = torch.nn.functional.normalize(q, dim=1)
+        n_subvectors = self.codebooks.size(0)
+
+        coarse = q @ self.centroids.T
+        probes = coarse.topk(min(n_probe, len(self.centroids)), dim=1).indices
+        # lookup tables: inner product of every piece of the query with every codeword (Q, n_subvectors, 256)
+        tables = torch.einsum("qmd,mcd->qmc", q.view(len(q), n_subvectors, -1), self.codebooks)
+        pieces = torch.arange(n_subvectors, device=q.device)
+
+        all_scores, all_ids = [], []
+        for i in range(len(q)):
+            rows = torch.cat([torch.arange(self.offsets[l], self.offsets[l + 1], device=q.device) for l in probes[i].tolist()])
+            list_of_row = torch.repeat_interleave(probes[i], self.offsets[probes[i] + 1] - self.offsets[probes[i]])
+            # q.x ~ q.centroid + sum over the pieces of q_m.codeword_m
+            scores = coarse[i, list_of_row] + tables[i, pieces, self.codes[rows].long()].sum(1)
+            ids = self.token_ids[rows]
+
+            n_candidates = min(max(rerank, k), len(ids))
+            scores, top = scores.topk(n_candidates)
+            ids = ids[top]
+            if rerank and emb_matrix is not None:
+                candidates = emb_matrix[ids.to(emb_matrix.device)].float().to(q.device)
+                if self.metric == "cosine":
+                    candidates = torch.nn.functional.normalize(candidates, dim=1)
+                scores = candidates @ q[i]
+                scores, top = scores.topk(min(k, len(ids)))
+                ids = ids[top]
+            all_scores.append(scores[:k])
+            all_ids.append(ids[:k])
+        return torch.stack(all_scores), torch.stack(all_ids)
+
+    def exact_search(self, queries: torch.Tensor, emb_matrix: torch.Tensor, k: int = 10) -> tuple[torch.Tensor, torch.Tensor]:
+        """Exact top-k tokens of every query with the same metric as the index"""
+        q = queries.float().to(emb_matrix.device)
+        matrix = emb_matrix.float()
+        if self.metric == "cosine":
+            q = torch.nn.functional.normalize(q, dim=1)
+            matrix = torch.nn.functional.normalize(matrix, dim=1)
+        return (q @ matrix.T).topk(k, dim=1)
+
+    def recall(self, queries: torch.Tensor, emb_matrix: torch.Tensor, k: int = 10, **search_kwargs) -> float:
+        """
+        Recall@k of the approximate search against the exact search.
+
+        Args:
+            queries (torch.Tensor): query embeddings (Q, D)
+            emb_matrix (torch.Tensor): embeddings of the vocabulary (V, D)
+            k (int, optional): number of tokens compared. Defaults to 10.
+            **search_kwargs: arguments of search (n_probe, rerank)
+
+        Returns:
+            float: fraction of the exact top-k tokens found by the approximate search
+        """
+        _, exact = self.exact_search(queries, emb_matrix, k)
+        _, approx = self.search(queries, k, emb_matrix=emb_matrix, **search_kwargs)
+        exact, approx = exact.cpu(), approx.cpu()
+        found = sum(len(set(e.tolist()) & set(a.tolist())) for e, a in zip(exact, approx))
+        return found / exact.numel()
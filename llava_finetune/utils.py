@@ -1,18 +1,23 @@
 import torch
 import json
 import os
+from multiprocessing import Pool
+
+import cv2
+import numpy as np
 from PIL import Image, ImageDraw, ImageFont
-from torch.utils.data import Dataset, DataLoader
+from torch.utils.data import Dataset, DataLoader, Sampler
 import wandb
 
 import matplotlib.pyplot as plt
-import matplotlib.colors as mcolors
+
+from llava_finetune.embeddings import decode_embeddings, dequantize, embedding_bytes, num_embeddings, quantize
 
 # ==========================
 # 1. Dataset Definition
 # ==========================
 class CustomDataset(Dataset):
-    def __init__(self, json_path, image_dir, exp_json_path=None, load_images=False, top_samples=30):
+    def __init__(self, json_path, image_dir, exp_json_path=None, load_images=False, top_samples=30, embedding_encoding="fp32"):
         """Initializes the CustomDataset class.
 
         Args:
@@ -20,10 +25,14 @@ class CustomDataset(Dataset):
             image_dir (str): Path to the directory containing the images.
             exp_json_path (str, optional): Path to the json file containing the explanatory data. Defaults to None.
             load_images (bool, optional): Whether to pre-load the images. Defaults to False.
+            top_samples (int, optional): Number of SAM masks kept per image. Defaults to 30.
+            embedding_encoding (str, optional): Encoding of the embeddings held in memory ("fp32", "fp16" or "int8"),
+                they are dequantized to float32 when a sample is loaded. Defaults to "fp32".
         """
         self.image_dir = image_dir
         self.load_images = load_images
         self.top_samples = top_samples
+        self.embedding_encoding = embedding_encoding
         self.data = self.load_data(json_path, image_dir, exp_json_path)
 
     def load_data(self, json_path, image_dir, exp_json_path):
@@ -48,11 +57,17 @@ class CustomDataset(Dataset):
                 with open(image_json_path, "r") as f2:
                     image_queries = json.load(f2)["text"]
 
-                if (len(sample["gt_embs"]) == 0) or (len(sample["sam_embs"]) == 0):
+                if (num_embeddings(sample["gt_embs"]) == 0) or (num_embeddings(sample["sam_embs"]) == 0):
                     continue
                 
-                gt_classes += len(sample["gt_embs"])
-                sam_classes += len(sample["sam_embs"])
+                gt_embs = decode_embeddings(sample["gt_embs"])
+                sam_embs = decode_embeddings(sample["sam_embs"])[: self.top_samples]
+                # how close every negative is to the target, used to pick the hard negatives during training
+                sam_hardness = negative_hardness(gt_embs, sam_embs)
+                gt_embs, gt_scale = quantize(gt_embs, self.embedding_encoding)
+                sam_embs, sam_scale = quantize(sam_embs, self.embedding_encoding)
+                gt_classes += len(gt_embs)
+                sam_classes += len(sam_embs)
                 
                 data.append(
                     {
@@ -63,13 +78,13 @@ class CustomDataset(Dataset):
                         ),
                         "queries": image_queries,
                         "answer": answers.get(image, None),
-                        "gt_embs": torch.tensor(sample["gt_embs"]).view(
-                            len(sample["gt_embs"]), -1
-                        ),
+                        # scales are None unless the embeddings are stored in int8
+                        "gt_embs": gt_embs,
+                        "gt_embs_scale": gt_scale,
                         "gt_shapes": sample["gt_shapes"],
-                        "sam_embs": torch.tensor(sample["sam_embs"][:self.top_samples]).view(
-                            min(len(sample["sam_embs"]),self.top_samples), -1
-                        ),
+                        "sam_embs": sam_embs,
+                        "sam_embs_scale": sam_scale,
+                        "sam_hardness": sam_hardness,
                         "sam_shapes": sample["sam_shapes"][:self.top_samples],
                     }
                 )
@@ -82,6 +97,30 @@ class CustomDataset(Dataset):
     def __len__(self):
         return len(self.data)
 
+    def embedding_bytes(self):
+        """Memory used by the embeddings of the dataset"""
+        return sum(
+            embedding_bytes(sample[key], sample[f"{key}_scale"]) for sample in self.data for key in ("gt_embs", "sam_embs")
+        )
+
+    def share_memory(self):
+        """Move the embeddings to shared memory so that other processes can use the dataset without copying it.
+        The embeddings of all the samples are packed in one buffer per key and each sample keeps a view on it.
+
+        Returns:
+            CustomDataset: the dataset itself.
+        """
+        for key in ("gt_embs", "gt_embs_scale", "sam_embs", "sam_embs_scale", "sam_hardness"):
+            tensors = [sample[key] for sample in self.data]
+            if not tensors or tensors[0] is None:
+                continue
+            buffer = torch.cat(tensors).share_memory_()
+            offset = 0
+            for sample, tensor in zip(self.data, tensors):
+                sample[key] = buffer.narrow(0, offset, len(tensor))
+                offset += len(tensor)
+        return self
+
     def __getitem__(self, idx):
         sample = self.data[idx]
         image = (
@@ -95,13 +134,120 @@ class CustomDataset(Dataset):
             "image_path": os.path.join(self.image_dir, sample["image"]) if not self.load_images else None,
             "queries": query,
             "answer": sample["answer"],
-            "gt_embs": sample["gt_embs"],
+            "gt_embs": dequantize(sample["gt_embs"], sample["gt_embs_scale"]),
             "gt_shapes": sample["gt_shapes"],
-            "sam_embs": sample["sam_embs"],
+            "sam_embs": dequantize(sample["sam_embs"], sample["sam_embs_scale"]),
+            "sam_hardness": sample["sam_hardness"],
             "sam_shapes": sample["sam_shapes"],
         }
 
 
+def negative_hardness(gt_embs, sam_embs):
+    """Cosine similarity of every SAM embedding (num_sam, dim) to the closest gt embedding (num_gt, dim)"""
+    if len(gt_embs) == 0 or len(sam_embs) == 0:
+        return torch.zeros(len(sam_embs))
+    similarity = torch.nn.functional.normalize(sam_embs, dim=-1) @ torch.nn.functional.normalize(gt_embs, dim=-1).T
+    return similarity.max(dim=1).values
+
+
+class ResumableSampler(Sampler):
+    """
+    Shuffling sampler whose order only depends on the seed and the epoch,
+    so that an interrupted epoch can be resumed from any batch with the same order.
+    When training with several processes each one gets its own shard of the same order.
+    """
+
+    def __init__(self, data_source, shuffle=True, seed=0, num_replicas=1, rank=0, pad=True):
+        """
+        Args:
+            data_source (Dataset): dataset to sample from.
+            shuffle (bool, optional): whether to shuffle the indices every epoch. Defaults to True.
+            seed (int, optional): seed of the shuffling. Defaults to 0.
+            num_replicas (int, optional): number of processes sharing the dataset. Defaults to 1.
+            rank (int, optional): rank of the current process. Defaults to 0.
+            pad (bool, optional): repeat the first indices so that every shard has the same size, needed when the
+                                  processes synchronize at every step. Without it every sample is seen exactly once,
+                                  as the evaluation metrics summed over the processes require. Defaults to True.
+        """
+        self.data_source = data_source
+        self.shuffle = shuffle
+        self.seed = seed
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.pad = pad
+        self.epoch = 0
+        self.start_index = 0
+
+    def set_epoch(self, epoch, start_index=0):
+        """Select the order of the given epoch, skipping the first start_index samples"""
+        self.epoch = epoch
+        self.start_index = start_index
+
+    def indices(self):
+        if self.shuffle:
+            generator = torch.Generator()
+            generator.manual_seed(self.seed + self.epoch)
+            indices = torch.randperm(len(self.data_source), generator=generator).tolist()
+        else:
+            indices = list(range(len(self.data_source)))
+
+        if not self.pad:
+            return indices[self.rank :: self.num_replicas]
+        # pad with the first indices so that every process does the same number of steps
+        total_size = self.shard_size() * self.num_replicas
+        indices += indices[: total_size - len(indices)]
+        return indices[self.rank : total_size : self.num_replicas]
+
+    def shard_size(self):
+        if not self.pad:
+            return len(range(self.rank, len(self.data_source), self.num_replicas))
+        return -(-len(self.data_source) // self.num_replicas)
+
+    def __iter__(self):
+        return iter(self.indices()[self.start_index :])
+
+    def __len__(self):
+        return max(self.shard_size() - self.start_index, 0)
+
+
+class HardNegativeSampler:
+    """
+    Selects the negative masks injected in a training step instead of using all the SAM masks of the image.
+
+    Every mask token adds to the sequence and to the vocabulary of the step, most SAM masks are easy negatives that
+    look nothing like the target. The sampler keeps the num_hard masks closest to the gt masks (cosine similarity of
+    their embeddings, precomputed by CustomDataset) and num_random of the other ones, drawn again at every step so
+    that the easy negatives are still seen from time to time.
+    """
+
+    def __init__(self, num_hard=8, num_random=2):
+        """
+        Args:
+            num_hard (int, optional): hardest negatives kept per sample. Defaults to 8.
+            num_random (int, optional): negatives drawn at random among the remaining ones. Defaults to 2.
+        """
+        self.num_hard = num_hard
+        self.num_random = num_random
+
+    def select(self, hardness):
+        """Sorted indices of the selected negatives of a sample given the hardness of all its negatives"""
+        if len(hardness) <= self.num_hard + self.num_random:
+            return torch.arange(len(hardness))
+        order = torch.argsort(hardness, descending=True)
+        rest = order[self.num_hard :]
+        chosen = torch.cat([order[: self.num_hard], rest[torch.randperm(len(rest))[: self.num_random]]])
+        return chosen.sort().values
+
+    def __call__(self, batch):
+        """Batch (from collate_fn) with only the selected negatives of every sample"""
+        batch = dict(batch)
+        selections = [self.select(hardness) for hardness in batch["sam_hardness"]]
+        batch["sam_embs"] = [embs[indices] for embs, indices in zip(batch["sam_embs"], selections)]
+        batch["sam_hardness"] = [hardness[indices] for hardness, indices in zip(batch["sam_hardness"], selections)]
+        batch["sam_shapes"] = [[shapes[i] for i in indices.tolist()] for shapes, indices in zip(batch["sam_shapes"], selections)]
+        return batch
+
+
 def collate_fn(batch):
     new_batch = {}
     for key in batch[0]:
@@ -109,71 +255,178 @@ def collate_fn(batch):
     return new_batch
 
 
-def get_dataloaders(
-    explanatory_train, image_dir, batch_size, train_jsonl, val_jsonl, test_jsonl
-):
-    """Get the training, validation, and test data loaders.
+def get_datasets(explanatory_train, image_dir, train_jsonl, val_jsonl, test_jsonl, top_samples=30, embedding_encoding="fp32"):
+    """Load the training, validation, and test datasets.
 
     Args:
         explanatory_train (_type_): file path to the explanatory data for training
         image_dir (_type_): path to the directory containing the images
-        batch_size (_type_): batch size for the data loaders
         train_jsonl (_type_): jsonl file containing the training data masks
         val_jsonl (_type_): jsonl file containing the validation data masks
         test_jsonl (_type_): jsonl file containing the test data masks
+        top_samples (int, optional): SAM masks kept per image. Defaults to 30.
+        embedding_encoding (str, optional): encoding of the embeddings held in memory ("fp32", "fp16" or "int8"). Defaults to "fp32".
 
     Returns:
-        DataLoader: training data loader
-        DataLoader: validation data loader
-        DataLoader: test data loader
+        CustomDataset: training dataset
+        CustomDataset: validation dataset
+        CustomDataset: test dataset
     """
     print("Loading Training Data")
     data_train = CustomDataset(
         json_path=train_jsonl,
         image_dir=os.path.join(image_dir, "train"),
         exp_json_path=explanatory_train,
+        top_samples=top_samples,
+        embedding_encoding=embedding_encoding,
     )
 
     print("Loading Validation Data")
     data_val = CustomDataset(
-        json_path=val_jsonl, image_dir=os.path.join(image_dir, "val")
+        json_path=val_jsonl, image_dir=os.path.join(image_dir, "val"), top_samples=top_samples, embedding_encoding=embedding_encoding
     )
 
     print("Loading Test Data")
     data_test = CustomDataset(
-        json_path=test_jsonl, image_dir=os.path.join(image_dir, "test")
+        json_path=test_jsonl, image_dir=os.path.join(image_dir, "test"), top_samples=top_samples, embedding_encoding=embedding_encoding
     )
 
-    # Create DataLoaders
+    return data_train, data_val, data_test
+
+
+def make_dataloaders(datasets, batch_size, seed=42, rank=0, world_size=1, eval_batch_size=None, num_workers=0):
+    """Create the training, validation, and test data loaders from already loaded datasets.
+
+    Args:
+        datasets (tuple): training, validation, and test datasets
+        batch_size (int): batch size for the data loaders
+        seed (int, optional): seed of the training data order. Defaults to 42.
+        rank (int, optional): rank of the process when training with several processes. Defaults to 0.
+        world_size (int, optional): number of processes, each one gets a shard of every split. Defaults to 1.
+        eval_batch_size (int, optional): batch size of the validation and test data loaders. Defaults to batch_size.
+        num_workers (int, optional): processes loading the batches, kept alive between epochs. Defaults to 0.
+
+    Returns:
+        DataLoader: training data loader
+        DataLoader: validation data loader
+        DataLoader: test data loader
+    """
+    data_train, data_val, data_test = datasets
+    eval_batch_size = eval_batch_size or batch_size
+    worker_params = {"num_workers": num_workers, "persistent_workers": num_workers > 0}
+
+    # the order of the training data only depends on the seed and the epoch so that training can be resumed,
+    # the loader gets its own generator to leave the global RNG untouched when iterators are created
     data_loader = DataLoader(
-        data_train, batch_size=batch_size, shuffle=True, collate_fn=collate_fn
+        data_train,
+        batch_size=batch_size,
+        sampler=ResumableSampler(data_train, shuffle=True, seed=seed, num_replicas=world_size, rank=rank),
+        collate_fn=collate_fn,
+        generator=torch.Generator().manual_seed(seed),
+        **worker_params,
     )
+    # the evaluation shards are not padded, the metrics summed over the processes count every sample once
     data_val_loader = DataLoader(
-        data_val, batch_size=batch_size, shuffle=False, collate_fn=collate_fn
+        data_val,
+        batch_size=eval_batch_size,
+        sampler=ResumableSampler(data_val, shuffle=False, num_replicas=world_size, rank=rank, pad=False),
+        collate_fn=collate_fn,
+        **worker_params,
     )
     data_test_loader = DataLoader(
-        data_test, batch_size=batch_size, shuffle=False, collate_fn=collate_fn
+        data_test,
+        batch_size=eval_batch_size,
+        sampler=ResumableSampler(data_test, shuffle=False, num_replicas=world_size, rank=rank, pad=False),
+        collate_fn=collate_fn,
+        **worker_params,
     )
 
     return data_loader, data_val_loader, data_test_loader
 
 
+def get_dataloaders(
+    explanatory_train,
+    image_dir,
+    batch_size,
+    train_jsonl,
+    val_jsonl,
+    test_jsonl,
+    seed=42,
+    rank=0,
+    world_size=1,
+    eval_batch_size=None,
+    num_workers=0,
+    top_samples=30,
+    embedding_encoding="fp32",
+):
+    """Get the training, validation, and test data loaders.
+
+    Args:
+        explanatory_train (_type_): file path to the explanatory data for training
+        image_dir (_type_): path to the directory containing the images
+        batch_size (_type_): batch size for the data loaders
+        train_jsonl (_type_): jsonl file containing the training data masks
+        val_jsonl (_type_): jsonl file containing the validation data masks
+        test_jsonl (_type_): jsonl file containing the test data masks
+        seed (int, optional): seed of the training data order. Defaults to 42.
+        rank (int, optional): rank of the process when training with several processes. Defaults to 0.
+        world_size (int, optional): number of processes, each one gets a shard of every split. Defaults to 1.
+        eval_batch_size (int, optional): batch size of the validation and test data loaders. Defaults to batch_size.
+        num_workers (int, optional): processes loading the batches. Defaults to 0.
+        top_samples (int, optional): SAM masks kept per image. Defaults to 30.
+        embedding_encoding (str, optional): encoding of the embeddings held in memory ("fp32", "fp16" or "int8"). Defaults to "fp32".
+
+    Returns:
+        DataLoader: training data loader
+        DataLoader: validation data loader
+        DataLoader: test data loader
+    """
+    datasets = get_datasets(
+        explanatory_train,
+        image_dir,
+        train_jsonl,
+        val_jsonl,
+        test_jsonl,
+        top_samples=top_samples,
+        embedding_encoding=embedding_encoding,
+    )
+    return make_dataloaders(
+        datasets,
+        batch_size,
+        seed=seed,
+        rank=rank,
+        world_size=world_size,
+        eval_batch_size=eval_batch_size,
+        num_workers=num_workers,
+    )
+
+
 # ==========================
 # 2. WandB Initialization
 # ==========================
-def initialize_wandb(exp_name, exp_config):
+def initialize_wandb(exp_name, exp_config, run_id=None, enabled=True):
     """
     Initialize a wandb run for the experiment.
 
     Args:
         exp_name (str): Name of the experiment.
         exp_config (dict): Experiment-specific configuration.
+        run_id (str, optional): Id of a previous run to resume. Defaults to None.
+        enabled (bool, optional): If False the run is disabled and logging is a no-op (non-main processes). Defaults to True.
+
+    Returns:
+        str: Id of the wandb run.
     """
+    run_id = run_id or wandb.util.generate_id()
     wandb.init(
         project="LISA_ACV",
-        name=exp_name + "_" + wandb.util.generate_id(),
+        name=exp_name + "_" + run_id,
+        id=run_id,
+        resume="allow",
         config=exp_config,
+        mode=None if enabled else "disabled",
     )
+    return run_id
 
 
 # ==========================
@@ -189,6 +442,10 @@ def draw_shapes(
     """
     Draw segmentation masks on an image with distinct colors and optional enumeration.
 
+    All the masks are filled into one label map (later masks on top of earlier ones) and blended with the image in a
+    single operation, the outlines are drawn on a second map and the labels are placed at the centroid of each mask
+    computed from the moments of its polygons.
+
     Args:
         image (PIL.Image.Image): The original image.
         shapes (List[List[List[Tuple[int, int]]]]): 
@@ -202,55 +459,89 @@ def draw_shapes(
         PIL.Image.Image: The image with drawn masks.
     """
     # Convert and resize the original image
-    image = image.convert("RGBA").resize(resize)
-    
-    # Initialize Matplotlib's tab20 colormap for distinct colors
-    cmap = plt.get_cmap('tab20')
-    num_masks = len(shapes)
-    colors = [mcolors.to_rgba(cmap(i % 20), alpha=0.4) for i in range(num_masks)]
-    
-    # Convert RGBA floats to integers (0-255)
-    colors = [tuple(int(c * 255) for c in color) for color in colors]
-    
-    # Create an overlay for drawing masks
-    overlay = Image.new("RGBA", image.size, (255, 255, 255, 0))
-    draw = ImageDraw.Draw(overlay, "RGBA")
-
-    # Attempt to load a TrueType font; fallback to default if unavailable
-    font = ImageFont.load_default(20)
+    pixels = np.asarray(image.convert("RGBA"))
+    shrink = resize[0] * resize[1] < pixels.shape[0] * pixels.shape[1]
+    pixels = cv2.resize(pixels, resize, interpolation=cv2.INTER_AREA if shrink else cv2.INTER_CUBIC)
+
+    # Colors of Matplotlib's tab20 colormap, blended with 0.4 opacity
+    colors = (np.asarray(plt.get_cmap("tab20").colors) * 255).round().astype(np.uint8)
+    alpha = int(0.4 * 255) / 255
+
+    # color of every pixel (index in the colormap + 1, 0 where there is no mask), later masks on top
+    labels = np.zeros(pixels.shape[:2], dtype=np.uint8)
+    all_polygons = []
+    centroids = []
 
     for i, mask in enumerate(shapes):
-        color = colors[i]
-        all_points = []
+        polygons = [np.asarray(polygon).reshape(-1, 2) for polygon in mask]
+        polygons = [
+            (np.rint(polygon) if polygon.dtype.kind == "f" else polygon).astype(np.int32)
+            for polygon in polygons
+            if len(polygon) >= 2
+        ]
+        if len(polygons) < len(mask):
+            print(f"Warning: {len(mask) - len(polygons)} polygons in mask {i} have less than 2 points and will be skipped.")
+        if not polygons:
+            centroids.append(None)
+            continue
+
+        # every polygon is filled on its own, overlapping polygons of a mask do not cancel out
+        for polygon in polygons:
+            cv2.fillPoly(labels, [polygon], i % len(colors) + 1)
+        all_polygons.extend(polygons)
+
+        if not enumerate_masks:
+            continue
+        moments = [cv2.moments(polygon) for polygon in polygons if len(polygon) >= 3]
+        area = sum(m["m00"] for m in moments)
+        if area > 0:
+            centroids.append((sum(m["m10"] for m in moments) / area, sum(m["m01"] for m in moments) / area))
+        else:
+            # degenerate polygons (lines): mean of the points
+            centroids.append(tuple(np.concatenate(polygons).mean(axis=0)))
 
-        for polygon in mask:
-            points = [tuple(point) for point in polygon]
-            if len(points) < 2:
-                print(f"Warning: Polygon {polygon} in mask {i} has less than 2 points and will be skipped.")
+    # Blend the colors of all the masks at once, then draw all the outlines in black
+    table = np.full((256, 1, 4), 255, dtype=np.uint8)
+    table[1 : len(colors) + 1, 0, :3] = colors
+    overlay = cv2.LUT(cv2.merge([labels] * 4), table)
+    blended = cv2.addWeighted(pixels, 1 - alpha, overlay, alpha, 0)
+    cv2.copyTo(blended, labels, pixels)
+    cv2.polylines(pixels, all_polygons, isClosed=True, color=(0, 0, 0, 255), thickness=2)
+    combined = Image.fromarray(pixels, "RGBA")
+
+    if enumerate_masks:
+        draw = ImageDraw.Draw(combined)
+        font = ImageFont.load_default(20)
+        for i, centroid in enumerate(centroids):
+            if centroid is None:
                 continue
+            text = str(i + 1) if not mask_names else mask_names[i]
+            # black label with a white outline for better visibility
+            draw.text(centroid, text, font=font, fill="black", stroke_width=1, stroke_fill="white")
 
-            # Draw the filled polygon with transparency
-            draw.polygon(points, fill=color)
-            # Draw the polygon outline
-            draw.line(points + [points[0]], fill=(0, 0, 0, 255), width=2)
-            # Collect points to compute centroid later
-            all_points.extend(points)
-        
-        if enumerate_masks and all_points:
-            # Calculate centroid of all points in the mask for label placement
-            xs = [p[0] for p in all_points]
-            ys = [p[1] for p in all_points]
-            centroid = (sum(xs) / len(xs), sum(ys) / len(ys))
-            text = str(i + 1)  if not mask_names else mask_names[i]
-
-            # Draw white outline for better text visibility
-            draw.text((centroid[0]+1, centroid[1]+1), text, font=font, fill="white")
-            draw.text((centroid[0]-1, centroid[1]-1), text, font=font, fill="white")
-            draw.text((centroid[0]+1, centroid[1]-1), text, font=font, fill="white")
-            draw.text((centroid[0]-1, centroid[1]+1), text, font=font, fill="white")
-            # Draw the black enumeration number
-            draw.text(centroid, text, font=font, fill="black")
-
-    # Combine the overlay with the original image
-    combined = Image.alpha_composite(image, overlay)
-    return combined
\ No newline at end of file
+    return combined
+
+
+def _export_overlay(job):
+    image_path, shapes, output_path, kwargs = job
+    with Image.open(image_path) as image:
+        # fast png compression, the default level takes longer than drawing the masks
+        draw_shapes(image, shapes, **kwargs).save(output_path, compress_level=1)
+    return output_path
+
+
+def export_overlays(jobs: list[tuple[str, list, str]], workers: int = None, **kwargs) -> list[str]:
+    """
+    Draw the masks of many images in parallel and save the results.
+
+    Args:
+        jobs (list[tuple[str, list, str]]): path of the image, its shapes and the path of the output image for every image
+        workers (int, optional): number of processes. Defaults to the number of CPUs.
+        **kwargs: arguments of draw_shapes (resize, enumerate_masks, mask_names)
+
+    Returns:
+        list[str]: paths of the saved images
+    """
+    jobs = [(image_path, shapes, output_path, kwargs) for image_path, shapes, output_path in jobs]
+    with Pool(workers) as pool:
+        return pool.map(_export_overlay, jobs, chunksize=max(1, len(jobs) // (4 * (workers or os.cpu_count()))))
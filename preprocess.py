@@ -9,8 +9,8 @@ from PIL import Image, ImageDraw
 from tqdm import tqdm
 
 from configuration import ProjectConfig, dataclass, load_yaml_config
-from preprocessing.alphaclip import AlphaCLIPEncoder
-from preprocessing.sam import SegmentationMaskExtractor
+from llava_finetune.embeddings import encode_embeddings
+from llava_finetune.profiling import MemoryTracker
 
 
 @dataclass
@@ -35,9 +35,20 @@ def iou(mask1: np.ndarray, mask2: np.ndarray) -> float:
 
 class PreprocessPipeline:
     def __init__(self, config: ProjectConfig):
-        self.sme = SegmentationMaskExtractor(config.sam)
-        self.ace = AlphaCLIPEncoder(config.alphaclip)
+        # imported here so that the mask helpers of this module only need numpy and cv2
+        from preprocessing.alphaclip import AlphaCLIPEncoder
+        from preprocessing.sam import SegmentationMaskExtractor
+
+        self.sme = SegmentationMaskExtractor(config.sam, config.performance)
+        self.ace = AlphaCLIPEncoder(config.alphaclip, config.performance)
         self.dataset = config.dataset
+        self.embedding_encoding = config.performance.embedding_encoding
+        # peak memory of the preprocessing stages, enabled by the profiling section of the config
+        self.memory = MemoryTracker(
+            config.profiling.memory,
+            device=config.performance.resolve_device(),
+            tracemalloc=config.profiling.tracemalloc,
+        )
 
     def run_all(self, mask_only: bool = False):
         res = []
@@ -47,6 +58,7 @@ class PreprocessPipeline:
             except Exception as e:
                 print(f"Error in {image}: {e}")
 
+        print(self.sme.filter_report())
         return res
 
     def run(self, img_path: str, mask_only: bool) -> dict:
@@ -58,11 +70,14 @@ class PreprocessPipeline:
             mask_only (bool): Whether to multiply the image by the mask or not.
 
         Returns:
-            dict: Dictionary containing the image name, ground truth shapes, ground truth embeddings, SAM shapes, and SAM embeddings.
+            dict: Dictionary containing the image name, ground truth shapes, ground truth embeddings, SAM shapes, and SAM embeddings
+                  (encoded with the embedding_encoding of the performance section, see llava_finetune.embeddings).
         """
         with torch.no_grad():
-            gt_masks = self.create_gt_masks(img_path)
-            sam_masks = self.create_sam_masks(img_path)
+            with self.memory.stage("gt_masks"):
+                gt_masks = self.create_gt_masks(img_path)
+            with self.memory.stage("sam"):
+                sam_masks = self.create_sam_masks(img_path)
 
             img = cv2.imread(img_path)
             img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
@@ -74,16 +89,18 @@ class PreprocessPipeline:
 
             sam_masks = self.remove_gt_masks(sam_masks, gt_masks)
 
-            sam_shapes = self.get_shapes_from_masks(sam_masks)
-            gt_shapes = self.get_shapes_from_masks(gt_masks)
+            with self.memory.stage("shapes"):
+                sam_shapes = self.get_shapes_from_masks(sam_masks)
+                gt_shapes = self.get_shapes_from_masks(gt_masks)
 
-            gt_embs = [self.ace.get_visual_embedding(img, mask, mask_only) for mask in gt_masks]
-            sam_embs = [self.ace.get_visual_embedding(img, mask, mask_only) for mask in sam_masks]
+            with self.memory.stage("alphaclip"):
+                gt_embs = self.ace.get_visual_embeddings(img, gt_masks, mask_only)
+                sam_embs = self.ace.get_visual_embeddings(img, sam_masks, mask_only)
 
             return {
                 "img": os.path.basename(img_path),
-                "gt_embs": [emb.cpu().numpy().tolist() for emb in gt_embs],
-                "sam_embs": [emb.cpu().numpy().tolist() for emb in sam_embs],
+                "gt_embs": encode_embeddings(gt_embs, self.embedding_encoding),
+                "sam_embs": encode_embeddings(sam_embs, self.embedding_encoding),
                 "gt_shapes": gt_shapes,
                 "sam_shapes": sam_shapes,
             }
@@ -130,28 +147,34 @@ class PreprocessPipeline:
 
         return [[[tuple(p[0]) for p in s] for s in shape] for shape in shapes]
 
-    def inference_preprocess(self, img_path: str, mask_only: bool) -> dict:
+    def inference_preprocess(self, img_path: str | np.ndarray, mask_only: bool) -> dict:
         """
         Preprocess an image for inference.
 
         Args:
-            img_path (str): Path to the image to preprocess.
+            img_path (str | np.ndarray): Path to the image to preprocess, or the image itself as an RGB array.
             mask_only (bool): Whether to multiply the image by the mask or not.
 
         Returns:
-            dict: Dictionary containing the image name, SAM shapes, and SAM embeddings.
+            dict: Dictionary containing the image name (None for arrays), SAM shapes, and SAM embeddings.
         """
-        img = cv2.imread(img_path)
-        img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
-        img = self.reshape_image(img)
-        img = Image.fromarray(img)
-
-        sam_masks = self.create_sam_masks(img_path)
-        sam_embs = [self.ace.get_visual_embedding(img, mask, mask_only) for mask in sam_masks]
-        sam_shapes = self.get_shapes_from_masks(sam_masks)
+        if isinstance(img_path, str):
+            rgb = cv2.cvtColor(cv2.imread(img_path), cv2.COLOR_BGR2RGB)
+        else:
+            rgb = img_path
+        img = Image.fromarray(self.reshape_image(rgb))
+
+        # same input as SegmentationMaskExtractor.segment_path, without reading the image again
+        with self.memory.stage("sam"):
+            res = self.sme.segment_array(rgb)
+            sam_masks = [mask["segmentation"].astype("uint8") * 255 for mask in res]
+        with self.memory.stage("alphaclip"):
+            sam_embs = self.ace.get_visual_embeddings(img, sam_masks, mask_only)
+        with self.memory.stage("shapes"):
+            sam_shapes = self.get_shapes_from_masks(sam_masks)
 
         return {
-            "img": os.path.basename(img_path),
+            "img": os.path.basename(img_path) if isinstance(img_path, str) else None,
             "sam_shapes": sam_shapes,
             "sam_embs": [emb.cpu().numpy().tolist() for emb in sam_embs],
         }
@@ -186,3 +209,6 @@ if __name__ == "__main__":
         with open(f"data/{os.path.basename(config.dataset.image_dir)}_TEST.jsonl", "w") as f:
             for r in res:
                 f.write(json.dumps(r, default=default) + "\n")
+
+        if pipeline.memory.enabled:
+            pipeline.memory.save(os.path.join(config.profiling.report_dir, f"preprocess_{d}.json"))
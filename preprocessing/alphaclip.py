@@ -8,8 +8,6 @@ from torchvision import transforms
 
 import configuration as c
 
-config = c.load_yaml_config("config.yaml")
-
 mask_transform = transforms.Compose(
     [
         transforms.ToTensor(),
@@ -46,20 +44,28 @@ class AlphaCLIPDownloader:
 
 
 class AlphaCLIPEncoder:
-    def __init__(self, alphaclip_config: c.AlphaCLIPConfig):
+    def __init__(self, alphaclip_config: c.AlphaCLIPConfig, performance: c.PerformanceConfig = None):
         self.config = alphaclip_config
+        # device, precision and batch size, the defaults of the performance section if not given
+        performance = performance or c.PerformanceConfig()
+        self.batch_size = performance.alphaclip_batch_size
 
         checkpoint_path = AlphaCLIPDownloader.download(
             self.config.model, self.config.checkpoint_dir
         )
 
-        self.device = "cuda" if torch.cuda.is_available() else "cpu"
+        self.device = performance.resolve_device()
 
         self.alphaclip, self.preprocess = alpha_clip.load(
             self.config.model, alpha_vision_ckpt_pth=checkpoint_path, device=self.device
         )
+        # alpha_clip loads fp16 weights on cuda and fp32 ones on the cpu, the inputs follow the weights
+        if performance.dtype is not None:
+            self.alphaclip = self.alphaclip.to(performance.dtype)
 
-    def get_visual_embedding(self, image: Image.Image, mask: np.ndarray, mask_only=False):
+    def _inputs(self, image: Image.Image, mask: np.ndarray, mask_only=False):
+        """Preprocessed image and alpha channel of a mask, on the device and in the dtype of the model"""
+        dtype = self.alphaclip.visual.conv1.weight.dtype
         binary_mask = mask == 255
 
         if mask_only:
@@ -67,31 +73,65 @@ class AlphaCLIPEncoder:
             binary_mask = binary_mask.astype(np.uint8)
 
             image = image * binary_mask[:, :, None]
-            image = transforms.ToTensor()(image).half().to(self.device)
-            t_binary_mask = torch.tensor(binary_mask).half().cuda().unsqueeze(dim=0)
+            image = transforms.ToTensor()(image).to(self.device, dtype)
+            t_binary_mask = torch.tensor(binary_mask).to(self.device, dtype).unsqueeze(dim=0)
             image = image * t_binary_mask
 
             image = Image.fromarray(
-                (image.squeeze(0).cpu().numpy().transpose(1, 2, 0) * 255).astype(np.uint8)
+                (image.squeeze(0).float().cpu().numpy().transpose(1, 2, 0) * 255).astype(np.uint8)
             )
 
         alpha = mask_transform((binary_mask * 255).astype(np.uint8))
-        alpha = alpha.half().cuda().unsqueeze(dim=0)
+        alpha = alpha.to(self.device, dtype).unsqueeze(dim=0)
 
-        image = self.preprocess(image).unsqueeze(0).half().to(self.device)
+        image = self.preprocess(image).unsqueeze(0).to(self.device, dtype)
+        return image, alpha
+
+    def get_visual_embedding(self, image: Image.Image, mask: np.ndarray, mask_only=False):
+        image, alpha = self._inputs(image, mask, mask_only)
 
         with torch.no_grad():
             image_features = self.alphaclip.visual(image, alpha).squeeze(0)
 
         return image_features / image_features.norm(dim=-1, keepdim=True)
 
+    def get_visual_embeddings(self, image: Image.Image, masks: list[np.ndarray], mask_only=False, batch_size=None):
+        """
+        Embeddings of several masks of the same image, encoded in batches instead of one forward pass per mask.
+
+        Args:
+            image (Image.Image): image of the masks
+            masks (list[np.ndarray]): masks of the image (255 inside the mask)
+            mask_only (bool, optional): whether to multiply the image by the mask. Defaults to False.
+            batch_size (int, optional): masks encoded at a time. Defaults to the alphaclip_batch_size of the performance section.
+
+        Returns:
+            list[torch.Tensor]: normalized embedding of every mask
+        """
+        if not mask_only:
+            # the image does not depend on the mask, it is only preprocessed once
+            base_image = self._inputs(image, masks[0])[0] if masks else None
+
+        batch_size = batch_size or self.batch_size
+        embeddings = []
+        for start in range(0, len(masks), batch_size):
+            inputs = [self._inputs(image, mask, mask_only) for mask in masks[start : start + batch_size]]
+            alpha = torch.cat([a for _, a in inputs])
+            images = torch.cat([i for i, _ in inputs]) if mask_only else base_image.expand(len(alpha), -1, -1, -1)
+
+            with torch.no_grad():
+                features = self.alphaclip.visual(images, alpha)
+            embeddings.extend(features / features.norm(dim=-1, keepdim=True))
+        return embeddings
+
 
 if __name__ == "__main__":
+    config = c.load_yaml_config("config.yaml")
     img_name = "11709607_652f25a747_o.jpg"
     image_path = os.path.join(config.dataset.image_dir, img_name)
     mask_path = os.path.join(config.dataset.mask_dir, img_name.split(".")[0], "mask_5.png")
 
-    encoder = AlphaCLIPEncoder(config.alphaclip)
+    encoder = AlphaCLIPEncoder(config.alphaclip, config.performance)
     image = Image.open(image_path)
     mask = np.array(Image.open(mask_path))
 
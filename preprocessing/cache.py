@@ -0,0 +1,230 @@
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+from dataclasses import asdict
+
+import numpy as np
+import torch
+
+
+def config_key(config, only_masks: bool) -> str:
+    """
+    Part of the cache key describing how the image was preprocessed: the SAM and AlphaCLIP configuration
+    (without the local checkpoint directories) and whether the image was multiplied by the masks.
+
+    Args:
+        config (ProjectConfig): project configuration
+        only_masks (bool): whether the image is multiplied by the masks before AlphaCLIP
+
+    Returns:
+        str: canonical json of the preprocessing configuration
+    """
+    sam = {k: v for k, v in asdict(config.sam).items() if k != "checkpoint_dir"}
+    alphaclip = {k: v for k, v in asdict(config.alphaclip).items() if k != "checkpoint_dir"}
+    return json.dumps({"sam": sam, "alphaclip": alphaclip, "only_masks": only_masks}, sort_keys=True)
+
+
+def weights_key(model_name: str, model_path: str) -> str:
+    """
+    Name under which the SegAdapter outputs of a model are cached: the model name and the size and modification
+    time of its weights, so that a retrained or overwritten model never gets the outputs of the previous weights.
+
+    Args:
+        model_name (str): name of the model
+        model_path (str): path of its .pth file
+
+    Returns:
+        str: "<model_name>_<fingerprint>"
+    """
+    stat = os.stat(model_path)
+    fingerprint = hashlib.sha256(f"{stat.st_size}:{stat.st_mtime_ns}".encode()).hexdigest()[:16]
+    return f"{model_name}_{fingerprint}"
+
+
+class PreprocessCache:
+    """
+    Content-addressed cache of the inference preprocessing (SAM masks and AlphaCLIP embeddings).
+
+    Entries are keyed by the hash of the image bytes and of the preprocessing configuration, so the same image
+    uploaded twice (under any name) is only preprocessed once. The most recently used entries are kept in memory
+    within a byte budget, every entry is also written to disk (if a directory is given) and reloaded from there
+    after being evicted or when the application restarts. Along with the masks, the outputs of the SegAdapter of
+    each model can be stored.
+    """
+
+    def __init__(self, max_bytes: int = 512 * 2**20, cache_dir: str = "cache/preprocess"):
+        """
+        Args:
+            max_bytes (int, optional): memory budget of the in-memory tier. Defaults to 512 MiB.
+            cache_dir (str, optional): directory of the disk tier, None to keep the cache in memory only. Defaults to "cache/preprocess".
+        """
+        self.max_bytes = max_bytes
+        self.cache_dir = cache_dir
+        self.entries: OrderedDict[str, dict] = OrderedDict()
+        self.sizes: dict[str, int] = {}
+        self.bytes = 0
+        self.counters = {
+            "hits": 0,
+            "disk_hits": 0,
+            "misses": 0,
+            "evictions": 0,
+            "adapter_hits": 0,
+            "adapter_misses": 0,
+        }
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def key(image_bytes: bytes, config: str) -> str:
+        """Hash of the image content and of the preprocessing configuration (see config_key)"""
+        digest = hashlib.sha256()
+        digest.update(config.encode())
+        digest.update(image_bytes)
+        return digest.hexdigest()
+
+    def get(self, key: str) -> dict:
+        """
+        Preprocessing result of an image.
+
+        Args:
+            key (str): key of the image
+
+        Returns:
+            dict: "sam_shapes" and "sam_embs" of the image, None if it is not in the cache
+        """
+        with self.lock:
+            entry = self._lookup(key)
+            if entry is None:
+                self.counters["misses"] += 1
+                return None
+            # copies of the lists, callers may append masks to them
+            return {"sam_shapes": list(entry["sam_shapes"]), "sam_embs": list(entry["sam_embs"])}
+
+    def put(self, key: str, result: dict):
+        """
+        Store the preprocessing result of an image.
+
+        Args:
+            key (str): key of the image
+            result (dict): output of PreprocessPipeline.inference_preprocess
+        """
+        # copies of the lists, the caller may append masks to its own
+        entry = {"sam_shapes": list(result["sam_shapes"]), "sam_embs": list(result["sam_embs"]), "adapter": {}}
+        with self.lock:
+            self._insert(key, entry)
+            self._save(key, "preprocess", {"sam_shapes": entry["sam_shapes"], "sam_embs": entry["sam_embs"]})
+
+    def get_adapter(self, key: str, adapter_key: str) -> torch.Tensor:
+        """SegAdapter output of the masks of an image for the model weights of adapter_key (see weights_key), None if not cached"""
+        with self.lock:
+            entry = self._lookup(key, count=False)
+            output = None
+            if entry is not None:
+                output = entry["adapter"].get(adapter_key)
+                if output is None:
+                    output = self._load(key, f"adapter_{adapter_key}")
+                    if output is not None:
+                        self._add_adapter(key, entry, adapter_key, output)
+            self.counters["adapter_hits" if output is not None else "adapter_misses"] += 1
+            return output
+
+    def put_adapter(self, key: str, adapter_key: str, output: torch.Tensor):
+        """Store the SegAdapter output of the masks of an image (the image must be in the cache)"""
+        output = output.detach().cpu()
+        with self.lock:
+            entry = self._lookup(key, count=False)
+            if entry is None:
+                return
+            self._add_adapter(key, entry, adapter_key, output)
+            self._save(key, f"adapter_{adapter_key}", output)
+
+    def stats(self) -> dict:
+        """Hit, miss and eviction counters and the memory used by the cache"""
+        with self.lock:
+            return {**self.counters, "entries": len(self.entries), "bytes": self.bytes}
+
+    def clear(self):
+        """Empty the in-memory tier (the disk tier is kept)"""
+        with self.lock:
+            self.entries.clear()
+            self.sizes.clear()
+            self.bytes = 0
+
+    # ==========================
+    # In-memory tier
+    # ==========================
+    def _lookup(self, key, count=True):
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            if count:
+                self.counters["hits"] += 1
+            return self.entries[key]
+
+        result = self._load(key, "preprocess")
+        if result is None:
+            return None
+        if count:
+            self.counters["disk_hits"] += 1
+        entry = {**result, "adapter": {}}
+        self._insert(key, entry)
+        return entry
+
+    def _insert(self, key, entry):
+        if key in self.entries:
+            self.bytes -= self.sizes[key]
+        self.entries[key] = entry
+        self.entries.move_to_end(key)
+        self.sizes[key] = self._size(entry)
+        self.bytes += self.sizes[key]
+        self._evict()
+
+    def _add_adapter(self, key, entry, adapter_key, output):
+        entry["adapter"][adapter_key] = output
+        self.bytes -= self.sizes[key]
+        self.sizes[key] = self._size(entry)
+        self.bytes += self.sizes[key]
+        self._evict(keep=key)
+
+    def _evict(self, keep=None):
+        # least recently used entries first, the entry being used is never evicted
+        while self.bytes > self.max_bytes and len(self.entries) > 1:
+            key = next(iter(self.entries))
+            if key == keep:
+                self.entries.move_to_end(key)
+                key = next(iter(self.entries))
+            self.entries.pop(key)
+            self.bytes -= self.sizes.pop(key)
+            self.counters["evictions"] += 1
+
+    @staticmethod
+    def _size(entry) -> int:
+        embs = np.asarray(entry["sam_embs"], dtype=np.float32).nbytes
+        # every contour point is a pair of integers
+        shapes = sum(len(contour) for shape in entry["sam_shapes"] for contour in shape) * 16
+        adapter = sum(output.numel() * output.element_size() for output in entry["adapter"].values())
+        return embs + shapes + adapter
+
+    # ==========================
+    # Disk tier
+    # ==========================
+    def _path(self, key, name):
+        return os.path.join(self.cache_dir, key[:2], key, f"{name}.pt")
+
+    def _save(self, key, name, value):
+        if self.cache_dir is None:
+            return
+        path = self._path(key, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # write to a temporary file first so that a crash never leaves a truncated entry
+        tmp_path = f"{path}.tmp"
+        torch.save(value, tmp_path)
+        os.replace(tmp_path, path)
+
+    def _load(self, key, name):
+        if self.cache_dir is None:
+            return None
+        path = self._path(key, name)
+        if not os.path.exists(path):
+            return None
+        return torch.load(path, map_location="cpu", weights_only=False)
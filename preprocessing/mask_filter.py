@@ -0,0 +1,77 @@
+import numpy as np
+import torch
+
+import configuration as c
+
+# reasons for which a mask is removed, in the order the filters are applied
+FILTER_REASONS = ("small", "unstable", "duplicate")
+
+
+def mask_overlaps(segmentations: np.ndarray, resolution: int = 256) -> tuple[torch.Tensor, torch.Tensor]:
+    """
+    Pairwise IoU and containment of binary masks, computed with a single matrix product.
+
+    Args:
+        segmentations (np.ndarray): masks (num_masks, height, width), bool
+        resolution (int, optional): the masks are subsampled to about this size first, overlaps of large SAM masks do
+                                    not need every pixel. Defaults to 256.
+
+    Returns:
+        tuple[torch.Tensor, torch.Tensor]: IoU and containment (intersection over the area of the smaller mask)
+                                           matrices (num_masks, num_masks)
+    """
+    stride = max(1, max(segmentations.shape[1:]) // resolution)
+    flat = torch.from_numpy(np.ascontiguousarray(segmentations[:, ::stride, ::stride])).reshape(len(segmentations), -1).float()
+    intersection = flat @ flat.T
+    area = intersection.diagonal()
+    union = area[:, None] + area[None, :] - intersection
+    iou = intersection / union.clamp_min(1)
+    containment = intersection / torch.minimum(area[:, None], area[None, :]).clamp_min(1)
+    return iou, containment
+
+
+def filter_masks(masks: list[dict], config: c.MaskFilterConfig) -> tuple[list[dict], dict]:
+    """
+    Remove the slivers, the unstable masks and the near-duplicates among the masks of SamAutomaticMaskGenerator.
+
+    The duplicates are removed by greedy non-maximum suppression in order of predicted IoU: a mask is dropped when
+    its IoU (or containment, if enabled) with a better mask that was kept exceeds the threshold.
+
+    Args:
+        masks (list[dict]): masks of SamAutomaticMaskGenerator.generate ("segmentation", "area", "predicted_iou",
+                            "stability_score")
+        config (MaskFilterConfig): thresholds of the filters
+
+    Returns:
+        tuple[list[dict], dict]: kept masks (by decreasing predicted IoU) and the number of masks removed by every
+                                 filter (see FILTER_REASONS)
+    """
+    removed = dict.fromkeys(FILTER_REASONS, 0)
+    kept = []
+    for mask in masks:
+        if mask["area"] < config.min_area:
+            removed["small"] += 1
+        elif config.min_stability is not None and mask["stability_score"] < config.min_stability:
+            removed["unstable"] += 1
+        else:
+            kept.append(mask)
+
+    if len(kept) < 2 or (config.nms_iou_thresh is None and config.nms_containment_thresh is None):
+        return kept, removed
+
+    kept.sort(key=lambda mask: mask["predicted_iou"], reverse=True)
+    iou, containment = mask_overlaps(np.stack([mask["segmentation"] for mask in kept]), config.nms_resolution)
+    overlapping = torch.zeros_like(iou, dtype=torch.bool)
+    if config.nms_iou_thresh is not None:
+        overlapping |= iou > config.nms_iou_thresh
+    if config.nms_containment_thresh is not None:
+        overlapping |= containment > config.nms_containment_thresh
+    # a mask can only be suppressed by a better one
+    overlapping = overlapping.triu(diagonal=1)
+
+    suppressed = torch.zeros(len(kept), dtype=torch.bool)
+    for i in range(len(kept)):
+        if not suppressed[i]:
+            suppressed |= overlapping[i]
+    removed["duplicate"] = int(suppressed.sum())
+    return [mask for mask, drop in zip(kept, suppressed.tolist()) if not drop], removed
@@ -1,5 +1,6 @@
 import glob
 import os
+from contextlib import contextmanager
 from dataclasses import dataclass
 
 import cv2
@@ -10,6 +11,8 @@ from segment_anything import SamAutomaticMaskGenerator, sam_model_registry
 from tqdm import tqdm
 
 import configuration as c
+from preprocessing.mask_filter import FILTER_REASONS, filter_masks
+from preprocessing.tiling import merge_tile_masks, paste_mask, tile_boxes, to_output_frame
 
 
 def show_anns(anns):
@@ -65,16 +68,24 @@ class SegmentationMask:
 
 
 class SegmentationMaskExtractor:
-    def __init__(self, sam_config: c.SAMConfig):
+    def __init__(self, sam_config: c.SAMConfig, performance: c.PerformanceConfig = None):
         self.config = sam_config
+        # device, size of the point grid and tile batch, the defaults of the performance section if not given
+        performance = performance or c.PerformanceConfig()
+        self.tile_batch_size = performance.sam_tile_batch_size
 
         checkpoint_path = SAMDownloader.download(self.config.model, self.config.checkpoint_dir)
 
-        device = "cuda" if torch.cuda.is_available() else "cpu"
+        device = performance.resolve_device()
         self.sam = sam_model_registry[self.config.model](checkpoint_path).to(device)
         self.mask_generator = SamAutomaticMaskGenerator(
-            self.sam, pred_iou_thresh=0.88, points_per_side=50
+            self.sam,
+            pred_iou_thresh=0.88,
+            points_per_side=performance.sam_points_per_side,
+            points_per_batch=performance.sam_points_per_batch,
         )
+        # masks removed by the filter and AlphaCLIP calls saved since the extractor was created
+        self.filter_counts = {"images": 0, "masks": 0, **dict.fromkeys(FILTER_REASONS, 0), "encoder_calls_saved": 0}
 
     def __call__(self, path: os.PathLike | list[os.PathLike]):
         return self.extract(path)
@@ -108,9 +119,31 @@ class SegmentationMaskExtractor:
         """
         image = cv2.imread(image_path)
         image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
-        image = cv2.resize(image, (self.config.resize, self.config.resize))
 
-        return self.segment_img(image)
+        return self.segment_array(image)
+
+    def segment_array(self, image: np.ndarray) -> list[SegmentationMask]:
+        """
+        Extracts segmentation masks from an image at its original resolution, the masks are given at the SAM input
+        resolution (resize x resize). Images larger than the tiles of the tiling config are segmented in tiles.
+            :param image: RGB image as a numpy array.
+            :return: List of segmentation masks.
+        """
+        tile_size = self.config.tiling.tile_size
+        if tile_size is not None and max(image.shape[:2]) > tile_size:
+            return self.segment_tiled(image)
+        return self.segment_img(cv2.resize(image, (self.config.resize, self.config.resize)))
+
+    def filter_report(self) -> str:
+        """Masks removed by the filter and AlphaCLIP calls saved, in total and per image"""
+        counts = self.filter_counts
+        images = max(counts["images"], 1)
+        removed = ", ".join(f"{counts[reason]} {reason}" for reason in FILTER_REASONS)
+        return (
+            f"Mask filter: {sum(counts[reason] for reason in FILTER_REASONS)} of {counts['masks']} SAM masks removed "
+            f"({removed}) in {counts['images']} images, {counts['encoder_calls_saved']} AlphaCLIP calls saved "
+            f"({counts['encoder_calls_saved'] / images:.1f} per image)"
+        )
 
     def segment_img(self, img: np.ndarray) -> list[SegmentationMask]:
         """
@@ -120,25 +153,122 @@ class SegmentationMaskExtractor:
         """
         try:
             masks = self.mask_generator.generate(img)
+            # every mask kept is encoded by AlphaCLIP, the duplicates and slivers are removed first
+            filtered, removed = filter_masks(masks, self.config.filter)
+
+            filtered.sort(key=(lambda x: x["area"]), reverse=True)
+            if self.config.n_masks > 0:
+                filtered = filtered[: self.config.n_masks]
+
+            self._count_filtered(len(masks), removed, len(filtered))
+            return filtered
+
+        except Exception as e:
+            print(f"Error processing image: {e}")
+            return []
 
-            masks.sort(key=(lambda x: x["area"]), reverse=True)
+    def segment_tiled(self, image: np.ndarray) -> list[SegmentationMask]:
+        """
+        Extracts segmentation masks from a large image in overlapping tiles at its full resolution.
+
+        The tiles are encoded by SAM in batches of sam_tile_batch_size, the masks of every tile are filtered and
+        moved to the SAM input resolution (resize x resize) as crops of their bounding box, then the objects cut by
+        the tile borders are joined. The peak memory does not depend on the resolution of the image: at most one batch
+        of tiles is encoded at a time and the masks kept are at the output resolution.
+            :param image: RGB image as a numpy array.
+            :return: List of segmentation masks.
+        """
+        try:
+            height, width = image.shape[:2]
+            size = self.config.resize
+            tiling = self.config.tiling
+            boxes = tile_boxes(height, width, tiling.tile_size, tiling.overlap)
+            scale = (size / width, size / height)
+            tile_rects = [
+                (int(x0 * scale[0]), int(y0 * scale[1]), int(np.ceil(x1 * scale[0])), int(np.ceil(y1 * scale[1])))
+                for x0, y0, x1, y1 in boxes
+            ]
+
+            raw_masks = 0
+            removed = dict.fromkeys(FILTER_REASONS, 0)
+            tile_masks = []
+            for start in range(0, len(boxes), self.tile_batch_size):
+                batch = boxes[start : start + self.tile_batch_size]
+                tiles = [np.ascontiguousarray(image[y0:y1, x0:x1]) for x0, y0, x1, y1 in batch]
+                features, input_sizes = self._encode_tiles(tiles)
+                for i, (tile, box) in enumerate(zip(tiles, batch)):
+                    with self._precomputed_image(features[i : i + 1], tile.shape[:2], input_sizes[i]):
+                        masks = self.mask_generator.generate(tile)
+                    raw_masks += len(masks)
+                    masks, tile_removed = filter_masks(masks, self.config.filter)
+                    for reason, count in tile_removed.items():
+                        removed[reason] += count
+                    tile_masks += [to_output_frame(mask, box, scale, start + i) for mask in masks]
+                del features
+
+            merged, duplicates = merge_tile_masks(tile_masks, tile_rects, tiling.merge_iou_thresh)
+            removed["duplicate"] += duplicates
+            merged.sort(key=(lambda x: x["area"]), reverse=True)
             if self.config.n_masks > 0:
-                masks = masks[: self.config.n_masks]
+                merged = merged[: self.config.n_masks]
+            masks = [paste_mask(mask, (size, size)) for mask in merged]
 
+            self._count_filtered(raw_masks, removed, len(masks))
             return masks
 
         except Exception as e:
             print(f"Error processing image: {e}")
             return []
 
+    def _encode_tiles(self, tiles: list[np.ndarray]):
+        """SAM image embeddings of a batch of tiles, as SamPredictor.set_image computes them for a single image"""
+        predictor = self.mask_generator.predictor
+        inputs, input_sizes = [], []
+        for tile in tiles:
+            transformed = torch.as_tensor(predictor.transform.apply_image(tile), device=predictor.device)
+            transformed = transformed.permute(2, 0, 1).contiguous()[None, :, :, :]
+            input_sizes.append(tuple(transformed.shape[-2:]))
+            inputs.append(self.sam.preprocess(transformed))
+        with torch.no_grad():
+            return self.sam.image_encoder(torch.cat(inputs)), input_sizes
+
+    @contextmanager
+    def _precomputed_image(self, features: torch.Tensor, original_size: tuple, input_size: tuple):
+        """The mask generator uses the given image embeddings instead of encoding the image it is given"""
+        predictor = self.mask_generator.predictor
+
+        def set_image(image, image_format="RGB"):
+            predictor.reset_image()
+            predictor.original_size = original_size
+            predictor.input_size = input_size
+            predictor.features = features
+            predictor.is_image_set = True
+
+        predictor.set_image = set_image
+        try:
+            yield
+        finally:
+            # back to the method of the class
+            del predictor.set_image
+
+    def _count_filtered(self, num_masks: int, removed: dict, num_kept: int):
+        # without the filter the n_masks largest masks would have been encoded
+        unfiltered = min(num_masks, self.config.n_masks) if self.config.n_masks > 0 else num_masks
+        self.filter_counts["images"] += 1
+        self.filter_counts["masks"] += num_masks
+        for reason, count in removed.items():
+            self.filter_counts[reason] += count
+        self.filter_counts["encoder_calls_saved"] += unfiltered - num_kept
+
 
 if __name__ == "__main__":
     conf = c.load_yaml_config("config.yaml")
-    extractor = SegmentationMaskExtractor(conf.sam)
+    extractor = SegmentationMaskExtractor(conf.sam, conf.performance)
     images = glob.glob(conf.dataset.image_dir + "/*.jpg")
     os.makedirs(conf.dataset.mask_dir, exist_ok=True)
 
     all_masks = extractor.extract(images)
+    print(extractor.filter_report())
 
     for img, img_masks in all_masks:
         out_folder = img.replace(conf.dataset.image_dir, conf.dataset.mask_dir).removesuffix(".jpg")
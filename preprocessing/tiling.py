@@ -0,0 +1,171 @@
+import cv2
+import numpy as np
+
+
+def tile_boxes(height: int, width: int, tile_size: int, overlap: int) -> list[tuple[int, int, int, int]]:
+    """
+    Overlapping tiles covering an image, the last row and column are aligned with the border of the image.
+
+    Args:
+        height (int): height of the image
+        width (int): width of the image
+        tile_size (int): side of the tiles (smaller along a side of the image shorter than a tile)
+        overlap (int): pixels shared by neighbouring tiles
+
+    Returns:
+        list[tuple[int, int, int, int]]: (x0, y0, x1, y1) of every tile, row by row
+    """
+
+    def starts(length):
+        if length <= tile_size:
+            return [0]
+        stride = tile_size - overlap
+        positions = list(range(0, length - tile_size, stride))
+        return positions + [length - tile_size]
+
+    return [
+        (x, y, min(x + tile_size, width), min(y + tile_size, height))
+        for y in starts(height)
+        for x in starts(width)
+    ]
+
+
+def to_output_frame(mask: dict, tile_box: tuple, scale: tuple[float, float], tile_index: int) -> dict:
+    """
+    Mask of a tile (output of SamAutomaticMaskGenerator on the tile) in the coordinates of the output frame,
+    stored as the crop of its bounding box so that its memory only depends on its size in the output frame.
+
+    Args:
+        mask (dict): mask of the tile ("segmentation", "bbox", "predicted_iou", "stability_score")
+        tile_box (tuple): (x0, y0, x1, y1) of the tile in the image
+        scale (tuple[float, float]): size of the output frame over the size of the image, along x and y
+        tile_index (int): index of the tile
+
+    Returns:
+        dict: "crop" (bool array), "rect" (x0, y0, x1, y1) of the crop in the output frame, "tile", "predicted_iou"
+              and "stability_score"
+    """
+    bx, by, bw, bh = (int(v) for v in mask["bbox"])
+    bw, bh = max(bw, 1), max(bh, 1)
+    sx, sy = scale
+    x0, y0 = tile_box[0] + bx, tile_box[1] + by
+    rect = (
+        int(np.floor(x0 * sx)),
+        int(np.floor(y0 * sy)),
+        max(int(np.ceil((x0 + bw) * sx)), int(np.floor(x0 * sx)) + 1),
+        max(int(np.ceil((y0 + bh) * sy)), int(np.floor(y0 * sy)) + 1),
+    )
+    coverage = cv2.resize(
+        mask["segmentation"][by : by + bh, bx : bx + bw].astype(np.uint8) * 255,
+        (rect[2] - rect[0], rect[3] - rect[1]),
+        interpolation=cv2.INTER_AREA,
+    )
+    # pixels mostly covered by the mask, objects smaller than a pixel of the output frame keep their best pixel
+    crop = coverage >= min(128, max(int(coverage.max()), 1))
+    return {
+        "crop": crop,
+        "rect": rect,
+        "tile": tile_index,
+        "predicted_iou": mask["predicted_iou"],
+        "stability_score": mask["stability_score"],
+    }
+
+
+def _region(mask: dict, region: tuple) -> np.ndarray:
+    """Part of a mask inside a region of the output frame (zeros where the mask has no pixels)"""
+    x0, y0, x1, y1 = region
+    out = np.zeros((y1 - y0, x1 - x0), dtype=bool)
+    mx0, my0, mx1, my1 = mask["rect"]
+    ix0, iy0, ix1, iy1 = max(x0, mx0), max(y0, my0), min(x1, mx1), min(y1, my1)
+    if ix0 < ix1 and iy0 < iy1:
+        out[iy0 - y0 : iy1 - y0, ix0 - x0 : ix1 - x0] = mask["crop"][iy0 - my0 : iy1 - my0, ix0 - mx0 : ix1 - mx0]
+    return out
+
+
+def merge_tile_masks(masks: list[dict], tile_rects: list[tuple], iou_thresh: float = 0.5) -> tuple[list[dict], int]:
+    """
+    Join the parts of the objects cut by the tile borders and drop the masks found by two tiles.
+
+    Two masks of different tiles are the same object when their IoU inside the overlap of their tiles (the only
+    region both tiles see) exceeds the threshold, the object is then the union of the masks.
+
+    Args:
+        masks (list[dict]): masks in the output frame (see to_output_frame)
+        tile_rects (list[tuple]): (x0, y0, x1, y1) of every tile in the output frame
+        iou_thresh (float, optional): IoU in the overlap above which two masks are merged. Defaults to 0.5.
+
+    Returns:
+        tuple[list[dict], int]: merged masks ("crop", "rect", "area", "predicted_iou" and "stability_score" of the
+                                largest part) and the number of masks merged into another one
+    """
+    if not masks:
+        return [], 0
+    rects = np.array([mask["rect"] for mask in masks])
+    tiles = np.array([mask["tile"] for mask in masks])
+    # candidate pairs: masks of different tiles whose boxes intersect
+    intersect = (
+        (rects[:, None, 0] < rects[None, :, 2])
+        & (rects[None, :, 0] < rects[:, None, 2])
+        & (rects[:, None, 1] < rects[None, :, 3])
+        & (rects[None, :, 1] < rects[:, None, 3])
+        & (tiles[:, None] < tiles[None, :])
+    )
+
+    parent = list(range(len(masks)))
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    for i, j in zip(*np.nonzero(intersect)):
+        a, b = tile_rects[tiles[i]], tile_rects[tiles[j]]
+        band = (max(a[0], b[0]), max(a[1], b[1]), min(a[2], b[2]), min(a[3], b[3]))
+        if band[0] >= band[2] or band[1] >= band[3]:
+            continue
+        part_i, part_j = _region(masks[i], band), _region(masks[j], band)
+        union = np.logical_or(part_i, part_j).sum()
+        if union > 0 and np.logical_and(part_i, part_j).sum() / union > iou_thresh:
+            parent[find(i)] = find(j)
+
+    groups = {}
+    for i in range(len(masks)):
+        groups.setdefault(find(i), []).append(masks[i])
+
+    merged = []
+    for members in groups.values():
+        rect = (
+            min(m["rect"][0] for m in members),
+            min(m["rect"][1] for m in members),
+            max(m["rect"][2] for m in members),
+            max(m["rect"][3] for m in members),
+        )
+        crop = np.zeros((rect[3] - rect[1], rect[2] - rect[0]), dtype=bool)
+        for member in members:
+            crop |= _region(member, rect)
+        largest = max(members, key=lambda m: m["crop"].sum())
+        merged.append(
+            {
+                "crop": crop,
+                "rect": rect,
+                "area": int(crop.sum()),
+                "predicted_iou": largest["predicted_iou"],
+                "stability_score": largest["stability_score"],
+            }
+        )
+    return merged, len(masks) - len(merged)
+
+
+def paste_mask(mask: dict, size: tuple[int, int]) -> dict:
+    """Mask of the output frame with a full (height, width) "segmentation", as SamAutomaticMaskGenerator gives them"""
+    x0, y0, x1, y1 = mask["rect"]
+    segmentation = np.zeros(size, dtype=bool)
+    segmentation[y0:y1, x0:x1] = mask["crop"][: size[0] - y0, : size[1] - x0]
+    return {
+        "segmentation": segmentation,
+        "area": int(segmentation.sum()),
+        "bbox": [x0, y0, x1 - x0, y1 - y0],
+        "predicted_iou": mask["predicted_iou"],
+        "stability_score": mask["stability_score"],
+    }
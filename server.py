@@ -0,0 +1,197 @@
+import argparse
+import asyncio
+import base64
+import io
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+
+import numpy as np
+import uvicorn
+from fastapi import FastAPI, HTTPException
+from PIL import Image
+from pydantic import BaseModel
+
+from configuration import load_yaml_config
+from inference import InferencePipeline, InferenceSample
+
+
+def arg_parser():
+    parser = argparse.ArgumentParser(description="HTTP inference server")
+    parser.add_argument("--config", type=str, default="config.yaml", help="Path to the project configuration")
+    parser.add_argument("--model_name", type=str, default="shorter_big", help="Model in the models directory")
+    parser.add_argument("--host", type=str, default="0.0.0.0", help="Address to listen on")
+    parser.add_argument("--port", type=int, default=8000, help="Port to listen on")
+    parser.add_argument("--max_batch_size", type=int, default=8, help="Maximum number of requests processed together")
+    parser.add_argument("--fast_adapter", action="store_true", help="Serve the fused inference version of the SegAdapter")
+    parser.add_argument("--max_wait_ms", type=float, default=20, help="Time the first request of a batch waits for others to join it")
+    return parser.parse_args()
+
+
+class InferenceRequest(BaseModel):
+    query: str
+    # base64 encoded image file (png, jpg, ...)
+    image: str
+    max_new_tokens: int = 100
+    n_beams: int = 1
+    repeat_penalty: float = 2.0
+    temperature: float = 0.8
+    do_sample: bool = False
+    constrained: bool = False
+
+
+class InferenceResponse(BaseModel):
+    gen_text: str
+    chosen_tokens: list[int]
+    masks: list[list[list[list[int]]]]
+    batch_size: int
+    latency_ms: float
+
+
+def decode_image(data: str) -> Image.Image:
+    """PIL image of a base64 encoded image file"""
+    image = Image.open(io.BytesIO(base64.b64decode(data)))
+    image.load()
+    return image
+
+
+def masks_to_lists(masks: list) -> list:
+    """Shapes with plain python integers (the contour points may be numpy integers)"""
+    return [[np.asarray(contour).reshape(-1, 2).tolist() for contour in shape] for shape in masks]
+
+
+class MicroBatcher:
+    """
+    Group the requests arriving close to each other into batches for InferencePipeline.inference.
+
+    The first request of a batch waits at most max_wait_ms for other requests, the batch is closed earlier when it
+    reaches max_batch_size. Requests with different generation parameters cannot be generated together, a batch is
+    split in one call per set of parameters. The pipeline runs in a single worker thread so that the event loop keeps
+    accepting requests while a batch is being processed.
+    """
+
+    def __init__(self, pipeline: InferencePipeline, max_batch_size: int = 8, max_wait_ms: float = 20):
+        """
+        Args:
+            pipeline (InferencePipeline): pipeline answering the requests
+            max_batch_size (int, optional): maximum number of requests in a batch. Defaults to 8.
+            max_wait_ms (float, optional): maximum time the first request of a batch waits for others. Defaults to 20.
+        """
+        self.pipeline = pipeline
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.queue: asyncio.Queue = None
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.task: asyncio.Task = None
+
+    def start(self):
+        """Start collecting batches (must be called from the event loop)"""
+        self.queue = asyncio.Queue()
+        self.task = asyncio.create_task(self._collect())
+
+    async def stop(self):
+        """Stop collecting batches and wait for the running one"""
+        self.task.cancel()
+        self.executor.shutdown(wait=True)
+
+    async def submit(self, sample: InferenceSample, generation_kwargs: dict) -> tuple[dict, int]:
+        """
+        Queue a request and wait for its result.
+
+        Returns:
+            tuple[dict, int]: output of InferencePipeline.inference for the sample and size of its batch
+        """
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((sample, generation_kwargs, future))
+        return await future
+
+    async def _next_batch(self) -> list:
+        loop = asyncio.get_running_loop()
+        batch = [await self.queue.get()]
+        deadline = loop.time() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _collect(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self._next_batch()
+
+            groups: dict[tuple, list] = {}
+            for item in batch:
+                groups.setdefault(tuple(sorted(item[1].items())), []).append(item)
+
+            for items in groups.values():
+                samples = [sample for sample, _, _ in items]
+                try:
+                    results = await loop.run_in_executor(self.executor, self._run, samples, items[0][1])
+                except Exception as e:
+                    for _, _, future in items:
+                        if not future.done():
+                            future.set_exception(e)
+                    continue
+                for (_, _, future), result in zip(items, results):
+                    if not future.done():
+                        future.set_result((result, len(items)))
+
+    def _run(self, samples: list[InferenceSample], generation_kwargs: dict) -> list[dict]:
+        return list(self.pipeline.inference(samples, **generation_kwargs))
+
+
+def create_app(pipeline: InferencePipeline, max_batch_size: int = 8, max_wait_ms: float = 20) -> FastAPI:
+    """
+    HTTP/JSON application serving the pipeline.
+
+    Endpoints:
+        GET /health: status of the server
+        POST /infer: answer an InferenceRequest with an InferenceResponse
+    """
+    batcher = MicroBatcher(pipeline, max_batch_size, max_wait_ms)
+
+    @asynccontextmanager
+    async def lifespan(app: FastAPI):
+        batcher.start()
+        yield
+        await batcher.stop()
+
+    app = FastAPI(title="LISA inference server", lifespan=lifespan)
+
+    @app.get("/health")
+    async def health():
+        return {"status": "ok", "model": pipeline.model_name, "device": pipeline.device}
+
+    @app.post("/infer", response_model=InferenceResponse)
+    async def infer(request: InferenceRequest):
+        start = time.perf_counter()
+        try:
+            image = decode_image(request.image)
+        except Exception as e:
+            raise HTTPException(status_code=400, detail=f"Invalid image: {e}")
+
+        generation_kwargs = request.model_dump(exclude={"query", "image"})
+        result, batch_size = await batcher.submit(InferenceSample(query=request.query, image=image), generation_kwargs)
+        return InferenceResponse(
+            gen_text=result["gen_text"],
+            chosen_tokens=result["chosen_tokens"],
+            masks=masks_to_lists(result["masks"]),
+            batch_size=batch_size,
+            latency_ms=(time.perf_counter() - start) * 1000,
+        )
+
+    return app
+
+
+# python server.py --model_name shorter_big --max_batch_size 8 --max_wait_ms 20
+# python client.py inference/2593366765_589ca5148e_o.jpg "Where is the van?" "Is there a ladder in this image?"
+if __name__ == "__main__":
+    args = arg_parser()
+    config = load_yaml_config(args.config)
+    pipeline = InferencePipeline(config, args.model_name, fast_adapter=args.fast_adapter)
+    uvicorn.run(create_app(pipeline, args.max_batch_size, args.max_wait_ms), host=args.host, port=args.port)
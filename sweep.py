@@ -0,0 +1,71 @@
+import argparse
+import warnings
+
+from llava_finetune.sweep import available_slots, expand_grid, run_sweep
+from llava_finetune.utils import get_datasets
+from train import config, experiments_config, seed
+
+warnings.filterwarnings("ignore")
+
+# ==========================
+# 1. Sweep Configuration
+# ==========================
+sweep_config = {
+    "name": "SWEEP_LR",
+    # every run starts from this experiment and overrides the parameters of the grid
+    "base": experiments_config["TEST_REDUCT_NEG"],
+    # dotted keys of the experiment configuration, every combination is a run
+    "grid": {
+        "optimizer.adapter_lr": [1e-3, 3e-4],
+        "optimizer.lora_lr": [1e-6, 1e-5],
+        "model_params.dropout": [0.1, 0.2],
+    },
+    # explicit list of runs, trained in addition to the grid
+    "configs": [],
+    "halving": {
+        "min_epochs": 5,  # Epochs trained by every run before the first pruning
+        "reduction_factor": 2,  # Only the best 1/reduction_factor runs (by validation F1) continue at every rung
+    },
+    "runs_per_gpu": 1,  # Runs trained at the same time on each GPU
+    "cpu_slots": None,  # Runs trained at the same time without GPU (None: half the CPU cores)
+}
+
+
+def arg_parser():
+    parser = argparse.ArgumentParser(description="Hyperparameter sweep")
+    parser.add_argument("--resume", action="store_true", help="Continue an interrupted sweep from the checkpoints of its runs")
+    return parser.parse_args()
+
+
+# ==========================
+# 2. Main Execution
+# ==========================
+# python sweep.py: the results table is written to sweeps/<name>.csv after every rung
+if __name__ == "__main__":
+    args = arg_parser()
+
+    # the datasets are loaded once and shared by all the workers
+    print("Loading Datasets")
+    datasets = get_datasets(
+        config.dataset.json_path,
+        config.dataset.image_dir,
+        "data/train_final.jsonl",
+        "data/val_final.jsonl",
+        "data/test_final.jsonl",
+        top_samples=config.performance.top_samples,
+        embedding_encoding=config.performance.embedding_encoding,
+    )
+    print("Datasets Loaded Successfully")
+
+    run_sweep(
+        sweep_config["name"],
+        expand_grid(sweep_config["base"], sweep_config["grid"], sweep_config["configs"]),
+        config,
+        datasets,
+        batch_size=config.performance.train_batch_size,
+        eval_batch_size=config.performance.eval_batch_size,
+        seed=seed,
+        slots=available_slots(sweep_config["cpu_slots"], sweep_config["runs_per_gpu"]),
+        resume=args.resume,
+        **sweep_config["halving"],
+    )
@@ -0,0 +1,76 @@
+import argparse
+import json
+import time
+
+import torch
+from tqdm import tqdm
+
+from llava_finetune.embeddings import decode_embeddings, num_embeddings
+from llava_finetune.functions import load_model
+from llava_finetune.token_index import INDEX_PATH, TokenIndex
+
+
+def arg_parser():
+    parser = argparse.ArgumentParser(description="Approximate nearest-neighbour index of the LLaVA vocabulary")
+    parser.add_argument("command", choices=["build", "label"], help="build the index, or label every mask of a dataset with its top tokens")
+    parser.add_argument("--model_name", type=str, default="TEST_REDUCT_NEG", help="Model in the models directory (its base model gives the vocabulary, its adapter the mask embeddings)")
+    parser.add_argument("--metric", type=str, default="cosine", choices=["ip", "cosine"], help="Similarity of the index")
+    parser.add_argument("--n_lists", type=int, default=1024, help="Number of inverted lists")
+    parser.add_argument("--n_subvectors", type=int, default=64, help="Number of pieces of the product quantizer")
+    parser.add_argument("--n_probe", type=int, default=16, help="Inverted lists scored for every query")
+    parser.add_argument("--rerank", type=int, default=100, help="Candidates rescored with the exact embeddings (0 to disable)")
+    parser.add_argument("--k", type=int, default=10, help="Number of tokens of every mask")
+    parser.add_argument("--dataset", type=str, default="data/val-v3.jsonl", help="Dataset whose masks are labelled")
+    parser.add_argument("--output", type=str, default="output/mask_tokens.jsonl", help="Labels of the masks")
+    parser.add_argument("--recall_samples", type=int, default=1000, help="Masks used to measure the recall against the exact search")
+    return parser.parse_args()
+
+
+def report_recall(index, queries, emb_matrix, args):
+    """Print the recall@k and the search time per mask of the index against the exact search"""
+    start = time.perf_counter()
+    index.search(queries, args.k, args.n_probe, args.rerank, emb_matrix)
+    elapsed = (time.perf_counter() - start) / len(queries) * 1000
+    recall = index.recall(queries, emb_matrix, args.k, n_probe=args.n_probe, rerank=args.rerank)
+    print(f"Recall@{args.k}: {recall:.4f} ({elapsed:.2f} ms per mask, n_probe={args.n_probe}, rerank={args.rerank})")
+
+
+# python token_index.py build --metric cosine
+# python token_index.py label --dataset data/val-v3.jsonl --output output/mask_tokens.jsonl
+if __name__ == "__main__":
+    args = arg_parser()
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+
+    model = load_model(f"models/{args.model_name}.pth", f"models/{args.model_name}.json", device).eval()
+    emb_matrix = model.llava_model.original_emb_matrix
+    tokenizer = model.llava_model.processor.tokenizer
+    index_path = INDEX_PATH.format(metric=args.metric)
+
+    if args.command == "build":
+        print(f"Building the {args.metric} index of {len(emb_matrix)} tokens")
+        index = TokenIndex.build(emb_matrix, args.metric, args.n_lists, args.n_subvectors)
+        index.save(index_path)
+        print(f"Index saved to {index_path}")
+
+        # the vocabulary embeddings themselves (slightly perturbed) as queries
+        queries = emb_matrix[torch.randperm(len(emb_matrix))[: args.recall_samples].to(emb_matrix.device)].float()
+        report_recall(index, queries + 0.1 * queries.std() * torch.randn_like(queries), emb_matrix, args)
+    else:
+        index = TokenIndex.load(index_path, device)
+        recall_queries = []
+        with open(args.dataset, "r") as f, open(args.output, "w") as out, torch.no_grad():
+            for line in tqdm(f):
+                sample = json.loads(line)
+                if num_embeddings(sample["sam_embs"]) == 0:
+                    continue
+                embs = model.adapter(decode_embeddings(sample["sam_embs"]).to(device))
+                _, ids = index.search(embs, args.k, args.n_probe, args.rerank, emb_matrix)
+                out.write(json.dumps({
+                    "img": sample["img"],
+                    "tokens": [[tokenizer.decode([i]) for i in mask_ids] for mask_ids in ids.tolist()],
+                }) + "\n")
+                if sum(len(q) for q in recall_queries) < args.recall_samples:
+                    recall_queries.append(embs)
+        print(f"Labels saved to {args.output}")
+
+        report_recall(index, torch.cat(recall_queries)[: args.recall_samples], emb_matrix, args)
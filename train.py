@@ -1,3 +1,4 @@
+import argparse
 import warnings
 import torch
 import random
@@ -5,6 +6,7 @@ import numpy as np
 
 import wandb
 from configuration import load_yaml_config
+from llava_finetune.distributed import cleanup, init_distributed
 from llava_finetune.functions import run_experiment
 from llava_finetune.utils import get_dataloaders
 
@@ -63,24 +65,60 @@ experiments_config = {
             "text": True, # Whether to use text or not (add "in the image the objects are ...")
         },
         "log_interval": 10,  # How often to log to wandb
+        "profile": False,  # Time the stages of the training step and log them every log_interval
+        "memory_profile": False,  # Record the peak memory of every stage (training step, validation, test) and save a report to output/memory
+        "memory_tracemalloc": False,  # With memory_profile, also record the python allocations (slow)
         "val_every": 50,  # How often to run validation
+        "val_mode": "generate",  # "generate" or "teacher_forced" (single forward pass per batch, much faster)
+        "full_val_every": None,  # With teacher forced validation, how often to also run the generate-based one (multiple of val_every)
+        "hard_negatives": None,  # e.g. {"num_hard": 8, "num_random": 2}: negatives injected per training step (most similar to the gt masks + random ones), all of them if None
+        "checkpoint": {
+            "every_steps": 50,  # Minimum number of steps between two training state checkpoints
+            "max_overhead": 0.05,  # Maximum fraction of the training time spent saving checkpoints
+        },
     }
 }
 
 
+def arg_parser():
+    parser = argparse.ArgumentParser(description="Training")
+    parser.add_argument("--resume", action="store_true", help="Resume each experiment from its last training state checkpoint")
+    return parser.parse_args()
+
+
 # ==========================
 # 2. Main Execution
 # ==========================
+# Single process: python train.py
+# Several processes/nodes: torchrun --nproc_per_node=N train.py (nccl on GPUs, gloo on CPU)
 if __name__ == "__main__":
+    args = arg_parser()
+    performance = config.performance
+    # gloo when the performance section asks for the cpu, a single process trains on the configured device
+    rank, world_size, device = init_distributed("gloo" if performance.device == "cpu" else None)
+    if world_size == 1:
+        device = performance.resolve_device()
+    # different random masking and query choices in every process
+    torch.manual_seed(seed + rank)
+    random.seed(seed + rank)
+    np.random.seed(seed + rank)
+
     # Load datasets based on configuration
     print("Loading Datasets")
     data_loader, data_val_loader, data_test_loader = get_dataloaders(
         config.dataset.json_path,
         config.dataset.image_dir,
-        2,
+        performance.train_batch_size,
         "data/train_final.jsonl",
         "data/val_final.jsonl",
         "data/test_final.jsonl",
+        seed=seed,
+        rank=rank,
+        world_size=world_size,
+        eval_batch_size=performance.eval_batch_size,
+        num_workers=performance.num_workers,
+        top_samples=performance.top_samples,
+        embedding_encoding=performance.embedding_encoding,
     )
     print("Datasets Loaded Successfully")
 
@@ -91,4 +129,8 @@ if __name__ == "__main__":
             exp_config=exp_config,
             config=config,
             data_loaders=(data_loader, data_val_loader, data_test_loader),
+            resume=args.resume,
+            device=device,
         )
+
+    cleanup()
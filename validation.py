@@ -3,14 +3,14 @@ from PIL import Image, ImageDraw
 from tqdm.auto import tqdm
 import wandb
 import json
+import os
 import argparse
 from inference import InferencePipeline, InferenceSample
+from llava_finetune.metrics import compute_metrics, summarize_metrics
 from llava_finetune.utils import get_dataloaders
 from configuration import load_yaml_config
 import torch
 import numpy as np
-from shapely.geometry import Polygon
-from shapely.ops import unary_union
 
 # seed for reproducibility
 seed = 42
@@ -23,6 +23,10 @@ def arg_parser():
     parser.add_argument("--train_json", type=str, default="data/train-v3.jsonl", help="Path to the training JSON file")
     parser.add_argument("--val_json", type=str, default="data/val-v3.jsonl", help="Path to the validation JSON file")
     parser.add_argument("--test_json", type=str, default="data/test-v3.jsonl", help="Path to the test JSON file")
+    parser.add_argument("--metric_workers", type=int, default=None, help="Processes computing the IoU metrics (0 to compute them in the main process, default: metric_workers of the performance section)")
+    parser.add_argument("--offline", action="store_true", help="Use the SAM embeddings and shapes stored in the JSON files instead of preprocessing the images (SAM and AlphaCLIP are not loaded). "
+                        "The stored SAM masks exclude the ground truth masks and are truncated to top_samples, so the target mask can only be selected with the gt masks: "
+                        "the metrics are logged under val_offline/ and are not comparable with the online val/ ones")
     return parser.parse_args()
 
 def shapes_to_mask(shapes, size=(1024, 1024)):
@@ -38,95 +42,6 @@ def shapes_to_mask(shapes, size=(1024, 1024)):
     
     return np.array(mask, dtype=bool)
 
-def compute_IoU(gt_shapes, pred_shapes):
-    """
-    Compute IoU and gIoU using Shapely geometry operations.
-
-    Args:
-        gt_shapes (list): List of ground truth polygons, each polygon is a list of [x,y] points.
-        pred_shapes (list): List of predicted polygons, each polygon is a list of [x,y] points.
-
-    Returns:
-        dict: Dictionary containing IoU and gIoU scores as well as intersection and union areas.
-    """
-    # Convert shapes into valid Shapely Polygons
-    # 1,2,48
-    gt_polygons = []
-    for shape in gt_shapes:
-        for poly in shape:
-            if len(poly) >= 3:
-                p = Polygon(poly)
-                if p.is_valid and not p.is_empty:
-                    gt_polygons.append(p)
-                else:
-                    tqdm.write("Invalid GT polygon")
-            else:
-                tqdm.write("Invalid GT polygon not enough points")
-    
-    # 2,1,57
-    pred_polygons = []
-    for shape in pred_shapes:
-        for poly in shape:
-            if len(poly) >= 3:
-                p = Polygon(poly)
-                if p.is_valid and not p.is_empty:
-                    pred_polygons.append(p)
-                else:
-                    tqdm.write("Invalid prediction polygon")
-            else:
-                tqdm.write("Invalid prediction polygon not enough points")
-    
-    # If no valid polygons in either GT or prediction, IoU and gIoU are zero
-    if len(gt_polygons) == 0 or len(pred_polygons) == 0:
-        tqdm.write("No valid polygons in either GT or prediction")
-        return {
-            "intersection": 0.0,
-            "union": 0.0,
-            "IoU": 0.0,
-            "gIoU": 0.0
-        }
-    
-    # Create union polygons
-    gt_union = unary_union(gt_polygons)
-    pred_union = unary_union(pred_polygons)
-    
-    # Intersection and union areas
-    intersection_area = gt_union.intersection(pred_union).area
-    union_area = gt_union.union(pred_union).area
-    
-    IoU = intersection_area / union_area if union_area > 0 else 0.0
-    
-    # If no intersection or union is zero, IoU = 0 and so gIoU = 0
-    if union_area == 0:
-        tqdm.write("Union area is zero")
-        return {
-            "intersection": intersection_area,
-            "union": union_area,
-            "IoU": IoU,
-            "gIoU": 0.0
-        }
-
-    # Compute the convex hull of the combined geometry
-    combined_geometry = gt_union.union(pred_union)
-    convex_hull = combined_geometry.convex_hull
-    convex_hull_area = convex_hull.area
-    
-    # gIoU = IoU - ((ConvexHullArea - UnionArea) / ConvexHullArea)
-    # Ensure convex_hull_area > 0
-    if convex_hull_area == 0:
-        # Degenerate case: everything collapses to a line or point
-        tqdm.write("Convex hull area is zero")
-        gIoU = IoU
-    else:
-        gIoU = IoU - ((convex_hull_area - union_area) / convex_hull_area)
-    
-    return {
-        "intersection": intersection_area,
-        "union": union_area,
-        "IoU": IoU,
-        "gIoU": gIoU
-    }
-
 
 if __name__ == "__main__":
     args = arg_parser()
@@ -134,17 +49,39 @@ if __name__ == "__main__":
     config = load_yaml_config("config_davide.yaml")
     wan_db_token = config.others.wandb_token
     wandb.login(key=wan_db_token)
+    performance = config.performance
+    metric_workers = args.metric_workers if args.metric_workers is not None else performance.metric_workers
 
-    # Initialize data loaders
+    # Initialize data loaders, the batches of the validation loader are the batches of the inference pipeline
     data_loader, data_val_loader, data_test_loader = get_dataloaders(
         config.dataset.json_path,
         config.dataset.image_dir,
-        1,
+        performance.train_batch_size,
         args.train_json,
         args.val_json,
-        args.test_json
+        args.test_json,
+        eval_batch_size=performance.eval_batch_size,
+        num_workers=performance.num_workers,
+        top_samples=performance.top_samples,
+        embedding_encoding=performance.embedding_encoding,
     )
     
+    # The evaluation samples are built once and shared by all the models, so that every model answers the same queries.
+    # Offline, the stored SAM embeddings and shapes of the dataset are given to the model instead of preprocessing the images
+    output_seg_query = " Output the segmentation mask for the object in the image"
+    val_batches = []
+    for data in data_val_loader:
+        stored = [
+            {"sam_embs": data["sam_embs"][i].tolist(), "sam_shapes": data["sam_shapes"][i]} if args.offline else {}
+            for i in range(len(data["queries"]))
+        ]
+        samples = [InferenceSample(data["queries"][i]+output_seg_query, data["image_path"][i], **stored[i]) for i in range(len(data["queries"]))]
+        samples_with_gt_masks = [InferenceSample(data["queries"][i]+output_seg_query, data["image_path"][i], data["gt_embs"][i].tolist(), data["gt_shapes"][i], **stored[i]) for i in range(len(data["queries"]))]
+        val_batches.append((samples, samples_with_gt_masks, data["gt_shapes"]))
+
+    # the offline SAM masks have no ground truth mask, their metrics are kept apart from the online ones
+    prefix = "val_offline" if args.offline else "val"
+
     # Initialize inference pipeline
     models = ["LONG", "MLP-adapter-big-outputLora-randomized", "TEST_REDUCT_NEG"]
     for model_name in models:
@@ -156,74 +93,54 @@ if __name__ == "__main__":
         wandb.init(project="ACV_testing", name=f"{model_name}", config=model_params)
 
         inference_pipeline = InferencePipeline(config, model_name)
-        output_seg_query = " Output the segmentation mask for the object in the image"
 
-        # Validation phase
-        val_intersection = 0
-        val_intersection_with_gt_masks = 0
-        val_union = 0
-        val_union_with_gt_masks = 0
-        val_iou_list = []
-        val_iou_list_with_gt_masks = []
-        val_giou_list = []
-        val_giou_list_with_gt_masks = []
-
-        for data in tqdm(data_val_loader):
-            samples = [InferenceSample(data["queries"][i]+output_seg_query, data["image_path"][i]) for i in range(len(data["queries"]))]
+        # Validation phase: generation first, the metrics of all the samples are then computed in a pool of processes
+        gt_shapes = []
+        pred_shapes = []
+        pred_shapes_with_gt_masks = []
+        for samples, samples_with_gt_masks, batch_gt_shapes in tqdm(val_batches):
             results = inference_pipeline.inference(samples, n_beams=1, temperature=0.1, repeat_penalty=1.0, max_new_tokens=200)
             
-            samples_with_gt_masks = [InferenceSample(data["queries"][i]+output_seg_query, data["image_path"][i], data["gt_embs"][i], data["gt_shapes"][i]) for i in range(len(data["queries"]))]
             results_with_gt_masks = inference_pipeline.inference(samples_with_gt_masks, n_beams=1, temperature=0.1, repeat_penalty=1.0, max_new_tokens=200)
 
-            i = 0
-            for result, result_with_gt_masks in zip(results, results_with_gt_masks):
-                gt_shapes = data["gt_shapes"][i]
-                
-                pred_shapes = result["masks"]
-                pred_shapes_with_gt_masks = result_with_gt_masks["masks"]
+            for result, result_with_gt_masks, shapes in zip(results, results_with_gt_masks, batch_gt_shapes):
+                gt_shapes.append(shapes)
+                pred_shapes.append(result["masks"])
+                pred_shapes_with_gt_masks.append(result_with_gt_masks["masks"])
 
-                metrics = compute_IoU(gt_shapes, pred_shapes)
-                metrics_with_gt_masks = compute_IoU(gt_shapes, pred_shapes_with_gt_masks)
+        metrics = compute_metrics(gt_shapes, pred_shapes, workers=metric_workers)
+        metrics_with_gt_masks = compute_metrics(gt_shapes, pred_shapes_with_gt_masks, workers=metric_workers)
 
-                val_intersection += metrics["intersection"]
-                val_union += metrics["union"]
-                val_giou_list.append(metrics["gIoU"])
-                val_iou_list.append(metrics["IoU"])
-                
-                val_intersection_with_gt_masks += metrics_with_gt_masks["intersection"]
-                val_union_with_gt_masks += metrics_with_gt_masks["union"]
-                val_giou_list_with_gt_masks.append(metrics_with_gt_masks["gIoU"])
-                val_iou_list_with_gt_masks.append(metrics_with_gt_masks["IoU"])
-                
-                wandb.log({
-                    "val/gIoU_per_sample": metrics["gIoU"],
-                    "val/IoU_per_sample": metrics["IoU"],
-                    "val/gIoU_per_sample_with_gt_masks": metrics_with_gt_masks["gIoU"],
-                    "val/IoU_per_sample_with_gt_masks": metrics_with_gt_masks["IoU"]
-                })
-                i += 1
+        for sample_metrics, sample_metrics_with_gt_masks in zip(metrics, metrics_with_gt_masks):
+            wandb.log({
+                f"{prefix}/gIoU_per_sample": sample_metrics["gIoU"],
+                f"{prefix}/IoU_per_sample": sample_metrics["IoU"],
+                f"{prefix}/gIoU_per_sample_with_gt_masks": sample_metrics_with_gt_masks["gIoU"],
+                f"{prefix}/IoU_per_sample_with_gt_masks": sample_metrics_with_gt_masks["IoU"]
+            })
 
-        val_giou = np.mean(val_giou_list)
-        val_ciou = val_intersection / val_union if val_union > 0 else 0.0
-        val_iou = np.mean(val_iou_list)
-        
-        val_giou_with_gt_masks = np.mean(val_giou_list_with_gt_masks)
-        val_ciou_with_gt_masks = val_intersection_with_gt_masks / val_union_with_gt_masks if val_union_with_gt_masks > 0 else 0.0
-        val_iou_with_gt_masks = np.mean(val_iou_list_with_gt_masks)
+        summary = summarize_metrics(metrics)
+        summary_with_gt_masks = summarize_metrics(metrics_with_gt_masks)
 
         wandb.log({
-            "val/mean_gIoU": val_giou,
-            "val/cIoU": val_ciou,
-            "val/mean_gIoU_with_gt_masks": val_giou_with_gt_masks,
-            "val/cIoU_with_gt_masks": val_ciou_with_gt_masks,
-            "val/mean_IoU": val_iou,
-            "val/mean_IoU_with_gt_masks": val_iou_with_gt_masks
+            f"{prefix}/mean_gIoU": summary["mean_gIoU"],
+            f"{prefix}/cIoU": summary["cIoU"],
+            f"{prefix}/mean_gIoU_with_gt_masks": summary_with_gt_masks["mean_gIoU"],
+            f"{prefix}/cIoU_with_gt_masks": summary_with_gt_masks["cIoU"],
+            f"{prefix}/mean_IoU": summary["mean_IoU"],
+            f"{prefix}/mean_IoU_with_gt_masks": summary_with_gt_masks["mean_IoU"],
+            f"{prefix}/invalid_contours": summary["invalid"] + summary_with_gt_masks["invalid"],
         })
 
-        print(f"Validation gIoU: {val_giou}")
-        print(f"Validation cIoU: {val_ciou}")
-        print(f"Validation gIoU with gt masks: {val_giou_with_gt_masks}")
-        print(f"Validation cIoU with gt masks: {val_ciou_with_gt_masks}")
+        if args.offline:
+            print("Offline metrics: the stored SAM masks do not contain the ground truth masks")
+        print(f"Validation gIoU: {summary['mean_gIoU']}")
+        print(f"Validation cIoU: {summary['cIoU']}")
+        print(f"Validation gIoU with gt masks: {summary_with_gt_masks['mean_gIoU']}")
+        print(f"Validation cIoU with gt masks: {summary_with_gt_masks['cIoU']}")
+
+        if inference_pipeline.memory.enabled:
+            inference_pipeline.memory.save(os.path.join(config.profiling.report_dir, f"validation_{model_name}.json"))
 
         # # Test phase
         # test_intersection = 0
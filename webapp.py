@@ -1,10 +1,11 @@
 import os
-import glob
+import threading
+
 import gradio as gr
-from PIL import Image
 import matplotlib.pyplot as plt
 
 from inference import InferencePipeline, InferenceSample, load_yaml_config
+from llava_finetune.registry import ModelRegistry
 from llava_finetune.utils import draw_shapes
 
 plt.ioff()  # Disable interactive matplotlib
@@ -12,36 +13,48 @@ plt.ioff()  # Disable interactive matplotlib
 # Load configuration
 config = load_yaml_config("config.yaml")
 
+# All the models share one base LLaVA model, each one only adds its LoRA weights and adapter
+registry = ModelRegistry("models", config.performance.resolve_device(), config.performance.dtype)
+
 # Get the list of available models
-model_paths = glob.glob("models/*.pth")
-model_names = [os.path.basename(p).replace(".pth", "") for p in model_paths]
+model_names = registry.available()
 
 def load_pipeline(model_name):
-    pipeline = InferencePipeline(config, model_name)
+    # SAM and AlphaCLIP are shared between the pipelines as well, with the cache of the preprocessed images
+    first = next(iter(pipelines.values()), None)
+    pipeline = InferencePipeline(
+        config,
+        model_name,
+        registry=registry,
+        preprocess=first.pp if first else None,
+        cache=first.cache if first else None,
+    )
     return pipeline
 
 # Cache pipelines
 pipelines = {}
+pipelines_lock = threading.Lock()
 
-def inference_fn(model_name, query, image, max_new_tokens, n_beams, temperature, repeat_penalty):
+# Requests processed at the same time, each one works on its own in-memory image
+CONCURRENCY_LIMIT = int(os.environ.get("WEBAPP_CONCURRENCY", 4))
+
+def inference_fn(model_name, query, image, max_new_tokens, n_beams, temperature, repeat_penalty, constrained):
     if image is None or query.strip() == "":
         return "Please provide both an image and a query.", None
 
-    if model_name not in pipelines:
-        pipelines[model_name] = load_pipeline(model_name)
+    with pipelines_lock:
+        if model_name not in pipelines:
+            pipelines[model_name] = load_pipeline(model_name)
 
     pipeline : InferencePipeline = pipelines[model_name]
 
-    # Temporary save for inference
-    tmp_image_path = "inference/temp_upload.png"
-    image.save(tmp_image_path)
-
-    data = [InferenceSample(query=query, image=tmp_image_path)]
+    # the uploaded image is given to the pipeline in memory, nothing is written to disk
+    data = [InferenceSample(query=query, image=image)]
 
-    results = pipeline.inference(data, max_new_tokens=max_new_tokens, n_beams=n_beams, temperature=temperature, repeat_penalty=repeat_penalty)
+    results = pipeline.inference(data, max_new_tokens=max_new_tokens, n_beams=n_beams, temperature=temperature, repeat_penalty=repeat_penalty, constrained=constrained)
     result = next(results)
 
-    orig_image = Image.open(tmp_image_path).convert("RGBA")
+    orig_image = image.convert("RGBA")
     processed_image = draw_shapes(orig_image, result["masks"], mask_names=[f"<SEG_MASK_{idx+1}>" for idx in result["chosen_tokens"]])
 
     return result["gen_text"], processed_image
@@ -105,6 +118,11 @@ with gr.Blocks(title="LLaVA Model Inference Interface") as demo:
                     label="Repetition Penalty",
                     info="Higher values reduce repeated tokens in the output."
                 )
+                constrained_checkbox = gr.Checkbox(
+                    value=False,
+                    label="Constrained Decoding",
+                    info="Only answer with the selected masks (faster, no free text)."
+                )
             
             with gr.Row():
                 run_button = gr.Button("Run Inference", variant="primary")
@@ -136,7 +154,7 @@ with gr.Blocks(title="LLaVA Model Inference Interface") as demo:
     # Button actions
     run_button.click(
         fn=inference_fn,
-        inputs=[model_dropdown, query_input, image_input, max_new_tokens, n_beams_slider, temperature_slider, repeat_penalty_slider],
+        inputs=[model_dropdown, query_input, image_input, max_new_tokens, n_beams_slider, temperature_slider, repeat_penalty_slider, constrained_checkbox],
         outputs=[answer_output, processed_image_output]
     )
 
@@ -151,4 +169,5 @@ with gr.Blocks(title="LLaVA Model Inference Interface") as demo:
     )
 
 if __name__ == "__main__":
+    demo.queue(default_concurrency_limit=CONCURRENCY_LIMIT)
     demo.launch(server_name="0.0.0.0", server_port=7860)